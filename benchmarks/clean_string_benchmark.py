@@ -0,0 +1,71 @@
+from argparse import ArgumentParser
+
+import os
+import re
+import sys
+import time
+# The benchmark is run from the root of the repository, like main.py
+sys.path.insert(0, 'src')
+
+from unidecode import unidecode
+from utils import clean_string, conllu_file_path_loader, leaf_dirs, rootdir_orig
+
+
+def reference_clean_string(str):
+    # The original implementation: uncompiled pattern, 'unidecode' on every call, two passes.
+    cleaned_string = re.sub('[^a-zA-Z0-9]', '', unidecode(str))
+    return cleaned_string.lower()
+
+
+def collect_sentences(language):
+    """
+    Collect the sentences that are normalized during the generation for a language:
+    the '# text =' lines of the UD treebank and the sentences of the morphology probes (all tasks, all splits).
+    """
+    sentences = []
+    for conllu_path in conllu_file_path_loader(language):
+        if not conllu_path.endswith(".conllu"):
+            continue
+        with open(conllu_path, "r", encoding="utf-8") as conllu_file:
+            for line in conllu_file:
+                if line.startswith("# text = "):
+                    sentences.append(line[len("# text = "):].rstrip("\n"))
+
+    for _dir in leaf_dirs(rootdir_orig()):
+        if _dir.split(os.sep)[-1].lower() != language.lower():
+            continue
+        for file_name in ("train.tsv", "dev.tsv", "test.tsv"):
+            morph_path = os.path.join(_dir, file_name)
+            if os.path.isfile(morph_path):
+                with open(morph_path, "r", encoding="utf-8") as morph_file:
+                    sentences.extend(line.split("\t")[0].strip() for line in morph_file)
+    return sentences
+
+
+def timed(function, sentences):
+    start = time.perf_counter()
+    results = [function(s) for s in sentences]
+    return time.perf_counter() - start, results
+
+
+def main():
+    parser = ArgumentParser(description="Micro-benchmark of the sentence normalization ('clean_string') on a UD treebank.")
+    parser.add_argument("--language", type=str, default="English")
+    args = parser.parse_args()
+
+    sentences = collect_sentences(args.language)
+    ascii_count = sum(1 for s in sentences if s.isascii())
+    print(f"{len(sentences)} sentences ({len(set(sentences))} unique, {ascii_count} pure ASCII) for {args.language}")
+
+    reference_time, reference_results = timed(reference_clean_string, sentences)
+    clean_time, clean_results = timed(clean_string, sentences)
+
+    if not reference_results == clean_results:
+        raise Exception("The normalized sentences differ from the reference implementation.")
+
+    print(f"reference:     {reference_time:.3f}s")
+    print(f"clean_string:  {clean_time:.3f}s ({reference_time/clean_time:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
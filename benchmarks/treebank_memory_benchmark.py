@@ -0,0 +1,65 @@
+from argparse import ArgumentParser
+
+import gc
+import subprocess
+import sys
+# The benchmark is run from the root of the repository, like main.py
+sys.path.insert(0, 'src')
+
+from datagen import iter_ud_sentences, extract_UD_sentences_from_all_files
+from utils import conllu_file_path_loader, conllu_file_size
+
+
+def current_rss_mb():
+    # Resident set size of the current process (Linux only).
+    with open("/proc/self/status", "r") as status_file:
+        for line in status_file:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def load_dict(file_paths):
+    # The previous representation: {key: [token_sentence, orig_sentence, data_lists]}
+    sentence_data_dict = {}
+    for cur_path in file_paths:
+        with open(cur_path, "r", encoding="utf-8") as conllu_file:
+            for raw_sentence, sentence_data in iter_ud_sentences(conllu_file):
+                sentence_data_dict[raw_sentence] = sentence_data
+    return sentence_data_dict
+
+
+def measure(mode, language):
+    file_paths = [p for p in conllu_file_path_loader(language) if p.endswith(".conllu")]
+    gc.collect()
+    rss_before = current_rss_mb()
+    if mode == "dict":
+        ud_data = load_dict(file_paths)
+    else:
+        ud_data = extract_UD_sentences_from_all_files(file_paths)
+    gc.collect()
+    file_mb = sum(map(conllu_file_size, file_paths)) / 2**20
+    print(f"{mode}\t{len(ud_data)}\t{current_rss_mb()-rss_before:.1f}\t{file_mb:.1f}")
+
+
+def main():
+    parser = ArgumentParser(description="Compare the RSS of the dict-of-lists and the columnar UD sentence representation. "
+                                        "The RSS per MB of .conllu files of the columnar one is the ratio of 'UD_MEMORY_PER_BYTE'.")
+    parser.add_argument("--language", type=str, default="English")
+    parser.add_argument("--mode", type=str, choices=["dict", "columnar"], help="Measure a single representation (used internally).")
+    args = parser.parse_args()
+
+    if args.mode:
+        measure(args.mode, args.language)
+        return
+
+    # Every representation is measured in a fresh process, so that they do not share freed memory.
+    for mode in ["dict", "columnar"]:
+        output = subprocess.run([sys.executable, __file__, "--language", args.language, "--mode", mode],
+                                capture_output=True, text=True, check=True).stdout
+        mode, sentence_count, rss_mb, file_mb = output.strip().split("\n")[-1].split("\t")
+        print(f"{mode:>10}: {sentence_count} sentences, RSS +{rss_mb} MB, {float(rss_mb)/float(file_mb):.2f} MB per MB of .conllu files")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,30 @@
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 
+import os
 import sys
-# caution: path[0] is reserved for script path (or '' in REPL)
-sys.path.insert(1, 'src')
+# The modules are imported from 'src', which goes before the script path (path[0]),
+# so that the legacy modules in the root of the repository (datagen.py, utils.py, ...) do not shadow them.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
 
 from datagen import download_data, generate_data
 from probehandler import training, inference
-from statistics import get_statistics
+from statistics import get_statistics, get_relation_statistics
+from perturbation import RANDOM_MODES
+from utils import DATASET_FORMATS, DATASET_LAYOUTS
+
+def non_negative_int(value):
+    # The seeds of the random generators can not be negative (see 'task_rng').
+    number = int(value)
+    if number < 0:
+        raise ArgumentTypeError(f"invalid non-negative integer: '{value}'")
+    return number
+
+def positive_int(value):
+    # At least one of something (e.g. random datasets).
+    number = int(value)
+    if number < 1:
+        raise ArgumentTypeError(f"invalid positive integer: '{value}'")
+    return number
 
 def parse_arguments():
     # Declaration of the argument parser
@@ -15,12 +33,33 @@ def parse_arguments():
     subparsers = parser.add_subparsers(dest='command', help="Commands to access different functions in the probing wrapper project.")
 
     # Subparser for downloading the data
-    subparsers.add_parser("download", help="Download the data needed for the dataset expansion.")
+    download_parser = subparsers.add_parser("download", help="Download the data needed for the dataset expansion.")
+    download_parser.add_argument("--extract", action="store_true", help="Extract the UD treebank archive (by default the .conllu files are read from the archive).")
+    download_parser.add_argument("--ud_url", type=str, help="Base url of the UD treebank archive. Default: the LINDAT repository.")
+    download_parser.add_argument("--sha256", type=str, help="Expected SHA-256 checksum of the UD treebank archive, verified before extraction.")
+    download_parser.add_argument("--tags", type=str, default="All,All", help="Check out only the morphology probes of these tags (sparse checkout). Default: All,All")
+    download_parser.add_argument("--git_url", type=str, help="Base url of the git repositories. Default: https://github.com/juditacs/")
 
     # Subparser for generating the extended data
     gen_parser = subparsers.add_parser("generate", help="Generate the extended datasets.")
     gen_parser.add_argument("--tags", type=str, default="All,All")
     gen_parser.add_argument("--random", action="store_true")
+    gen_parser.add_argument("--clear_cache", action="store_true", help="Delete the cached parsed UD treebank data before generating.")
+    gen_parser.add_argument("--workers", type=int, default=1, help="Number of worker processes used for the generation. Default: 1")
+    gen_parser.add_argument("--lazy", action="store_true", help="Index the UD treebank files by byte offsets and parse only the matching sentences.")
+    gen_parser.add_argument("--random_mode", type=str, default="uniform", choices=RANDOM_MODES, help="Sampling of the random indices: any token (uniform) or matching the deptree node distances (distance). Default: uniform")
+    gen_parser.add_argument("--random_samples", type=positive_int, default=1, help="Number of random datasets, the extra ones are written to datasets/random_<i>. Default: 1")
+    gen_parser.add_argument("--seed", type=non_negative_int, help="Seed of the random indices, a non-negative integer.")
+    gen_parser.add_argument("--hash_keys", action="store_true", help="Join the UD and morphology probe sentences on 64-bit hashes instead of the full simplified sentences (less memory).")
+    gen_parser.add_argument("--parse_workers", type=int, default=1, help="Number of processes parsing the chunks of the UD treebank files (large files are split at sentence boundaries). Default: 1")
+    gen_parser.add_argument("--max_memory", type=int, help="Memory budget of the parsed UD data of a language in MB: the treebanks estimated to be larger (from the size of their .conllu files) are spilled to an on-disk SQLite store. An estimate, the memory use is not limited.")
+    gen_parser.add_argument("--force", action="store_true", help="Regenerate all datasets, also the ones whose inputs did not change since the last run.")
+    gen_parser.add_argument("--format", type=str, default="tsv", choices=list(DATASET_FORMATS), help="Format of the generated datasets: tsv, gzip or zstd compressed tsv, or parquet. Default: tsv")
+    gen_parser.add_argument("--layout", type=str, default="rows", choices=list(DATASET_LAYOUTS), help="Layout of the generated datasets: one row per line, or normalized (the sentences are written once per split, in a separate table). Default: rows")
+    gen_parser.add_argument("--fuzzy", action="store_true", help="Match the morphology probe sentences without an exact match in the UD data to the most similar UD sentence (character n-gram MinHash/LSH), the match rate gains are reported.")
+    gen_parser.add_argument("--variants", type=str, help="Comma separated dataset variants written in one pass, e.g. extended,random,masked. Default: extended (random with --random)")
+    gen_parser.add_argument("--mask_sets", type=str, help="Comma separated deptree masking sets of the masked variant: target, all, relations (one set per relation label), hop<k> (e.g. hop2). Default: target,all,relations")
+    gen_parser.add_argument("--mask_relations", type=str, help="Comma separated relation labels of the 'relations' mask set, e.g. nsubj,obj. Default: all labels")
 
     # Subparser for generating the extended data
     probe_parser = subparsers.add_parser("probe", help="Wrapper function for the probing.")
@@ -29,12 +68,16 @@ def parse_arguments():
     probe_action_group.add_argument("--infer_test", action='store_true', help="Inference on trained models (statistics file is generated automatically).")
     probe_action_group.add_argument("--infer_posthoc", action='store_true', help="Make inference using a file called 'posthoc.tsv' instead of 'test.tsv'.")
     probe_parser.add_argument("--tags", type=str, default="all,all", help="Tags indicating the input used datasets. Not mandatory, default: all,all. Format: <Language,morphtag_postag>* [muliple tags allowed, separated by '|'] eg. English,number_noun")
-    probe_parser.add_argument("--data_type", type=str, default="original", help="Select input data type from: {original, random, extended}")
+    probe_parser.add_argument("--data_type", type=str, default="original", help="Select input data type from: {original, random, extended, masked/<mask set>, view:<spec>}, e.g. view:hops=2,relations=nsubj+obj (perturbations applied at read time to the extended data)")
     
     probe_parser.add_argument("--config_path", type=str, help="Set which configuration path should used at model training: {local, default}")
+    probe_parser.add_argument("--workers", type=int, default=1, help="Number of probes trained in parallel, the output of every training is written to logs/training. Default: 1")
+    probe_parser.add_argument("--plan", action="store_true", help="With --train: print the order of the training jobs (longest first, estimated from the data size and the earlier runtimes) and the predicted makespan, without training.")
 
     # Subparser for the statistics retrieval action
     stats_parser = subparsers.add_parser("stats", help="Generate a statistics file from the model trainings (which models are saved in /home/workdir/...)")
+    stats_parser.add_argument("report", nargs="?", default="training", choices=["training", "relations"], help="training: statistics of the model trainings (default); relations: KL/JS divergence of the deptree relation distributions of the datasets and UD, with node distance histograms.")
+    stats_parser.add_argument("--tags", type=str, default="All,All", help="Datasets of the relation statistics. Default: All,All")
 
     return parser.parse_args()
 
@@ -42,32 +85,70 @@ def parse_arguments():
 Parser arguemnts:
 help
 download
+    --extract? [bool, false if not provided]
+    --ud_url? [default: the LINDAT repository]
+    --sha256? [checksum of the UD treebank archive]
+    --tags? [default: All,All]
+    --git_url? [default: https://github.com/juditacs/]
 generate
     --tags? [default: All,All]
     --random? [bool, false if not provided]
+    --clear_cache? [bool, false if not provided]
+    --workers? [default: 1]
+    --lazy? [bool, false if not provided]
+    --random_mode? [default: uniform]
+    --random_samples? [positive int, default: 1]
+    --seed? [non-negative int, not reproducible if not provided]
+    --hash_keys? [bool, false if not provided]
+    --parse_workers? [default: 1]
+    --max_memory? [MB, estimated from the UD file sizes; no spilling if not provided]
+    --force? [bool, false if not provided]
+    --format? [tsv, gzip, zstd or parquet; default: tsv]
+    --layout? [rows or normalized; default: rows]
+    --fuzzy? [bool, false if not provided]
+    --variants? [eg. extended,random,masked; default: extended, or random if --random is provided]
+    --mask_sets? [eg. target,all,relations,hop2; default: target,all,relations]
+    --mask_relations? [eg. nsubj,obj; default: all relation labels]
 probe
     --train / --infer_test /  --infer_posthoc
     --tags? [default: All,All]
+    --data_type? [original, random, extended, masked/<mask set> or view:<spec>; default: original]
+    --workers? [train only, default: 1]
+    --plan? [train only, bool, false if not provided]
     --random? [bool, false if not provided]
 stats
+    training / relations? [default: training]
+    --tags? [relations only, default: All,All]
 """
 
 def main():
     parser = parse_arguments()
     if parser.command == "download":
-        download_data()
+        download_data(parser.extract, parser.ud_url, parser.sha256, parser.tags, parser.git_url)
     elif parser.command == "generate":
-        generate_data(parser.tags, parser.random)
+        generate_data(parser.tags, random=parser.random, clear_cache=parser.clear_cache, workers=parser.workers,
+                      lazy=parser.lazy, random_mode=parser.random_mode, random_samples=parser.random_samples,
+                      seed=parser.seed, variants=parser.variants.split(",") if parser.variants else None,
+                      hash_keys=parser.hash_keys, parse_workers=parser.parse_workers, max_memory=parser.max_memory,
+                      force=parser.force, output_format=parser.format, layout=parser.layout, fuzzy=parser.fuzzy,
+                      mask_sets=parser.mask_sets.split(",") if parser.mask_sets else None,
+                      mask_relations=parser.mask_relations.split(",") if parser.mask_relations else None)
     elif parser.command == "probe":
         if parser.train:
-            training(parser.tags, parser.data_type, parser.config_path)
+            results = training(parser.tags, parser.data_type, parser.config_path, parser.workers, parser.plan)
+            # The failed jobs are listed by 'training', the exit code tells the caller.
+            if any(returncode != 0 for _, returncode in results):
+                sys.exit(1)
         elif parser.infer_test:
             inference(parser.tags, parser.data_type, parser.config_path)
         elif parser.infer_posthoc:
             inference(parser.tags, parser.data_type, parser.config_path, True)
     elif parser.command == "stats":
         #get_statistics(parser.infer)
-        get_statistics()
+        if parser.report == "relations":
+            get_relation_statistics(parser.tags)
+        else:
+            get_statistics()
 
 if __name__ == '__main__':
     main()
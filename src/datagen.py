@@ -1,15 +1,33 @@
+import ast
 import csv
 import requests
 import zipfile
 import os
 import tarfile
 import re
+import pickle
+import hashlib
+import shutil
+import io
+import traceback
+import contextlib
+import collections
+import mmap
+import json
+import sqlite3
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
 
 from argparse import ArgumentParser
 from unidecode import unidecode
-from random import randrange
 from git import Repo
 from utils import *
+from treebank import SentenceKeyIndex, UDTreebank, MatchedRows
+from perturbation import sample_random_indices, task_rng, mask_indices, validate_mask_sets, MASK_SETS
+from dataset_io import write_dataset, PARQUET_INT_COLUMNS, MASKED_PARQUET_INT_COLUMNS
+from relation_stats import RelationCounts, save_dataset_relation_counts
+from fuzzy_match import MinHashIndex
 
 
 
@@ -28,7 +46,7 @@ def process_ud_sentence(sentence_data):
     7	szünet	szünet	NOUN	_	Case=Nom|Number=Sing	4	nsubj	_	SpaceAfter=No
     8	.	.	PUNCT	_	_	4	punct	_	_
     Args:
-        lines (list of strings): The lines of the sentence data. See example above.
+        sentence_data (string or list of strings): The lines of the sentence data. See example above.
 
     Returns:
         pair:
@@ -36,7 +54,10 @@ def process_ud_sentence(sentence_data):
             -sentence data [word, w. index, morph. tag(s), parent word (in dependency tree), parent word, p. word index, relationship in the tree]
     """
     #lines = list(filter(None, list(sentence_data.split("\n"))))
-    lines = list(sentence_data.split("\n"))
+    if isinstance(sentence_data, str):
+        lines = list(sentence_data.split("\n"))
+    else:
+        lines = sentence_data
 
     comment_lines = [l for l in lines if l[0] == "#"]
     data_lines = [l for l in lines if not l[0] == "#"]
@@ -78,12 +99,14 @@ def process_ud_sentence(sentence_data):
     return joined_sentence_tokens, orig_sentnece_text, data_lists
 
 
-def process_morpho_file(file_path):
+def process_morpho_file(file_path, hash_keys=False):
     """
     The format of the data for the morpholoical probes:
         Tolles ( Fisch - ) Restaurant direkt am Luitjensee gelegen .	Tolles	0	Neut
 
     The keys to the dict are the simplifed sentences, the values are the data from the rows in a list
+    With 'hash_keys' the keys are the hashes of the simplified sentences (see 'sentence_key_hash'),
+    a sentence whose hash collides with a different sentence is kept under its simplified form.
     """
     sentence_dict = {}
 
@@ -91,19 +114,76 @@ def process_morpho_file(file_path):
         for line in sentence_data_file:
             sentence_data = [s.strip() for s in line.split("\t")]
             raw_sentence = clean_string(sentence_data[0])
-            sentence_dict[raw_sentence] = sentence_data
+            if hash_keys:
+                key = sentence_key_hash(raw_sentence)
+                if key in sentence_dict and not clean_string(sentence_dict[key][0]) == raw_sentence:
+                    key = raw_sentence
+                sentence_dict[key] = sentence_data
+            else:
+                sentence_dict[raw_sentence] = sentence_data
 
     return sentence_dict
 
 
 
-def extract_UD_sentences_from_all_files(file_paths):
+def read_conllu_blocks(lines):
+    """
+    Group the lines of a CoNLL-U stream into sentence blocks, one block at a time.
+    Only the lines of the current sentence are kept in memory, so the memory usage
+    does not depend on the size of the file.
+
+    Args:
+        lines (iterable of strings): The lines of a CoNLL-U file (e.g. an open file object).
+
+    Yields:
+        list of strings: the lines of one sentence (comments and token lines), without the line endings.
+    """
+    block = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line:
+            block.append(line)
+        elif block:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def iter_ud_sentences(conllu_file):
+    """
+    Parse the sentences of a CoNLL-U stream lazily (see 'process_ud_sentence').
+
+    Args:
+        conllu_file (iterable of strings): The lines of a CoNLL-U file (e.g. an open file object).
+
+    Yields:
+        pair:
+            -the character-simplified sentence (see the 'clean_string' function)
+            -[token_sentence, orig_sentence, data_lists]
+    """
+    for sentence_lines in read_conllu_blocks(conllu_file):
+        try:
+            # joined_sentence_tokens, orig_sentnece_text, data_lists
+            token_sentnece, orig_sentnece, data_lists = process_ud_sentence(sentence_lines)
+            raw_sentence = clean_string(orig_sentnece)
+            #toekn_sentnece ~ sentence rejoined from the conllu tokens
+            yield raw_sentence, [token_sentnece, orig_sentnece, data_lists]
+        except Exception as e:
+            print("\n".join(sentence_lines))    # the exception type
+            print(e.args)     # arguments stored in .args
+            print(e)          # __str__ allows args to be printed directly,
+
+
+def extract_UD_sentences_from_all_files(file_paths, hash_keys=False, workers=1):
     """
     Args:
         file_paths (list of strings): the paths to the .conllu files containing the data
+        hash_keys (bool): key the sentences by the hash of the simplified sentences (see 'SentenceKeyIndex')
+        workers (int): parse the files in chunks in a process pool (see 'extract_UD_sentences_parallel')
     Returns:
-        dict:   containing the inforamtion for the processed data.
-                The dict key is the given character-simplified sentence (see the 'clean_string' function).
+        UDTreebank: containing the inforamtion for the processed data in a columnar format.
+                    The sentences are looked up by the given character-simplified sentence (see the 'clean_string' function).
 
     This function reads all the files and processes the sentences in them.
     The processed data is saved in files in the same folder structure as they are read from,
@@ -120,34 +200,416 @@ def extract_UD_sentences_from_all_files(file_paths):
         5	folyik	folyik	VERB	_	Definite=Ind|Mood=Ind|Number=Sing|Person=3|Tense=Pres|VerbForm=Fin|Voice=Act	0	root	_	SpaceAfter=No
         6	.	.	PUNCT	_	_	5	punct	_	_
     """
-    sentence_data_dict = {}
+    if workers > 1:
+        return extract_UD_sentences_parallel(file_paths, hash_keys, workers)
+
+    ud_treebank = UDTreebank(hash_keys)
+    #if not os.path.isfile(cur_path):
+    #    print(f"UD treebank data file not found at: {cur_path}")
+    #print(f"    Collecting sentence data from UD treebank dataset at: {cur_path}")
+    for cur_path, conllu_file in iter_conllu_files(file_paths):
+        for raw_sentence, sentence_data in iter_ud_sentences(conllu_file):
+            ud_treebank.add_sentence(raw_sentence, *sentence_data)
+
+    return ud_treebank.freeze()
+
+
+# Target size of the byte ranges the .conllu files are split into for the parallel parsing.
+PARSE_CHUNK_SIZE = 32 * 1024 * 1024
+
+
+def conllu_chunk_ranges(file_path, chunk_size=PARSE_CHUNK_SIZE):
+    """
+    Split a .conllu file into byte ranges of about 'chunk_size' bytes. Every range ends after a blank line,
+    so no sentence is cut in two.
+
+    Returns:
+        list of pairs: (start, end) byte offsets, covering the whole file.
+    """
+    file_size = os.path.getsize(file_path)
+    ranges = []
+    start = 0
+    with open(file_path, "rb") as conllu_file:
+        while start < file_size:
+            end = start + chunk_size
+            if end >= file_size:
+                end = file_size
+            else:
+                conllu_file.seek(end)
+                # The rest of the line the range would end in.
+                conllu_file.readline()
+                while True:
+                    line = conllu_file.readline()
+                    if not line:
+                        end = file_size
+                        break
+                    if not line.strip():
+                        end = conllu_file.tell()
+                        break
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def parse_conllu_chunk(file_path, start=None, end=None):
+    """
+    Parse the sentences of a byte range of a .conllu file (the whole file, or archive member, without a range).
+
+    Returns:
+        pair: the keys of the parsed sentences in order, and the UDTreebank of the sentences (not indexed).
+    """
+    ud_treebank = UDTreebank()
+    keys = []
+    if start is None:
+        chunks = (conllu_file for _, conllu_file in iter_conllu_files([file_path]))
+    else:
+        with open(file_path, "rb") as conllu_file:
+            conllu_file.seek(start)
+            chunks = [conllu_file.read(end-start).decode("utf-8").split("\n")]
+    for lines in chunks:
+        for raw_sentence, sentence_data in iter_ud_sentences(lines):
+            ud_treebank.add_sentence(None, *sentence_data)
+            keys.append(raw_sentence)
+    return keys, ud_treebank.freeze()
+
+
+def _parse_conllu_chunk_job(chunk):
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        keys, ud_treebank = parse_conllu_chunk(*chunk)
+    return log.getvalue(), keys, ud_treebank
+
+
+def extract_UD_sentences_parallel(file_paths, hash_keys=False, workers=2, chunk_size=PARSE_CHUNK_SIZE):
+    """
+    Parse the .conllu files in a process pool (see 'extract_UD_sentences_from_all_files').
+    The regular files are split into byte ranges at sentence boundaries (see 'conllu_chunk_ranges'),
+    so that a single large file is parsed on several cores too; the archive members are parsed as a whole.
+    The chunks are merged in the order of the files and ranges, which gives the same treebank
+    (the same sentence order, vocabulary ids and duplicate key resolution) as the sequential parsing.
+    """
+    chunks = []
     for cur_path in file_paths:
-        #if not os.path.isfile(cur_path):
-        #    print(f"UD treebank data file not found at: {cur_path}")
-        #print(f"    Collecting sentence data from UD treebank dataset at: {cur_path}")
-        #with open(cur_path, "r", encoding="unicode_escape") as conllu_file:
-        with open(cur_path, "r") as conllu_file:
-            content = conllu_file.read()
-            senence_data_paragraphs = list(filter(None, content.split("\n\n")))
-
-            for sentence_paragrpah in senence_data_paragraphs:
-                """
-                sentence, data_lists = process_ud_sentence(sentence_paragrpah)
-                raw_sentence = clean_string(sentence)
-                sentence_data_dict[raw_sentence] = [sentence, data_lists]
-                """
-                try:
-                    # joined_sentence_tokens, orig_sentnece_text, data_lists
-                    token_sentnece, orig_sentnece, data_lists = process_ud_sentence(sentence_paragrpah)
-                    raw_sentence = clean_string(orig_sentnece)
-                    #toekn_sentnece ~ sentence rejoined from the conllu tokens
-                    sentence_data_dict[raw_sentence] = [token_sentnece, orig_sentnece, data_lists]
-                except Exception as e:
-                    print(sentence_paragrpah)    # the exception type
-                    print(e.args)     # arguments stored in .args
-                    print(e)          # __str__ allows args to be printed directly,
-
-    return sentence_data_dict
+        if split_archive_member_path(cur_path)[0] is None:
+            chunks.extend((cur_path, start, end) for start, end in conllu_chunk_ranges(cur_path, chunk_size))
+        else:
+            chunks.append((cur_path, None, None))
+    print(f"Parsing {len(file_paths)} UD file(s) in {len(chunks)} chunk(s) with {workers} workers.")
+
+    ud_treebank = UDTreebank(hash_keys)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for log, keys, chunk_treebank in executor.map(_parse_conllu_chunk_job, chunks):
+            print(log, end="")
+            ud_treebank.merge(chunk_treebank, keys)
+    return ud_treebank.freeze()
+
+
+class ConlluIndex(SentenceKeyIndex):
+    """
+    Byte-offset index over CoNLL-U files, an alternative of the fully parsed UDTreebank.
+    It maps the character-simplified sentences (see 'SentenceKeyIndex') to (file id, byte offset, length),
+    the sentences are parsed on demand only, when they are selected (see 'select').
+
+    Args:
+        file_paths (list of strings): the paths to the .conllu files containing the data
+        hash_keys (bool): key the sentences by the hash of the simplified sentences
+    """
+    def __init__(self, file_paths, hash_keys=False):
+        self.file_paths = list(file_paths)
+        self.init_index(hash_keys)
+        for file_id in range(len(self.file_paths)):
+            self.index_file(file_id)
+
+    def read_sentence(self, location):
+        file_id, offset, length = location
+        with open(self.file_paths[file_id], "rb") as conllu_file:
+            conllu_file.seek(offset)
+            return conllu_file.read(length).decode("utf-8")
+
+    def raw_sentence_of(self, location):
+        for line in self.read_sentence(location).split("\n"):
+            if line.startswith("# text ="):
+                return clean_string(line.rstrip("\r").split("# text = ")[1])
+        return None
+
+    def index_file(self, file_id):
+        # Only the '# text =' lines are decoded, the sentences are not parsed.
+        with open(self.file_paths[file_id], "rb") as conllu_file:
+            offset = 0
+            block_start = None
+            raw_sentence = None
+            for line in conllu_file:
+                if line.rstrip(b"\r\n"):
+                    if block_start is None:
+                        block_start = offset
+                        raw_sentence = None
+                    if raw_sentence is None and line.startswith(b"# text ="):
+                        text_parts = line.decode("utf-8").rstrip("\r\n").split("# text = ")
+                        if len(text_parts) > 1:
+                            raw_sentence = clean_string(text_parts[1])
+                elif block_start is not None:
+                    self.add_sentence(raw_sentence, file_id, block_start, offset-block_start)
+                    block_start = None
+                offset += len(line)
+            if block_start is not None:
+                self.add_sentence(raw_sentence, file_id, block_start, offset-block_start)
+
+    def raw_sentences(self):
+        if not self.hash_keys:
+            return list(self.index)
+        # Only the hashes are kept, the '# text =' lines are read again (instead of seeking to every sentence).
+        raw_sentences = []
+        for cur_path in self.file_paths:
+            with open(cur_path, "r", encoding="utf-8") as conllu_file:
+                for line in conllu_file:
+                    if line.startswith("# text ="):
+                        text_parts = line.rstrip("\r\n").split("# text = ")
+                        if len(text_parts) > 1:
+                            raw_sentences.append(clean_string(text_parts[1]))
+        return raw_sentences
+
+    def add_sentence(self, raw_sentence, file_id, offset, length):
+        # Sentences without text can not be matched (and are not parsed by 'process_ud_sentence' either).
+        if raw_sentence is not None:
+            self.set_key(raw_sentence, (file_id, offset, length))
+
+    def select(self, keys):
+        """
+        Parse the indexed sentences with the given keys, reading them through mmap.
+
+        Args:
+            keys (iterable): character-simplified sentences (or their hashes), the ones not in the index are skipped.
+        Returns:
+            UDTreebank: containing only the selected sentences.
+        """
+        locations = set()
+        for key in keys:
+            key = self.index_key(key)
+            if key in self.index:
+                locations.add(self.index[key])
+                # The full-string check is done by the returned treebank.
+                locations.update(self.collisions.get(key, {}).values())
+        ud_treebank = UDTreebank(self.hash_keys)
+        mapped_files = {}
+        try:
+            for file_id, offset, length in sorted(locations):
+                if file_id not in mapped_files:
+                    with open(self.file_paths[file_id], "rb") as conllu_file:
+                        mapped_files[file_id] = mmap.mmap(conllu_file.fileno(), 0, access=mmap.ACCESS_READ)
+                sentence_text = mapped_files[file_id][offset:offset+length].decode("utf-8")
+                for raw_sentence, sentence_data in iter_ud_sentences(sentence_text.split("\n")):
+                    ud_treebank.add_sentence(raw_sentence, *sentence_data)
+        finally:
+            for mapped_file in mapped_files.values():
+                mapped_file.close()
+        return ud_treebank.freeze()
+
+
+# Number of keys queried at once from the SQLite store (the number of query parameters is limited).
+SQLITE_BATCH_SIZE = 500
+
+
+def sqlite_hash(key):
+    # The 64-bit key hashes as signed integers, as stored by SQLite.
+    return key - (1 << 64) if key >= (1 << 63) else key
+
+
+class SpilledTreebank:
+    """
+    The parsed UD sentences of a language spilled to an on-disk SQLite store, used instead of the
+    in-memory UDTreebank when it would not fit the memory budget (see 'load_ud_data').
+    Like in the case of 'ConlluIndex', only the selected sentences are loaded into memory (see 'select').
+    Only the path of the store is pickled, so it can be passed to the worker processes.
+
+    Args:
+        db_path (str): the path of the SQLite store (see 'build').
+        hash_keys (bool): the sentences are selected by the hash of the simplified sentences (see 'SentenceKeyIndex')
+    """
+    def __init__(self, db_path, hash_keys=False):
+        self.db_path = db_path
+        self.hash_keys = hash_keys
+
+    @classmethod
+    def build(cls, db_path, file_paths, hash_keys=False):
+        """
+        Parse the .conllu files into a new store, streaming the sentences (see 'iter_ud_sentences'),
+        so that only one sentence is kept in memory at a time. If the same key occurs more than once,
+        the last sentence wins.
+        """
+        def sentence_rows():
+            for _, conllu_file in iter_conllu_files(file_paths):
+                for raw_sentence, sentence_data in iter_ud_sentences(conllu_file):
+                    key_hash = sqlite_hash(sentence_key_hash(raw_sentence)) if hash_keys else None
+                    yield raw_sentence, key_hash, pickle.dumps(sentence_data, protocol=pickle.HIGHEST_PROTOCOL)
+
+        create_dir_if_needed(os.path.dirname(db_path))
+        with atomic_write(db_path) as tmp_path:
+            # A temporary file left by a killed process with the same pid.
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            connection = sqlite3.connect(tmp_path)
+            try:
+                connection.execute("CREATE TABLE sentences (key TEXT PRIMARY KEY, hash INTEGER, data BLOB)")
+                connection.executemany("INSERT OR REPLACE INTO sentences (key, hash, data) VALUES (?, ?, ?)", sentence_rows())
+                if hash_keys:
+                    connection.execute("CREATE INDEX sentences_hash ON sentences (hash)")
+                connection.commit()
+            finally:
+                connection.close()
+        return cls(db_path, hash_keys)
+
+    def __len__(self):
+        with contextlib.closing(sqlite3.connect(self.db_path)) as connection:
+            return connection.execute("SELECT COUNT(*) FROM sentences").fetchone()[0]
+
+    def raw_sentences(self):
+        with contextlib.closing(sqlite3.connect(self.db_path)) as connection:
+            return [raw_sentence for (raw_sentence,) in connection.execute("SELECT key FROM sentences")]
+
+    def select(self, keys):
+        """
+        Load the sentences with the given keys from the store.
+
+        Args:
+            keys (iterable): character-simplified sentences (or their hashes), the ones not in the store are skipped.
+        Returns:
+            UDTreebank: containing only the selected sentences.
+        """
+        hashes = []
+        raw_sentences = []
+        for key in keys:
+            if isinstance(key, str):
+                raw_sentences.append(key)
+            else:
+                hashes.append(sqlite_hash(key))
+
+        rows = {}
+        with contextlib.closing(sqlite3.connect(self.db_path)) as connection:
+            # All sentences with the same hash are loaded, the full-string check is done by the returned treebank.
+            for column, values in (("key", raw_sentences), ("hash", hashes)):
+                for batch_start in range(0, len(values), SQLITE_BATCH_SIZE):
+                    batch = values[batch_start:batch_start+SQLITE_BATCH_SIZE]
+                    query = f"SELECT rowid, key, data FROM sentences WHERE {column} IN ({','.join('?'*len(batch))})"
+                    for rowid, raw_sentence, data in connection.execute(query, batch):
+                        rows[rowid] = (raw_sentence, data)
+
+        ud_treebank = UDTreebank(self.hash_keys)
+        for rowid in sorted(rows):
+            raw_sentence, data = rows[rowid]
+            ud_treebank.add_sentence(raw_sentence, *pickle.loads(data))
+        return ud_treebank.freeze()
+
+
+# Estimated memory of the parsed UD data per byte of the .conllu files (see 'load_ud_data'). Measured with
+# 'benchmarks/treebank_memory_benchmark.py': the columnar treebank of 225 MB of .conllu files (200k sentences)
+# took 1.02 MB of RSS per MB of files. It depends on the treebank (e.g. the length of the MISC column),
+# so the memory budget is an estimate, the memory use is not limited.
+UD_MEMORY_PER_BYTE = 1.0
+
+
+def estimated_ud_memory(file_paths):
+    # Estimated memory of the parsed UD data in MB.
+    return sum(map(conllu_file_size, file_paths)) * UD_MEMORY_PER_BYTE / 2**20
+
+
+# Increase when the format of the parsed UD data changes, so that old caches are rebuilt.
+UD_CACHE_VERSION = 3
+
+
+def ud_cache_key(file_paths):
+    """
+    Fingerprint of the UD treebank files of a language: their paths, sizes and modification times.
+    """
+    fingerprint = hashlib.sha256(f"v{UD_CACHE_VERSION}".encode())
+    for cur_path in sorted(file_paths):
+        fingerprint.update(f"\n{cur_path}\t{file_signature(cur_path)}".encode())
+    return fingerprint.hexdigest()
+
+
+def ud_cache_path(language, lazy=False, hash_keys=False, spill=False):
+    file_name = language.lower()
+    if lazy:
+        file_name += ".index"
+    if spill:
+        file_name += ".spill"
+    if hash_keys:
+        file_name += ".hashed"
+    return os.path.join(ud_cache_dir(), file_name+".pickle")
+
+
+def read_ud_cache(cache_path, cache_key):
+    # Return the cached data if the cache file exists and it was built from the same files, None otherwise.
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path, "rb") as cache_file:
+                cached_key, cached_data = pickle.load(cache_file)
+            if cached_key == cache_key:
+                return cached_data
+        except (pickle.UnpicklingError, EOFError, ValueError) as err:
+            print(f"Invalid UD cache file ({err}), rebuilding: {cache_path}")
+    return None
+
+
+def write_ud_cache(cache_path, cache_key, data):
+    create_dir_if_needed(ud_cache_dir())
+    with atomic_write(cache_path) as tmp_path:
+        with open(tmp_path, "wb") as cache_file:
+            pickle.dump((cache_key, data), cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_ud_data(language, lazy=False, hash_keys=False, parse_workers=1, max_memory=None):
+    """
+    Load the parsed UD data of a language (see 'extract_UD_sentences_from_all_files').
+    The parsed data is cached on disk and reused as long as the source .conllu files are unchanged.
+
+    Args:
+        language (str): The language name, as in the morphology probes (e.g. 'English').
+        lazy (bool): Load only a byte-offset index of the sentences (see 'ConlluIndex'),
+                     the sentences are parsed on demand, when they are matched.
+        hash_keys (bool): Key the sentences by the hash of the simplified sentences (see 'SentenceKeyIndex').
+        parse_workers (int): Parse the .conllu files in chunks in a process pool (see 'extract_UD_sentences_parallel').
+        max_memory (int): Memory budget of the parsed UD data in MB. If the parsed data is estimated to be larger
+                          (from the size of the files, see 'UD_MEMORY_PER_BYTE'), the sentences are spilled
+                          to an on-disk store (see 'SpilledTreebank'). The memory use is not measured or limited.
+    Returns:
+        UDTreebank, ConlluIndex or SpilledTreebank: The parsed UD sentence data.
+    """
+    ud_data_paths = list(conllu_file_path_loader(language))
+    if lazy and any(split_archive_member_path(p)[0] for p in ud_data_paths):
+        print("The byte-offset index needs the extracted UD treebank files, parsing all sentences from the archive.")
+        lazy = False
+    spill = False
+    if not lazy and max_memory is not None:
+        estimated_memory = estimated_ud_memory(ud_data_paths)
+        if estimated_memory > max_memory:
+            print(f"The UD data of {language} (~{estimated_memory:.0f} MB) exceeds the memory budget ({max_memory} MB), spilling it to disk.")
+            spill = True
+    cache_key = ud_cache_key(ud_data_paths)
+    cache_path = ud_cache_path(language, lazy, hash_keys, spill)
+
+    ud_treebank = read_ud_cache(cache_path, cache_key)
+    if ud_treebank is not None:
+        print(f"Loaded cached UD data for {language} from: {cache_path}")
+        return ud_treebank
+
+    if lazy:
+        ud_treebank = ConlluIndex(ud_data_paths, hash_keys)
+    elif spill:
+        # The store is written next to the cache file, which only refers to it.
+        ud_treebank = SpilledTreebank.build(os.path.splitext(cache_path)[0]+".sqlite", ud_data_paths, hash_keys)
+    else:
+        ud_treebank = extract_UD_sentences_from_all_files(ud_data_paths, hash_keys, parse_workers)
+
+    write_ud_cache(cache_path, cache_key, ud_treebank)
+    print(f"Saved UD data cache for {language} to: {cache_path}")
+    return ud_treebank
+
+
+def clear_ud_cache():
+    cache_dir = ud_cache_dir()
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+        print(f"UD data cache cleared: '{cache_dir}'")
 
 
 def get_morph_tag(selected_morph_tag, morph_tags):
@@ -163,31 +625,154 @@ def get_morph_tag(selected_morph_tag, morph_tags):
     return None
 
 
-def process_sentence_data(ud_data_dict: dict, morph_path: str, allowed_tags: set, pos_tag: str, morph_tag: str):
+def fuzzy_sentence_index(ud_treebank):
+    # The MinHash index of all UD sentences, built once per loaded UD data.
+    if getattr(ud_treebank, "_fuzzy_index", None) is None:
+        ud_treebank._fuzzy_index = MinHashIndex(ud_treebank.raw_sentences())
+    return ud_treebank._fuzzy_index
+
+
+def fuzzy_aliases(ud_treebank, morph_data_dicts):
     """
+    Find the UD sentences of the morph. probe sentences without an exact match (see 'MinHashIndex.match').
+    Every UD sentence is claimed at most once, by the first sentence it is the best match of, and never if it is
+    an exact match: pass the data of all splits of a task (the training split first), so that no UD sentence
+    ends up in two splits of the task. The matches of a task never depend on the other tasks it is generated with.
+
     Args:
-        ud_data_dict:
+        morph_data_dicts: the morph. probe data of the splits of a task (see 'process_morpho_file')
+    Returns:
+        dict: {morph. probe key: the character-simplified UD sentence}
+    """
+    raw_sentences = {}
+    for morph_data_dict in morph_data_dicts:
+        for key, sentence_data in morph_data_dict.items():
+            if key not in raw_sentences:
+                raw_sentences[key] = key if isinstance(key, str) else clean_string(sentence_data[0])
+    matches = fuzzy_sentence_index(ud_treebank).match(raw_sentences.values())
+    return {key: matches[raw_sentence] for key, raw_sentence in raw_sentences.items() if raw_sentence in matches}
+
+
+def match_tasks(ud_treebank, morph_data_dicts, allowed_tags_list, pos_tags, morph_tags, fuzzy=False, task_aliases=None):
+    """
+    Match the sentences of several morph/pos tasks (of the same language and split) in a single walk
+    over the matching UD sentences. Every token is routed to all tasks it qualifies for.
+
+    Args:
+        ud_treebank: UDTreebank or ConlluIndex
+        morph_data_dicts: the morph. probe data of each task (see 'process_morpho_file')
+        allowed_tags_list: the allowed tags of each task (the tags that are present in the training data)
+        pos_tags: the PoS tag of each task
+        morph_tags: the morph. tag of each task
+        fuzzy: match the sentences without an exact match to the most similar UD sentence (see 'fuzzy_aliases')
+        task_aliases: the fuzzy matches of each task, resolved over all splits of the task (see 'fuzzy_aliases'),
+                      resolved for the given split only if not given
+    Returns:
+        list of quadruplets, one for each task:
+            collected_sentence_data (MatchedRows)
+            collected_tags
+            match_count: the number of morph. probe sentences found in the UD data
+            fuzzy_count: the number of them matched approximately
+    """
+    # key -> the tasks the sentence belongs to
+    key_tasks = collections.defaultdict(list)
+    for task_id, morph_data_dict in enumerate(morph_data_dicts):
+        for raw_sentence in morph_data_dict:
+            key_tasks[raw_sentence].append(task_id)
+    if not fuzzy:
+        task_aliases = [{} for _ in morph_data_dicts]
+    elif task_aliases is None:
+        task_aliases = [fuzzy_aliases(ud_treebank, [morph_data_dict]) for morph_data_dict in morph_data_dicts]
+    task_aliases = [{key: aliases[key] for key in morph_data_dict if key in aliases}
+                    for morph_data_dict, aliases in zip(morph_data_dicts, task_aliases)]
+    # Parse the matching sentences if only an index of the UD data is loaded (see 'ConlluIndex').
+    ud_treebank = ud_treebank.select(list(key_tasks) + [alias for aliases in task_aliases for alias in aliases.values()])
+
+    # The FEATS strings are parsed only once, the morph. tag value of every FEATS string is looked up once per morph. tag.
+    feature_maps = ud_treebank.feature_maps()
+    morph_feats_tags = {}
+    for morph_tag in morph_tags:
+        if morph_tag.lower() not in morph_feats_tags:
+            morph_feats_tags[morph_tag.lower()] = [feature_map.get(morph_tag.lower()) for feature_map in feature_maps]
+    task_feats_tags = [morph_feats_tags[morph_tag.lower()] for morph_tag in morph_tags]
+    task_pos_tags = [pos_tag.lower() for pos_tag in pos_tags]
+    lower_pos_tags = [found_pos_tag.lower() for found_pos_tag in ud_treebank.pos_tags.items]
+
+    # task -> {key: matching token rows}
+    task_key_rows = [{} for _ in morph_data_dicts]
+    for raw_sentence, task_ids in key_tasks.items():
+        # The simplified sentence is only needed for the full-string check of the hashed keys.
+        sentence_id = ud_treebank.lookup(raw_sentence, lambda: clean_string(morph_data_dicts[task_ids[0]][raw_sentence][0]))
+        if sentence_id is not None:
+            sentence_tasks = [(sentence_id, task_ids)]
+        else:
+            # Without an exact match, every task follows its own fuzzy match.
+            alias_tasks = collections.defaultdict(list)
+            for task_id in task_ids:
+                if raw_sentence in task_aliases[task_id]:
+                    alias_tasks[task_aliases[task_id][raw_sentence]].append(task_id)
+            sentence_tasks = [(ud_treebank.lookup(alias), alias_task_ids) for alias, alias_task_ids in alias_tasks.items()]
+        for sentence_id, sentence_task_ids in sentence_tasks:
+            if sentence_id is None:
+                continue
+            start, end = ud_treebank.token_rows(sentence_id)
+            token_data = zip(range(start, end), ud_treebank.pos[start:end].tolist(), ud_treebank.feats[start:end].tolist())
+            for row_id, pos_id, feats_id in token_data:
+                for task_id in sentence_task_ids:
+                    # Only the relevant pos and morph elements incuded
+                    if not lower_pos_tags[pos_id] == task_pos_tags[task_id]:
+                        continue
+                    result_tag = task_feats_tags[task_id][feats_id]
+                    allowed_tags = allowed_tags_list[task_id]
+                    if not result_tag == None and (not allowed_tags or (result_tag in allowed_tags)):
+                        task_key_rows[task_id].setdefault(raw_sentence, []).append(row_id)
+
+    results = []
+    for task_id, morph_data_dict in enumerate(morph_data_dicts):
+        # The rows are collected in the order of the morph. probe file.
+        key_rows = task_key_rows[task_id]
+        row_ids = [row_id for raw_sentence in morph_data_dict if raw_sentence in key_rows for row_id in key_rows[raw_sentence]]
+        collected_sentence_data = MatchedRows(ud_treebank, row_ids, task_feats_tags[task_id])
+        fuzzy_count = sum(1 for raw_sentence in key_rows if raw_sentence in task_aliases[task_id])
+        results.append((collected_sentence_data, set(collected_sentence_data.tags()), len(key_rows), fuzzy_count))
+    return results
+
+
+def report_match_rate(collected_sentence_data, match_count, sentence_count, morph_path, fuzzy_count=0):
+    match_rate = 0
+    if not collected_sentence_data:
+        print(f"    --No matching sentence found.")
+    else:
+        match_rate = match_count/sentence_count*100
+        print(f"    --Expanded {match_count}/{sentence_count} sentneces (Match rate: {match_rate:.2f}%) from: {morph_path}")
+        if fuzzy_count:
+            exact_rate = (match_count-fuzzy_count)/sentence_count*100
+            print(f"    --Fuzzy matched {fuzzy_count} sentences, match rate gain: +{match_rate-exact_rate:.2f}% (exact: {exact_rate:.2f}%)")
+    return match_rate
+
+
+def process_sentence_data(ud_treebank, morph_path: str, allowed_tags: set, pos_tag: str, morph_tag: str, fuzzy=False):
+    """
+    Args:
+        ud_treebank: UDTreebank or ConlluIndex
         morph_path:
         allowed_tags: the tags that are present in the training data (if they aren't, the model won't recognize them in the test data)
         pos_tag:
         morph_tag:
+        fuzzy: match the sentences approximately too (see 'fuzzy_aliases')
     Returns:
-        collected_sentence_data
+        collected_sentence_data (MatchedRows)
         collected_tags
         match_rate
     """
-    morph_data_dict = process_morpho_file(morph_path)
-
-    match_count = 0 # Counter for the sentences that were found in the UD CoNLL-U dataset
-    collected_sentence_data = []
-    collected_tags = set()
+    morph_data_dict = process_morpho_file(morph_path, ud_treebank.hash_keys)
 
 
     #Uncomment for testing the search of same sentences in the CoNLLU and morphology datasets!
     """
     search_key = "goodafternoonsara"
 
-    ud_conllu_matches  = [(key, value) for key, value in ud_data_dict.items() if search_key in key]
+    ud_conllu_matches  = [(key, [ud_treebank.token_sentences[ud_treebank.lookup(key)]]) for key in ud_treebank.index if search_key in key]
     morphology_matches  = [(key, value) for key, value in morph_data_dict.items() if search_key in key]
     print(ud_conllu_matches)
     print(morphology_matches)
@@ -198,172 +783,498 @@ def process_sentence_data(ud_data_dict: dict, morph_path: str, allowed_tags: set
         print("   ### Morphology data dict")
         mor_str = morphology_matches[0][1][0]
         print(f"<{mor_str}>")
-        print(morphology_matches[0][0] in ud_data_dict)
+        print(morphology_matches[0][0] in ud_treebank)
         print(ud_conllu_matches[0][0] in morph_data_dict)
     """
 
+    [(collected_sentence_data, collected_tags, match_count, fuzzy_count)] = match_tasks(ud_treebank, [morph_data_dict], [allowed_tags],
+                                                                                         [pos_tag], [morph_tag], fuzzy)
+    match_rate = report_match_rate(collected_sentence_data, match_count, len(morph_data_dict), morph_path, fuzzy_count)
+    return collected_sentence_data, collected_tags, match_rate
 
-    for raw_sentence, morph_sentence_data in morph_data_dict.items():
-
-        if raw_sentence in ud_data_dict:
 
-            valid_match = 0 # Add only if was inlcuded in the result data at least once
-            sentence, orig_ud_sentence, ud_sentence_data_lists = ud_data_dict[raw_sentence]
+def write_sentence_data(output_file: str, processed_data, output_format="tsv", layout="rows", int_columns=PARQUET_INT_COLUMNS):
+    # Buffered, atomic writing in the given format and layout (see 'write_dataset'), 'output_file' is the path of the TSV version.
+    # Returns the paths of the written files.
+    return write_dataset(output_file, processed_data, output_format, layout, int_columns)
 
-            for data_list in ud_sentence_data_lists:
-                orig_sentence = morph_sentence_data[0]
-                w_parent, w_parent_idx, found_pos_tag, found_morph_tags, w_child, w_child_idx, rela = data_list
 
-                result_tag = get_morph_tag(morph_tag, found_morph_tags)
-                # Only the relevant pos and morpg elements incuded
-                if  (not result_tag ==  None and
-                    (not allowed_tags or (result_tag in allowed_tags)) and
-                    (pos_tag.lower() == found_pos_tag.lower())):
 
 
-                    # Put the relevenat data in the correct order
+def random_index_rows(data_to_write, random_indices):
+    # The rows of the random datasets: the extended rows with a random index instead of the deptree neighbour.
+    return [sentence_data[:4]+[random_idx,'_','_','_'] for sentence_data, random_idx in zip(data_to_write, random_indices)]
 
-                    cur_data_row = [sentence, w_parent, w_parent_idx, result_tag, w_child_idx-w_parent_idx, w_child, w_child_idx, rela]
-                    collected_tags.add(result_tag)
-                    #cur_data_row = [sentence, w_parent, w_parent_idx, result_tag, w_child_idx-w_parent_idx]
-                    valid_match = 1
-                    collected_sentence_data.append(cur_data_row)
 
-            #if valid_match == 0:
-            #    print(f"<{raw_sentence}> {morph_sentence_data} {result_tag}")
-            match_count += valid_match
+def extended_variant(morph_path, data_to_write, **options):
+    return [(os.path.join(rootdir_dep_tree_ext(), morph_path), data_to_write)]
 
-    match_rate = 0
-    if not collected_sentence_data:
-        print(f"    --No matching sentence found.")
-    else:
-        sentence_count = len(morph_data_dict)
-        match_rate = match_count/sentence_count*100
-        print(f"    --Expanded {match_count}/{sentence_count} sentneces (Match rate: {match_rate:.2f}%) from: {morph_path}")
-    return collected_sentence_data, collected_tags, match_rate
 
+def random_variant(morph_path, data_to_write, random_mode="uniform", random_samples=1, seed=None, **options):
+    # All the random indices of the file are drawn at once.
+    random_indices = sample_random_indices(data_to_write.sentence_lengths(), data_to_write.target_indices(),
+                                           data_to_write.distances(), random_mode, random_samples,
+                                           task_rng(seed, morph_path))
+    return [(os.path.join(rootdir_rnd_ext(sample), morph_path), random_index_rows(data_to_write, random_indices[:, sample].tolist()))
+            for sample in range(random_samples)]
 
-def write_sentence_data(output_file: str, processed_data):
-    with open(output_file, "w") as f:
-        for row_data in processed_data:
-            csv_row = '\t'.join(map(str, row_data))
-            f.write(csv_row+'\n')
 
+def masked_variant(morph_path, data_to_write, mask_sets=MASK_SETS, mask_relations=None, **options):
+    """
+    The deptree masking datasets (see 'mask_indices'), one for each mask set, written to 'datasets/masked/<mask set>'.
+    All mask sets are collected in a single pass over the rows, the rows without masked tokens
+    (e.g. no neighbour with the relation) are left out of the set. The masked indices are in the 5th column:
+        [sentence, word, word_idx, morph_tag, masked indices (space separated), '_', '_', '_']
+    """
+    treebank = data_to_write.treebank
+    allowed_relations = set(mask_relations) if mask_relations else None
+    set_rows = collections.OrderedDict()
+    row_graphs = zip(data_to_write.sentence_ids.tolist(), data_to_write.target_indices().tolist(), data_to_write)
+    for sentence_id, target, sentence_data in row_graphs:
+        masks = mask_indices(treebank.adjacency(sentence_id), target, mask_sets, treebank.relations.items, allowed_relations)
+        for mask_set, indices in masks.items():
+            set_rows.setdefault(mask_set, []).append(sentence_data[:4]+[" ".join(map(str, indices)),'_','_','_'])
+    return [(os.path.join(rootdir_masked_ext(mask_set), morph_path), rows) for mask_set, rows in set_rows.items()]
+
+
+"""
+The dataset variants 'generate_dataset' can write from the same matched rows (the names are data types, see 'data_rootdir').
+Each function gets the path of the morph. probe file, the matched rows (MatchedRows) and the generation options,
+and returns the (output file, rows to write) pairs.
+"""
+DATASET_VARIANTS = {
+    "extended": extended_variant,
+    "random": random_variant,
+    "masked": masked_variant,
+}
+# The integer columns of the Parquet files of the variants (see 'PARQUET_INT_COLUMNS'), if they differ from the extended rows.
+VARIANT_INT_COLUMNS = {
+    "masked": MASKED_PARQUET_INT_COLUMNS,
+}
+
+
+def generate_language_datasets(ud_treebank, tasks, variants=("extended",), output_format="tsv", layout="rows", fuzzy=False, **variant_options):
+    """
+    Generate the datasets of several morph/pos tasks of the same language, matching the UD data
+    once per split for all tasks (see 'match_tasks'). The training split comes first, its tags are the
+    allowed tags of the other splits of the task.
 
+    Args:
+        ud_treebank:        the UD data of the language (UDTreebank or ConlluIndex, see 'load_ud_data')
+        tasks:              list of (header, morph_tag, pos_tag, morph_data_path_triplet),
+                            the header is printed before the output of the task (if not None)
+        variants:           the dataset variants written from the matched rows (see 'DATASET_VARIANTS'), in one pass.
+        output_format:      the format of the written files (see 'DATASET_FORMATS')
+        layout:             'rows', or 'normalized' to write the sentences once per split (see 'write_dataset')
+        fuzzy:              match the sentences without an exact match to the most similar UD sentence (see 'fuzzy_aliases'),
+                            the match rate gain is reported for every file
+        variant_options:    the options of the variants:
+            random_mode:        'uniform' or 'distance' (matching the deptree node distances), see 'sample_random_indices'
+            random_samples:     the number of random datasets (the first one is written to 'datasets/random',
+                                the others to 'datasets/random_<i>')
+            seed:               the seed of the random indices (combined with the path of the data)
+            mask_sets:          the deptree masking sets of the 'masked' variant (see 'mask_indices')
+            mask_relations:     the relation labels of the 'relations' mask set (all labels if not given)
+    Returns:
+        list: the files written for each task, as (variant, output file) pairs.
+    """
+    traindata_tags = [None for _ in tasks]
+    # task -> [(morph_path, collected_sentence_data, match_count, fuzzy_count, sentence_count)]
+    task_results = [[] for _ in tasks]
+    split_count = max((len(task[3]) for task in tasks), default=0)
+
+    # split -> (task ids, morph. probe paths, morph. probe data)
+    split_data = []
+    for split_idx in range(split_count):
+        split_tasks = [task_id for task_id, task in enumerate(tasks) if split_idx < len(task[3]) and task[3][split_idx]]
+        morph_paths = [tasks[task_id][3][split_idx] for task_id in split_tasks]
+        split_data.append((split_tasks, morph_paths, [process_morpho_file(morph_path, ud_treebank.hash_keys) for morph_path in morph_paths]))
+    # The fuzzy matches are resolved once per task over all its splits, so that a UD sentence is not matched in two
+    # splits of a task, and the matches of a task do not depend on the other tasks it is generated with.
+    task_morph_data = [[] for _ in tasks]
+    for split_tasks, _, morph_data_dicts in split_data:
+        for task_id, morph_data_dict in zip(split_tasks, morph_data_dicts):
+            task_morph_data[task_id].append(morph_data_dict)
+    task_aliases = [fuzzy_aliases(ud_treebank, morph_data) if fuzzy else {} for morph_data in task_morph_data]
+
+    for split_tasks, morph_paths, morph_data_dicts in split_data:
+        results = match_tasks(ud_treebank, morph_data_dicts,
+                              [traindata_tags[task_id] for task_id in split_tasks],
+                              [tasks[task_id][2] for task_id in split_tasks],
+                              [tasks[task_id][1] for task_id in split_tasks], fuzzy,
+                              [task_aliases[task_id] for task_id in split_tasks])
+
+        for task_id, morph_path, morph_data_dict, (collected_sentence_data, collected_tags, match_count, fuzzy_count) in zip(split_tasks, morph_paths, morph_data_dicts, results):
+            #The training path should be the first one among the path triplet.
+            if morph_path.split(os.sep)[-1] == "train.tsv":
+                traindata_tags[task_id] = collected_tags
+            task_results[task_id].append((morph_path, collected_sentence_data, match_count, fuzzy_count, len(morph_data_dict)))
+
+    task_outputs = [[] for _ in tasks]
+    for (header, _, _, _), results, outputs in zip(tasks, task_results, task_outputs):
+        if header is not None:
+            print(header)
+        for morph_path, data_to_write, match_count, fuzzy_count, sentence_count in results:
+            match_rate = report_match_rate(data_to_write, match_count, sentence_count, morph_path, fuzzy_count)
+            if data_to_write and match_rate > 5:
+                for variant in variants:
+                    for target_file, rows_to_write in DATASET_VARIANTS[variant](morph_path, data_to_write, **variant_options):
+                        # Create output directory if does not exist
+                        target_dir = os.path.dirname(target_file)
+                        create_dir_if_needed(target_dir)
+                        print(f"        Writing data to file: {dataset_format_path(target_file, output_format, layout)}")
+                        output_files = write_sentence_data(target_file, rows_to_write, output_format, layout,
+                                                           VARIANT_INT_COLUMNS.get(variant, PARQUET_INT_COLUMNS))
+                        outputs.extend((variant, output_file) for output_file in output_files)
+                        if variant == "extended":
+                            # The relation statistics of the dataset (see 'get_relation_statistics'), without reading it back.
+                            save_dataset_relation_counts(output_files[0], RelationCounts.from_treebank(data_to_write.treebank, data_to_write.row_ids))
+            else:
+                print("    WARNING! No data retrieved.")
+    return task_outputs
 
 
-def generate_dataset(ud_data_dict, morph_data_path_triplet, pos_tag, morph_tag, random=False):
+def generate_dataset(ud_treebank, morph_data_path_triplet, pos_tag, morph_tag, variants=("extended",), **variant_options):
     """
+    Generate the datasets of a single morph/pos task, see 'generate_language_datasets'.
+
     Args:
-        morph_langname:     the language name (it is needed, since in the morph. data they are in folders named according the language). Example: 'English'
-        selected_morph_tag: example: 'Tense'
-        morph_data_paths:   the paths of the files that conatain the morphological probe data.
-        ud_data_paths:      the paths of the files that conatain the UD conllu data.
-    Returns:
-        dict:   containing the inforamtion for the processed data.
-                The dict key is the given character-simplified sentence (see the 'clean_string' function).
-    Create the desired datasets in a folder called 'processed_output' writing the data into relevant .tsv files.
-    Example output file names:
+        ud_treebank:        the UD data of the language (UDTreebank or ConlluIndex, see 'load_ud_data')
+        morph_data_path_triplet: the paths of the files that conatain the morphological probe data (train, dev, test).
+        pos_tag:            example: 'noun'
+        morph_tag:          example: 'number'
+        variants:           the dataset variants written from the matched rows (see 'DATASET_VARIANTS').
+        variant_options:    the options of the variants (see 'generate_language_datasets').
     """
+    return generate_language_datasets(ud_treebank, [(None, morph_tag, pos_tag, morph_data_path_triplet)], variants, **variant_options)[0]
 
 
-    #morph_data_dict = extract_morph_sentences_for_language(morph_dir_path, morph_langname)
-    #dict of dicts: 'dev', 'train', 'test' dicts
+"""
+Incremental generation: the inputs of every written task and variant are recorded in a manifest
+(see 'task_fingerprint'), the tasks whose inputs and outputs are unchanged are skipped on the next run.
+"""
+# The generator options the outputs of the variants depend on.
+VARIANT_OPTIONS = {
+    "extended": (),
+    "random": ("random_mode", "random_samples", "seed"),
+    "masked": ("mask_sets", "mask_relations"),
+}
 
-    #morph_data_dicts = extract_morph_sentences_keep_datasets(morph_data_paths)
+_generator_code_version = []
 
-    #TODO ket keys from train!!!
-    #use only training keys from conllu
-    traindata_tags = None
-    for morph_path in morph_data_path_triplet:
-        #extended data
-        ext_output_file = os.path.join(rootdir_dep_tree_ext(), morph_path)
-        rnd_output_file = os.path.join(rootdir_rnd_ext(), morph_path)
-    
-        
-        #print(morph_data_path_triplet)
-        #print(ext_output_dir)
-        #print(rnd_output_dir)
-        # process sentences in files
-        # ud_data_dict: dict, morph_path: string, pos_tag:string, morph_tag: string
-        #print(f"    Collecting data from: {morph_path}")
-
-        data_to_write, collected_tags, match_rate = process_sentence_data(ud_data_dict, morph_path, traindata_tags, pos_tag, morph_tag)
-        #The training path should be the first one among the path triplet.
-        if morph_path.split(os.sep)[-1] == "train.tsv":
-            traindata_tags = collected_tags
-        if data_to_write and match_rate > 5:
-            #print(f"    Writing data to: {output_file}")
-            
-            if random:
-                target_file = rnd_output_file
-                
-                data_to_write = [sentence_data[:4]+[randrange(len(sentence_data[0].split())),'_','_','_'] for sentence_data in data_to_write]
-            else:
-                target_file = ext_output_file
-            
-            target_dir = os.path.dirname(target_file)
-            create_dir_if_needed(target_dir)
-            # Create output directory if does not exist
-            print(f"        Writing data to file: {target_file}")
-            write_sentence_data(target_file, data_to_write)
-        else:
-            print("    WARNING! No data retrieved.")
+
+def generator_modules():
+    """
+    The modules the generated datasets depend on: this module and the modules of 'src' it imports, transitively.
+    They are found from the import statements (also the ones in functions), so new modules are covered too.
+
+    Returns:
+        list of strings: the file names of the modules, sorted.
+    """
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    modules = set()
+    pending = [os.path.splitext(os.path.basename(__file__))[0]]
+    while pending:
+        module_name = pending.pop()
+        module_path = os.path.join(src_dir, module_name+".py")
+        # The standard library and the installed packages are not part of the code version.
+        if module_name in modules or not os.path.isfile(module_path):
+            continue
+        modules.add(module_name)
+        with open(module_path, "r", encoding="utf-8") as module_file:
+            module_tree = ast.parse(module_file.read())
+        for node in ast.walk(module_tree):
+            if isinstance(node, ast.Import):
+                pending.extend(alias.name.split(".")[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                pending.append(node.module.split(".")[0])
+    return sorted(module_name+".py" for module_name in modules)
+
+
+def generator_code_version():
+    # The content of the modules the generated datasets depend on (see 'generator_modules').
+    if not _generator_code_version:
+        sha256 = hashlib.sha256()
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        for module_name in generator_modules():
+            with open(os.path.join(src_dir, module_name), "rb") as module_file:
+                sha256.update(module_name.encode("utf-8") + b"\0" + module_file.read())
+        _generator_code_version.append(sha256.hexdigest())
+    return _generator_code_version[0]
+
+
+def task_manifest_path(task, variant):
+    # The manifest of a task: .cache/manifest/<variant>/<morph_pos>/<language>.json
+    task_dir = os.path.dirname(next(path for path in task[3] if path))
+    return os.path.join(manifest_dir(), variant, os.path.relpath(task_dir, rootdir_orig())+".json")
+
+
+def task_fingerprint(task, variant, ud_key, task_options):
+    """
+    Fingerprint of the inputs of a task and variant: the content of the morph. probe files,
+    the UD files (see 'ud_cache_key'), the options of the variant and the code version.
+    """
+    inputs = {
+        "code": generator_code_version(),
+        "variant": variant,
+        "options": {option: task_options.get(option) for option in VARIANT_OPTIONS[variant]},
+        "format": task_options.get("output_format", "tsv"),
+        "layout": task_options.get("layout", "rows"),
+        "fuzzy": task_options.get("fuzzy", False),
+        "ud": ud_key,
+        "sources": [[path, file_sha256(path)] if path else None for path in task[3]],
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def is_task_up_to_date(manifest_path, fingerprint):
+    # The task is up to date if its inputs are unchanged and its outputs were not modified (or deleted) since.
+    if not os.path.isfile(manifest_path):
+        return False
+    with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest["fingerprint"] != fingerprint:
+        return False
+    for path, output in manifest["outputs"].items():
+        if not os.path.isfile(path) or output_signature(path) != {"size": output["size"], "mtime_ns": output["mtime_ns"]}:
+            return False
+    return True
+
+
+def write_task_manifest(manifest_path, fingerprint, output_files):
+    outputs = {path: dict(output_signature(path), sha256=file_sha256(path)) for path in output_files}
+    create_dir_if_needed(os.path.dirname(manifest_path))
+    with atomic_write(manifest_path) as tmp_path:
+        with open(tmp_path, "w", encoding="utf-8") as manifest_file:
+            json.dump({"fingerprint": fingerprint, "outputs": outputs}, manifest_file, indent=1)
+
+
+def plan_language_tasks(language, tasks, task_options, force=False):
+    """
+    Select the tasks and variants of a language that have to be generated, the others are skipped.
+
+    Returns:
+        list of (tasks, fingerprints) groups: the tasks of a group are generated together (for the same variants),
+        the fingerprints of a task are {variant: fingerprint}.
+    """
+    ud_key = ud_cache_key(list(conllu_file_path_loader(language)))
+    groups = collections.OrderedDict()
+    for task in tasks:
+        fingerprints = {}
+        for variant in task_options["variants"]:
+            fingerprint = task_fingerprint(task, variant, ud_key, task_options)
+            if force or not is_task_up_to_date(task_manifest_path(task, variant), fingerprint):
+                fingerprints[variant] = fingerprint
+        if not fingerprints:
+            print(f"{task[0]}\n    Up to date, skipped.")
+            continue
+        group_tasks, group_fingerprints = groups.setdefault(tuple(fingerprints), ([], []))
+        group_tasks.append(task)
+        group_fingerprints.append(fingerprints)
+    return list(groups.values())
+
+
+def generate_and_record(ud_treebank, tasks, fingerprints, task_options):
+    """
+    Generate a group of tasks (see 'plan_language_tasks') and record the manifests of their outputs.
+    """
+    variants = list(fingerprints[0])
+    task_outputs = generate_language_datasets(ud_treebank, tasks, **dict(task_options, variants=variants))
+    for task, task_fingerprints, outputs in zip(tasks, fingerprints, task_outputs):
+        for variant, fingerprint in task_fingerprints.items():
+            write_task_manifest(task_manifest_path(task, variant), fingerprint,
+                                [output_file for output_variant, output_file in outputs if output_variant == variant])
 
 
 #TODO return only existing combinations?
 def find_tag_combinations(morph_pos_tag, language):
     if morph_pos_tag == "All":
-        base_path = f"morphology_probes/data"
-        morph_pos_list = [ tuple(os.path.basename(f.path).split("_")) for f in os.scandir(base_path) if f.is_dir() ]
+        morph_pos_list = find_all_tag_pairs()
     else:
         morph_pos_list = [tuple(morph_pos_tag.split("_"))]
 
     if language == "All":
-        found_languages = set()
-        for root, dirs, files in os.walk("morphology_probes/data"):
-            for dirname in dirs:
-                cur_dir  = os.path.join(root, dirname)
-                for lang_root, lang_dirs, lang_files in os.walk(cur_dir):
-                    for lang_dir_name in lang_dirs:
-                        found_languages.add(lang_dir_name)
-        language_list = list(found_languages)
+        language_list = find_all_languages()
     else:
         language_list = [language]
 
     return [([(mt,pt) for mt,pt in morph_pos_list], lang) for lang in language_list]
 
 
-def download_data():
+def download_data(extract=False, ud_url=None, sha256=None, tags="All,All", git_url=None):
     # Download the source datasets and the probing project. No further action taken.
-    base_url = ud_treebank_source_url()
+    # The UD treebank is read directly from the archive, unless it is extracted.
+    # Only the morphology probes selected by the tags are checked out.
+    base_url = ud_url if ud_url else ud_treebank_source_url()
     treebank_name = ud_treebank_name()
-    download_ud_treebank_if_needed(base_url, treebank_name)
-    git_url = git_repo_url()
+    download_ud_treebank_if_needed(base_url, treebank_name, extract, sha256)
+    git_url = git_url if git_url else git_repo_url()
     download_git_repo_if_needed(git_url, git_repo_name_probe())
-    download_git_repo_if_needed(git_url, git_repo_name_probing_dataset())
+    download_git_repo_if_needed(git_url, git_repo_name_morphology_probes(), git_repo_dir_morphology_probes(),
+                                morphology_probes_sparse_patterns(tags))
 
 
-def generate_data(tags: str, random = False):
-    # Deafault behaviour: download only on explicit command, see:
-    #download_data()
+# UD data loaded in a worker process: {language: UDTreebank}. Only the last language is kept.
+_worker_ud_data = {}
 
-    dataset_path_triplets = dataset_paths(git_repo_name_probing_dataset(), tags)
-    dataset_dict  = group_paths_on_language(dataset_path_triplets)
-    counter = 1
-    dataset_count = sum(map(len, dataset_dict.values()))
 
-    for lang, datalist in dataset_dict.items():
-        
+def _worker_load_ud_data(language, load_options):
+    if language not in _worker_ud_data:
+        _worker_ud_data.clear()
+        _worker_ud_data[language] = load_ud_data(language, **load_options)
+    return _worker_ud_data[language]
+
+
+def _run_captured(function, *args, **kwargs):
+    """
+    Run a function in a worker process, capturing everything it prints.
+    Returns the captured output, so that the main process can print the logs in order,
+    and whether the function succeeded (the traceback of an exception is part of the output).
+    """
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        try:
+            function(*args, **kwargs)
+            succeeded = True
+        except Exception:
+            print(traceback.format_exc())
+            succeeded = False
+    return log.getvalue(), succeeded
+
+
+def _prepare_language_job(language, load_options):
+    return _run_captured(load_ud_data, language, **load_options)
 
-        ud_data_paths = list(conllu_file_path_loader(lang))
-        ud_data_dict  = extract_UD_sentences_from_all_files(ud_data_paths)
 
+def _generate_tasks(language, tasks, fingerprints, load_options, task_options):
+    generate_and_record(_worker_load_ud_data(language, load_options), tasks, fingerprints, task_options)
+
+
+def _generate_tasks_job(*args):
+    return _run_captured(_generate_tasks, *args)
+
+
+def language_tasks(dataset_dict):
+    """
+    The morph/pos tasks of each language, in the format of 'generate_language_datasets',
+    with numbered headers: {language: [(header, morph_tag, pos_tag, morph_data_path_triplet)]}
+    """
+    dataset_count = sum(map(len, dataset_dict.values()))
+    tasks = collections.defaultdict(list)
+    counter = 1
+    for lang, datalist in dataset_dict.items():
         for morph_pos, morph_data_paths in datalist:
             morph_tag, pos_tag = list(morph_pos.split("_"))
-            print(f"\n {counter}/{dataset_count}. Language: {lang}; Morph: {morph_tag}; PoS: {pos_tag}")
+            header = f"\n {counter}/{dataset_count}. Language: {lang}; Morph: {morph_tag}; PoS: {pos_tag}"
             counter+=1
+            tasks[lang].append((header, morph_tag, pos_tag, morph_data_paths))
+    return tasks
+
+
+def generate_data_parallel(language_groups, load_options, task_options, workers):
+    """
+    Generate the datasets in a process pool.
+    First the UD data of the languages is parsed (and cached, see 'load_ud_data') in parallel
+    (or language by language with the chunked parsing, see 'extract_UD_sentences_parallel'),
+    then the tasks of the languages are distributed among the workers, which load the cached UD data.
+    If there are fewer languages than workers, the tasks of a language are split into several jobs
+    (each job matches the UD data once for all its tasks, see 'generate_language_datasets').
+    The output of the jobs is printed in the order of submission. The failed jobs are listed at the end
+    and an exception is raised, the tasks of the languages whose UD data could not be loaded are not started.
+
+    Args:
+        language_groups: the groups of the tasks to generate by language, {language: [(tasks, fingerprints)]}
+                         (see 'plan_language_tasks')
+        load_options (dict): the keyword arguments of 'load_ud_data'
+        task_options (dict): the keyword arguments of 'generate_language_datasets'
+        workers (int): the number of worker processes
+    """
+    languages = list(language_groups.keys())
+    if load_options.get("parse_workers", 1) > 1:
+        # The languages are parsed one after the other, each of them in chunks by its own process pool
+        # (the pools can not be nested), then the workers load the cached data.
+        for lang in languages:
+            load_ud_data(lang, **load_options)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        print(f"Loading the UD data of {len(languages)} language(s) with {workers} workers.")
+        failures = []
+        failed_languages = set()
+        for lang, (log, succeeded) in zip(languages, executor.map(_prepare_language_job, languages, [load_options]*len(languages))):
+            print(log, end="")
+            if not succeeded:
+                failed_languages.add(lang)
+                failures.append(f"{lang}: loading the UD data")
+
+        futures = []
+        jobs_per_language = max(1, -(-workers // max(1, len(languages))))
+        for lang, groups in language_groups.items():
+            if lang in failed_languages:
+                continue
+            for tasks, fingerprints in groups:
+                chunk_size = -(-len(tasks) // jobs_per_language)
+                for chunk_start in range(0, len(tasks), chunk_size):
+                    chunk = slice(chunk_start, chunk_start+chunk_size)
+                    job = executor.submit(_generate_tasks_job, lang, tasks[chunk], fingerprints[chunk], load_options, task_options)
+                    futures.append((lang, tasks[chunk], job))
+
+        for lang, tasks, job in futures:
+            log, succeeded = job.result()
+            print(log, end="")
+            if not succeeded:
+                failures.append(f"{lang}: {', '.join(f'{morph_tag}_{pos_tag}' for _, morph_tag, pos_tag, _ in tasks)}")
+
+    if failures:
+        print(f"\nGeneration failed: {len(failures)} job(s).")
+        for failure in failures:
+            print(f"    FAILED: {failure}")
+        raise Exception(f"{len(failures)} generation job(s) failed, see the output above.")
+
+
+def generate_data(tags: str, *, random = False, clear_cache = False, workers = 1, lazy = False,
+                  random_mode = "uniform", random_samples = 1, seed = None, variants = None, hash_keys = False,
+                  parse_workers = 1, max_memory = None, force = False, output_format = "tsv",
+                  layout = "rows", fuzzy = False, mask_sets = None, mask_relations = None):
+    # The options are keyword-only, there are too many of them to pass by position.
+    # Deafault behaviour: download only on explicit command, see:
+    #download_data()
+    # The extended (deptree) datasets are written by default, the random ones with 'random',
+    # several variants can be written in the same pass (see 'DATASET_VARIANTS').
+    if not variants:
+        variants = ["random"] if random else ["extended"]
+    for variant in variants:
+        if variant not in DATASET_VARIANTS:
+            raise Exception(f"Unknown dataset variant: {variant}. Available: {', '.join(DATASET_VARIANTS)}")
+    mask_sets = list(mask_sets) if mask_sets else list(MASK_SETS)
+    if "masked" in variants:
+        validate_mask_sets(mask_sets)
+    if clear_cache:
+        clear_ud_cache()
+
+    # The keyword arguments of 'load_ud_data' and 'generate_language_datasets'
+    load_options = {"lazy": lazy, "hash_keys": hash_keys, "parse_workers": parse_workers, "max_memory": max_memory}
+    task_options = {"variants": variants, "random_mode": random_mode, "random_samples": random_samples, "seed": seed,
+                    "output_format": output_format, "layout": layout, "fuzzy": fuzzy,
+                    "mask_sets": mask_sets, "mask_relations": mask_relations}
+
+    dataset_path_triplets = dataset_paths(git_repo_name_probing_dataset(), tags)
+    dataset_dict  = group_paths_on_language(dataset_path_triplets)
+    # The tasks whose outputs are up to date are skipped, unless 'force' (see 'plan_language_tasks').
+    language_groups = collections.OrderedDict()
+    for lang, tasks in language_tasks(dataset_dict).items():
+        groups = plan_language_tasks(lang, tasks, task_options, force)
+        if groups:
+            language_groups[lang] = groups
+    if workers > 1:
+        generate_data_parallel(language_groups, load_options, task_options, workers)
+        return
+
+    for lang, groups in language_groups.items():
+        
+
+        ud_treebank  = load_ud_data(lang, **load_options)
 
-            #morph_data_paths = morpho_file_path_loader(morph_repo_name, pos_tag, morph_tag, lang)
+        #morph_data_paths = morpho_file_path_loader(morph_repo_name, pos_tag, morph_tag, lang)
 
-            generate_dataset(ud_data_dict, morph_data_paths, pos_tag, morph_tag, random)
+        for tasks, fingerprints in groups:
+            generate_and_record(ud_treebank, tasks, fingerprints, task_options)
@@ -0,0 +1,291 @@
+import gzip
+import io
+import os
+import threading
+
+from utils import DATASET_FORMATS, DATASET_LAYOUTS, SENTENCE_TABLE_SUFFIX, dataset_format_path, dataset_tsv_path, atomic_write, \
+                  invalidate_catalog_tree
+
+
+"""
+Writing and reading the generated datasets in the supported formats (see 'DATASET_FORMATS'):
+    tsv       plain TSV, one row per line (the format of the morphology probes)
+    gzip      gzip compressed TSV
+    zstd      zstd compressed TSV (needs the 'zstandard' package)
+    parquet   Parquet file with dictionary-encoded string columns (needs the 'pyarrow' package)
+The sentences can be written once per split, in a separate table (the 'normalized' layout, see 'write_dataset').
+All formats and layouts are read back as the lines of the TSV file (see 'open_dataset').
+"""
+# The columns of the dataset rows (see the 'Structure of the dataset' in the README).
+DATASET_COLUMNS = ("sentence", "word", "word_idx", "morph_tag", "distance", "child_word", "child_idx", "relation")
+# The integer columns of the Parquet files, the others are dictionary-encoded strings.
+PARQUET_INT_COLUMNS = ("word_idx", "distance")
+# The integer columns of the masked datasets, their 'distance' column holds the space separated masked indices.
+MASKED_PARQUET_INT_COLUMNS = ("word_idx",)
+# The tables of the normalized layout (see 'write_dataset').
+ROW_TABLE_COLUMNS = ("sentence_id",) + DATASET_COLUMNS[1:]
+SENTENCE_TABLE_COLUMNS = ("sentence_id", "sentence")
+
+# Size of the write buffer of the text formats, the rows are written in batches of WRITE_BATCH_ROWS.
+WRITE_BUFFER_SIZE = 1024 * 1024
+WRITE_BATCH_ROWS = 4096
+# Number of rows of a Parquet row group.
+PARQUET_BATCH_ROWS = 65536
+
+
+def zstandard_module():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception("The zstd dataset format needs the 'zstandard' package: pip install zstandard")
+    return zstandard
+
+
+def pyarrow_modules():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("The parquet dataset format needs the 'pyarrow' package: pip install pyarrow")
+    return pyarrow, pyarrow.parquet
+
+
+def batched(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_tsv_rows(text_file, rows):
+    for batch in batched(rows, WRITE_BATCH_ROWS):
+        text_file.write("".join('\t'.join(map(str, row_data))+'\n' for row_data in batch))
+
+
+def write_parquet_rows(file_path, rows, columns=DATASET_COLUMNS, int_columns=PARQUET_INT_COLUMNS):
+    pyarrow, parquet = pyarrow_modules()
+    string_type = pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    schema = pyarrow.schema([(name, pyarrow.int64() if name in int_columns else string_type) for name in columns])
+    with parquet.ParquetWriter(file_path, schema) as writer:
+        for batch in batched(rows, PARQUET_BATCH_ROWS):
+            arrays = []
+            for column_id, name in enumerate(columns):
+                if name in int_columns:
+                    arrays.append(pyarrow.array([row[column_id] for row in batch], type=pyarrow.int64()))
+                else:
+                    values = pyarrow.array([str(row[column_id]) for row in batch], type=pyarrow.string())
+                    arrays.append(values.dictionary_encode().cast(string_type))
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+
+def write_table(target_file, rows, output_format, columns=DATASET_COLUMNS, int_columns=PARQUET_INT_COLUMNS):
+    # Written atomically (see 'atomic_write'), so that (parallel) writers never leave half-written files.
+    with atomic_write(target_file) as tmp_file:
+        if output_format == "tsv":
+            with open(tmp_file, "w", buffering=WRITE_BUFFER_SIZE) as f:
+                write_tsv_rows(f, rows)
+        elif output_format == "gzip":
+            # No timestamp in the header, the same rows give the same file.
+            with open(tmp_file, "wb") as raw_file, gzip.GzipFile(fileobj=raw_file, mode="wb", mtime=0) as gzip_file, \
+                 io.TextIOWrapper(gzip_file, encoding="utf-8") as f:
+                write_tsv_rows(f, rows)
+        elif output_format == "zstd":
+            zstandard = zstandard_module()
+            with open(tmp_file, "wb") as raw_file, zstandard.ZstdCompressor().stream_writer(raw_file) as zstd_file, \
+                 io.TextIOWrapper(zstd_file, encoding="utf-8") as f:
+                write_tsv_rows(f, rows)
+        else:
+            write_parquet_rows(tmp_file, rows, columns, int_columns)
+
+
+def normalized_rows(rows, sentence_ids):
+    # The rows referring to the sentences by id, the ids are given in the order of the first occurrence.
+    for row_data in rows:
+        sentence_id = sentence_ids.setdefault(row_data[0], len(sentence_ids))
+        yield [sentence_id] + list(row_data[1:])
+
+
+def sentence_table_path(rows_path):
+    # The sentence table of a dataset in the normalized layout, e.g. 'train.rows.tsv' -> 'train.sentences.tsv'
+    extension = DATASET_FORMATS[dataset_format(rows_path)]
+    return rows_path[:-len(DATASET_LAYOUTS["normalized"]+extension)] + SENTENCE_TABLE_SUFFIX + extension
+
+
+def write_dataset(output_file, rows, output_format="tsv", layout="rows", int_columns=PARQUET_INT_COLUMNS):
+    """
+    Write the rows of a dataset in the given format and layout:
+        rows        one row per line, [sentence, word, idx, morph_tag, distance, child_word, child_idx, relation]
+        normalized  the sentence table (sentence id, sentence), every sentence written once,
+                    and the row table, referring to the sentences by id: [sentence id, word, idx, ...]
+    The files of the other formats and layouts of the same dataset are removed, so that the readers find these ones.
+
+    Args:
+        output_file (str): the path of the dataset as a TSV file (e.g. '.../train.tsv'),
+                           the extensions of the format and the layout are applied (see 'dataset_format_path').
+        rows (iterable of lists): the rows of the dataset.
+        output_format (str): one of 'DATASET_FORMATS'.
+        layout (str): one of 'DATASET_LAYOUTS'.
+        int_columns (tuple of strings): the integer columns of the Parquet files (e.g. 'MASKED_PARQUET_INT_COLUMNS').
+    Returns:
+        list of strings: the paths of the written files.
+    """
+    if output_format not in DATASET_FORMATS:
+        raise Exception(f"Unknown dataset format: {output_format}. Available: {', '.join(DATASET_FORMATS)}")
+    if layout not in DATASET_LAYOUTS:
+        raise Exception(f"Unknown dataset layout: {layout}. Available: {', '.join(DATASET_LAYOUTS)}")
+    target_file = dataset_format_path(output_file, output_format, layout)
+    if layout == "rows":
+        write_table(target_file, rows, output_format, DATASET_COLUMNS, int_columns)
+        written_files = [target_file]
+    else:
+        # The row table is written first, the sentence ids are assigned on the way.
+        sentence_ids = {}
+        write_table(target_file, normalized_rows(rows, sentence_ids), output_format,
+                    ROW_TABLE_COLUMNS, int_columns+("sentence_id",))
+        write_table(sentence_table_path(target_file), ((sentence_id, sentence) for sentence, sentence_id in sentence_ids.items()),
+                    output_format, SENTENCE_TABLE_COLUMNS, ("sentence_id",))
+        written_files = [target_file, sentence_table_path(target_file)]
+
+    for other_layout in DATASET_LAYOUTS:
+        for other_format in DATASET_FORMATS:
+            other_file = dataset_format_path(output_file, other_format, other_layout)
+            other_files = [other_file, sentence_table_path(other_file)] if other_layout == "normalized" else [other_file]
+            for other_file in other_files:
+                if other_file not in written_files and os.path.isfile(other_file):
+                    os.remove(other_file)
+    # The catalog of the datasets is validated again when they are listed (see 'catalog_tree').
+    invalidate_catalog_tree(output_file)
+    return written_files
+
+
+def dataset_format(file_path):
+    # The format of a dataset file by its extension (the longest matching one).
+    for output_format, extension in sorted(DATASET_FORMATS.items(), key=lambda item: -len(item[1])):
+        if file_path.endswith(extension):
+            return output_format
+    return "tsv"
+
+
+def dataset_layout(file_path):
+    extension = DATASET_FORMATS[dataset_format(file_path)]
+    if file_path[:-len(extension)].endswith(DATASET_LAYOUTS["normalized"]):
+        return "normalized"
+    return "rows"
+
+
+def iter_parquet_lines(file_path):
+    _, parquet = pyarrow_modules()
+    parquet_file = parquet.ParquetFile(file_path)
+    for batch in parquet_file.iter_batches(batch_size=PARQUET_BATCH_ROWS):
+        columns = [column.to_pylist() for column in batch.columns]
+        for row_data in zip(*columns):
+            yield '\t'.join(map(str, row_data))+'\n'
+
+
+def open_table(file_path):
+    # The lines of a file of any format, in TSV format.
+    output_format = dataset_format(file_path)
+    if output_format == "tsv":
+        return open(file_path, "r")
+    if output_format == "gzip":
+        return gzip.open(file_path, "rt", encoding="utf-8")
+    if output_format == "zstd":
+        zstandard = zstandard_module()
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(file_path, "rb"), closefd=True), encoding="utf-8")
+    return iter_parquet_lines(file_path)
+
+
+def iter_normalized_lines(rows_path):
+    # Rebuild the rows of a normalized dataset lazily, only the sentence table is loaded into memory.
+    sentences = {}
+    for line in open_table(sentence_table_path(rows_path)):
+        sentence_id, sentence = line.rstrip("\n").split("\t", 1)
+        sentences[sentence_id] = sentence
+    for line in open_table(rows_path):
+        sentence_id, row_rest = line.split("\t", 1)
+        yield sentences[sentence_id] + "\t" + row_rest
+
+
+def open_dataset(file_path):
+    """
+    Open a dataset file of any format and layout (see 'DATASET_FORMATS', 'DATASET_LAYOUTS') for reading,
+    decompressing it in memory. The rows of the normalized layout are rebuilt on the fly.
+
+    Returns:
+        iterable of strings: the lines of the dataset in the TSV format of the 'rows' layout
+                             (a file object for the plain and compressed TSV files, a generator otherwise).
+    """
+    if dataset_layout(file_path) == "normalized":
+        return iter_normalized_lines(file_path)
+    return open_table(file_path)
+
+
+class DatasetStream:
+    """
+    Make a dataset of any format readable as a TSV file by external programs (e.g. the probing scripts),
+    without writing the decompressed data to disk: the rows are streamed through a named pipe.
+    The pipe is read once: a writer can not tell when a reader has drained the pipe, so reopening it for
+    the next reader could send the rows twice to the same one.
+    The path of the pipe ends with the same '<morph_pos>/<language>/<split>.tsv' parts as the dataset
+    (see 'tags_from_path'). Plain TSV files in the 'rows' layout are used directly, unless a perturbation
+    view is applied to the rows (see 'PerturbationView').
+    If the rows can not be read, the reader only sees them truncated: the error is raised when the block exits.
+
+        with DatasetStream(path, stream_dir) as tsv_path:
+            subprocess.run(... tsv_path ...)
+    """
+    def __init__(self, file_path, stream_dir, view=None):
+        self.file_path = file_path
+        self.stream_dir = stream_dir
+        self.view = view
+        self.pipe_path = None
+        self.closed = False
+        self.feeder = None
+        # The exception of the feeder thread, raised by '__exit__'.
+        self.error = None
+
+    def __enter__(self):
+        if self.view is None and dataset_format(self.file_path) == "tsv" and dataset_layout(self.file_path) == "rows":
+            return self.file_path
+        path_parts = dataset_tsv_path(self.file_path).split(os.sep)
+        pipe_dir = os.path.join(self.stream_dir, str(os.getpid()), *path_parts[-3:-1])
+        os.makedirs(pipe_dir, exist_ok=True)
+        self.pipe_path = os.path.abspath(os.path.join(pipe_dir, path_parts[-1]))
+        if os.path.exists(self.pipe_path):
+            os.remove(self.pipe_path)
+        os.mkfifo(self.pipe_path)
+        self.feeder = threading.Thread(target=self.feed, daemon=True)
+        self.feeder.start()
+        return self.pipe_path
+
+    def feed(self):
+        # Blocks until a reader opens the pipe.
+        with open(self.pipe_path, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as pipe:
+            if self.closed:
+                return
+            lines = self.view.lines(self.file_path) if self.view is not None else open_dataset(self.file_path)
+            try:
+                pipe.writelines(lines)
+            except BrokenPipeError:
+                pass
+            except Exception as err:
+                self.error = err
+            finally:
+                if hasattr(lines, "close"):
+                    lines.close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.pipe_path is None:
+            return
+        self.closed = True
+        # Open the pipe for reading, so that a waiting feeder thread stops.
+        reader = os.open(self.pipe_path, os.O_RDONLY | os.O_NONBLOCK)
+        os.close(reader)
+        self.feeder.join()
+        os.remove(self.pipe_path)
+        if self.error is not None and exc_type is None:
+            raise Exception(f"Streaming the rows of '{self.file_path}' failed: {self.error!r}") from self.error
@@ -0,0 +1,159 @@
+import numpy as np
+
+
+"""
+Approximate matching of the character-simplified sentences (see 'clean_string') of the morphology probes
+and the UD treebank, for the sentences that differ only slightly (e.g. tokenization, quotes or HTML entities).
+
+The sentences are represented by the MinHash signatures of their character n-grams, the signatures are split
+into bands, and the sentences sharing a band are the candidates of a match (locality-sensitive hashing).
+The bands are sorted arrays, a band of a query is looked up by binary search, so that only the candidates
+are compared (with the exact Jaccard similarity of their n-grams), not all pairs of sentences.
+"""
+# Length of the character n-grams (the simplified sentences are ASCII, an n-gram is packed into an int).
+SHINGLE_SIZE = 4
+# The signatures have MINHASH_BANDS * MINHASH_ROWS hashes. With 16 bands of 4 rows the sentences with a Jaccard
+# similarity of 0.8 become candidates with a probability of 0.999, the ones with 0.5 with 0.64.
+MINHASH_BANDS = 16
+MINHASH_ROWS = 4
+# The minimal Jaccard similarity of the n-grams of a match.
+FUZZY_MATCH_THRESHOLD = 0.8
+# The signatures are computed in batches of about this many n-grams (the hashes of a batch are kept in memory).
+SIGNATURE_BATCH_SHINGLES = 2**16
+# The hash functions are fixed, the signatures of the same sentence are always the same.
+MINHASH_SEED = 20240601
+# Multiplier of the hashes of the rows combined into a band key.
+BAND_KEY_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def minhash_parameters():
+    # Multiply-shift hash functions: h(x) = ((a*x + b) mod 2^64) >> 32, with odd multipliers.
+    rng = np.random.default_rng(MINHASH_SEED)
+    hash_count = MINHASH_BANDS * MINHASH_ROWS
+    multipliers = rng.integers(0, 2**63, size=hash_count, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    offsets = rng.integers(0, 2**63, size=hash_count, dtype=np.uint64)
+    return multipliers, offsets
+
+
+def shingles(raw_sentence):
+    # The set of the character n-grams of a sentence (the whole sentence if it is shorter).
+    return {raw_sentence[i:i+SHINGLE_SIZE] for i in range(max(len(raw_sentence)-SHINGLE_SIZE+1, 1))}
+
+
+def jaccard_similarity(shingles_a, shingles_b):
+    return len(shingles_a & shingles_b) / len(shingles_a | shingles_b)
+
+
+def shingle_arrays(raw_sentences):
+    """
+    The character n-grams of a batch of sentences, packed into ints.
+
+    Returns:
+        pair:
+            -array of ints: the n-grams of all sentences, the n-grams of a sentence are consecutive.
+            -array of ints: the index of the first n-gram of each sentence.
+    """
+    padded = [raw_sentence.ljust(SHINGLE_SIZE, "_") for raw_sentence in raw_sentences]
+    counts = np.array([len(sentence)-SHINGLE_SIZE+1 for sentence in padded], dtype=np.int64)
+    text = np.frombuffer("".join(padded).encode("ascii"), dtype=np.uint8).astype(np.uint64)
+    text_starts = np.cumsum([0] + [len(sentence) for sentence in padded[:-1]])
+    shingle_starts = np.cumsum(counts) - counts
+    # The position of every n-gram in the joined text.
+    positions = np.repeat(text_starts - shingle_starts, counts) + np.arange(counts.sum())
+    packed = np.zeros(len(positions), dtype=np.uint64)
+    for offset in range(SHINGLE_SIZE):
+        packed |= text[positions+offset] << np.uint64(8*offset)
+    return packed, shingle_starts
+
+
+def minhash_signatures(raw_sentences):
+    """
+    The MinHash signatures of the sentences, computed in batches.
+
+    Returns:
+        array of uint32 with the shape (number of sentences, MINHASH_BANDS * MINHASH_ROWS)
+    """
+    multipliers, offsets = minhash_parameters()
+    signatures = np.zeros((len(raw_sentences), len(multipliers)), dtype=np.uint32)
+    batch_start = 0
+    while batch_start < len(raw_sentences):
+        batch_end = batch_start
+        shingle_count = 0
+        while batch_end < len(raw_sentences) and (shingle_count < SIGNATURE_BATCH_SHINGLES or batch_end == batch_start):
+            shingle_count += max(len(raw_sentences[batch_end])-SHINGLE_SIZE+1, 1)
+            batch_end += 1
+        packed, shingle_starts = shingle_arrays(raw_sentences[batch_start:batch_end])
+        hashes = (packed[:, None] * multipliers + offsets) >> np.uint64(32)
+        signatures[batch_start:batch_end] = np.minimum.reduceat(hashes, shingle_starts, axis=0)
+        batch_start = batch_end
+    return signatures
+
+
+def band_keys(signatures):
+    # One key per band of each signature: the hashes of the rows of the band combined (shape: sentences, bands).
+    keys = np.zeros((len(signatures), MINHASH_BANDS), dtype=np.uint64)
+    for row in range(MINHASH_ROWS):
+        keys = keys * BAND_KEY_MULTIPLIER + signatures[:, row::MINHASH_ROWS].astype(np.uint64)
+    return keys
+
+
+class MinHashIndex:
+    """
+    Approximate lookup of the character-simplified sentences (see the module description).
+
+    Args:
+        raw_sentences (iterable of strings): the indexed sentences (the keys of the UD sentences).
+    """
+    def __init__(self, raw_sentences):
+        self.raw_sentences = list(dict.fromkeys(raw_sentence for raw_sentence in raw_sentences if raw_sentence))
+        self.ids = {raw_sentence: idx for idx, raw_sentence in enumerate(self.raw_sentences)}
+        keys = band_keys(minhash_signatures(self.raw_sentences))
+        # The sentence ids of every band, sorted by the band keys.
+        self.band_order = np.argsort(keys, axis=0, kind="stable")
+        self.sorted_keys = np.take_along_axis(keys, self.band_order, axis=0)
+
+    def __len__(self):
+        return len(self.raw_sentences)
+
+    def __contains__(self, raw_sentence):
+        return raw_sentence in self.ids
+
+    def candidates(self, query_keys):
+        # The ids of the indexed sentences sharing at least one band with the query.
+        candidate_ids = set()
+        for band, key in enumerate(query_keys.tolist()):
+            start = np.searchsorted(self.sorted_keys[:, band], np.uint64(key), side="left")
+            end = np.searchsorted(self.sorted_keys[:, band], np.uint64(key), side="right")
+            candidate_ids.update(self.band_order[start:end, band].tolist())
+        return candidate_ids
+
+    def match(self, raw_sentences, threshold=FUZZY_MATCH_THRESHOLD):
+        """
+        Find the most similar indexed sentence of each query sentence that is not indexed itself.
+        Every indexed sentence is matched at most once: the sentences that are indexed (the exact matches)
+        are excluded, the others go to the first query they are the best match of.
+
+        Args:
+            raw_sentences (iterable of strings): the query sentences.
+            threshold (float): the minimal Jaccard similarity of the character n-grams.
+        Returns:
+            dict: {query sentence: indexed sentence}
+        """
+        raw_sentences = list(raw_sentences)
+        queries = [raw_sentence for raw_sentence in dict.fromkeys(raw_sentences) if raw_sentence and raw_sentence not in self.ids]
+        matched_ids = {self.ids[raw_sentence] for raw_sentence in raw_sentences if raw_sentence in self.ids}
+        if not queries or not self.raw_sentences:
+            return {}
+        matches = {}
+        for raw_sentence, query_keys in zip(queries, band_keys(minhash_signatures(queries))):
+            query_shingles = shingles(raw_sentence)
+            scored = []
+            for candidate_id in self.candidates(query_keys) - matched_ids:
+                similarity = jaccard_similarity(query_shingles, shingles(self.raw_sentences[candidate_id]))
+                if similarity >= threshold:
+                    scored.append((-similarity, candidate_id))
+            if scored:
+                _, best_id = min(scored)
+                matched_ids.add(best_id)
+                matches[raw_sentence] = self.raw_sentences[best_id]
+        return matches
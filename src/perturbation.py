@@ -0,0 +1,134 @@
+import zlib
+import numpy as np
+
+
+RANDOM_MODES = ("uniform", "distance")
+
+# Rounds of redrawing the out-of-sentence indices in the 'distance' mode, before falling back to uniform sampling.
+MAX_RESAMPLING_ROUNDS = 20
+
+
+def task_rng(seed, task_name):
+    """
+    Random generator of a task. With a seed, every task gets its own reproducible stream
+    (independent of the order the tasks are processed in), without a seed the draws are not reproducible.
+    """
+    if seed is None:
+        return np.random.default_rng()
+    if seed < 0:
+        raise Exception(f"The seed must be a non-negative integer: {seed}")
+    return np.random.default_rng([seed, zlib.crc32(task_name.encode("utf-8"))])
+
+
+def sample_random_indices(sentence_lengths, target_indices, distances, mode="uniform", samples=1, rng=None):
+    """
+    Draw random token indices for all rows of a dataset in one vectorized call.
+
+    Args:
+        sentence_lengths (array of ints): the number of (space separated) tokens of the sentence of each row.
+        target_indices (array of ints): the index of the target word of each row.
+        distances (array of ints): the deptree node distances (parent index - word index) of the rows.
+        mode (str):
+            'uniform'   any token of the sentence, with equal probability.
+            'distance'  the offset from the target word follows the distribution of the deptree distances,
+                        offsets pointing outside the sentence are redrawn.
+        samples (int): the number of random indices drawn for each row.
+        rng (numpy.random.Generator): the random generator (see 'task_rng').
+    Returns:
+        array of ints with the shape (number of rows, samples)
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    sentence_lengths = np.asarray(sentence_lengths, dtype=np.int64)[:, None]
+    shape = (len(sentence_lengths), samples)
+
+    if mode == "uniform" or len(distances) == 0:
+        return rng.integers(0, sentence_lengths, size=shape)
+    if mode != "distance":
+        raise Exception(f"Unknown random sampling mode: {mode}")
+
+    target_indices = np.asarray(target_indices, dtype=np.int64)[:, None]
+    distances = np.asarray(distances, dtype=np.int64)
+    random_indices = target_indices + rng.choice(distances, size=shape)
+    invalid = (random_indices < 0) | (random_indices >= sentence_lengths)
+    for _ in range(MAX_RESAMPLING_ROUNDS):
+        if not invalid.any():
+            break
+        rows, cols = np.nonzero(invalid)
+        random_indices[rows, cols] = target_indices[rows, 0] + rng.choice(distances, size=len(rows))
+        invalid = (random_indices < 0) | (random_indices >= sentence_lengths)
+
+    if invalid.any():
+        # No valid offset was drawn (e.g. short sentences with long distances only).
+        rows, cols = np.nonzero(invalid)
+        random_indices[rows, cols] = rng.integers(0, sentence_lengths[rows, 0])
+    return random_indices
+
+
+"""
+Deptree masking: the token indices masked in the sentence of each row, selected in its dependency graph
+(see 'UDTreebank.adjacency'). The mask sets are given by name:
+    target      the target word only
+    all         all deptree neighbours of the target word (its parent and children)
+    relations   one set per relation label: the neighbours connected to the target by that relation
+    hop<k>      the k-hop neighbourhood of the target word (e.g. hop2), without the target word
+"""
+MASK_SETS = ("target", "all", "relations")
+HOP_MASK_PREFIX = "hop"
+
+
+def validate_mask_sets(mask_sets):
+    for mask_set in mask_sets:
+        hops = mask_set[len(HOP_MASK_PREFIX):]
+        if mask_set not in MASK_SETS and not (mask_set.startswith(HOP_MASK_PREFIX) and hops.isdigit() and int(hops) > 0):
+            raise Exception(f"Unknown mask set: {mask_set}. Available: {', '.join(MASK_SETS)}, {HOP_MASK_PREFIX}<k>")
+
+
+def relation_mask_name(relation):
+    # The name of the mask set of a relation label, usable as a directory name (e.g. 'nmod:poss' -> 'rel_nmod_poss').
+    return "rel_" + relation.replace(":", "_")
+
+
+def neighbourhood(adjacency, target, hops):
+    # The nodes within 'hops' steps from the target in the dependency graph: {node: distance}, breadth-first.
+    distances = {target: 0}
+    frontier = [target]
+    for distance in range(1, hops+1):
+        next_frontier = []
+        for node in frontier:
+            for neighbour, _ in adjacency.get(node, ()):
+                if neighbour not in distances:
+                    distances[neighbour] = distance
+                    next_frontier.append(neighbour)
+        frontier = next_frontier
+    return distances
+
+
+def mask_indices(adjacency, target, mask_sets, relation_labels, allowed_relations=None):
+    """
+    The masked token indices of a row for all the mask sets at once.
+
+    Args:
+        adjacency: the dependency graph of the sentence (see 'UDTreebank.adjacency')
+        target (int): the index of the target word
+        mask_sets (list of strings): the names of the mask sets (see above)
+        relation_labels (list of strings): the relation labels of the relation ids of the graph
+        allowed_relations (set of strings): the relation labels of the 'relations' sets (all labels if not given)
+    Returns:
+        dict: {mask set name: sorted list of the masked indices}, only the non-empty sets
+    """
+    masks = {}
+    neighbours = adjacency.get(target, ())
+    for mask_set in mask_sets:
+        if mask_set == "target":
+            masks[mask_set] = [target]
+        elif mask_set == "all":
+            masks[mask_set] = sorted({neighbour for neighbour, _ in neighbours})
+        elif mask_set == "relations":
+            for neighbour, rela in neighbours:
+                relation = relation_labels[rela]
+                if allowed_relations is None or relation in allowed_relations:
+                    masks.setdefault(relation_mask_name(relation), set()).add(neighbour)
+        else:
+            hops = int(mask_set[len(HOP_MASK_PREFIX):])
+            masks[mask_set] = sorted(node for node, distance in neighbourhood(adjacency, target, hops).items() if distance > 0)
+    return {name: sorted(indices) for name, indices in masks.items() if indices}
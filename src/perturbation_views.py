@@ -0,0 +1,137 @@
+import os
+import threading
+import numpy as np
+
+from utils import rootdir_dep_tree_ext, dataset_tsv_path, tags_from_path
+from dataset_io import open_dataset
+from perturbation import sample_random_indices, task_rng, neighbourhood, RANDOM_MODES
+from datagen import load_ud_data
+
+
+"""
+Perturbation views: the perturbed datasets computed from the extended datasets at read time, in memory,
+instead of being generated and written to disk (see 'DATASET_VARIANTS'). A view is described by a spec
+of comma separated settings, given as the data type 'view:<spec>' (e.g. 'probe --data_type view:hops=2'):
+    target              mask the target word only
+    hops=<k>            mask the k-hop deptree neighbourhood of the target word (default: 1, the parent and children)
+    relations=<a>+<b>   follow only the deptree edges with these relation labels (e.g. relations=nsubj+obj)
+    random=<mode>       a random index instead of the deptree neighbours, 'uniform' or 'distance'
+    seed=<int>          the seed of the random indices, a non-negative integer
+The rows of the views are the same as the ones of the generated variants: the masked views give the rows
+of 'masked_variant' (e.g. 'hops=2' the 'hop2' mask set), the random views the rows of 'random_variant'
+(the same indices with the same seed).
+"""
+VIEW_DATA_TYPE_PREFIX = "view:"
+
+# The UD data of the masked views: {language: UDTreebank}, only the last language is kept.
+_view_ud_data = {}
+# The views are read by the parallel training jobs (see 'training'), the UD data of a language is loaded once.
+_view_ud_data_lock = threading.Lock()
+
+
+def view_ud_treebank(language):
+    # The deptree graphs of the masked views come from the (cached) parsed UD data, see 'load_ud_data'.
+    # The jobs of the same language are run together (see 'lpt_schedule'), the data is loaded by the first one.
+    with _view_ud_data_lock:
+        if language not in _view_ud_data:
+            _view_ud_data.clear()
+            _view_ud_data[language] = load_ud_data(language)
+        return _view_ud_data[language]
+
+
+class PerturbationView:
+    """
+    A perturbation applied to the rows of the extended datasets when they are read (see the module description).
+
+        view = PerturbationView("hops=2,relations=nsubj+obj")
+        for line in view.lines("datasets/dep_tree/.../train.tsv"):
+            ...
+
+    Args:
+        spec (str): the comma separated settings of the view.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.target = False
+        self.hops = 1
+        self.relations = None
+        self.random_mode = None
+        self.seed = None
+        for setting in filter(None, spec.split(",")):
+            name, _, value = setting.partition("=")
+            if name == "target" and not value:
+                self.target = True
+            elif name == "hops" and value.isdigit() and int(value) > 0:
+                self.hops = int(value)
+            elif name == "relations" and value:
+                self.relations = set(value.split("+"))
+            elif name == "random" and value in RANDOM_MODES:
+                self.random_mode = value
+            elif name == "seed" and value.isdigit():
+                self.seed = int(value)
+            else:
+                raise Exception(f"Invalid perturbation view setting: '{setting}' (in '{spec}')")
+
+    def uses_ud_data(self):
+        # The masked views read the deptree graphs of the UD data (see 'view_ud_treebank').
+        return self.random_mode is None and not self.target
+
+    def lines(self, file_path):
+        """
+        The lines of the perturbed dataset, in the TSV format of the datasets.
+
+        Args:
+            file_path (str): an extended dataset of any format and layout (see 'open_dataset').
+        """
+        rows = [line.rstrip("\n").split("\t") for line in open_dataset(file_path)]
+        if self.random_mode is not None:
+            perturbed_rows = self.random_rows(file_path, rows)
+        else:
+            perturbed_rows = self.masked_rows(file_path, rows)
+        for row_data in perturbed_rows:
+            yield '\t'.join(map(str, row_data))+'\n'
+
+    def random_rows(self, file_path, rows):
+        # The random indices are drawn like by 'random_variant', for the morph. probe path of the dataset.
+        morph_path = os.path.relpath(os.path.abspath(dataset_tsv_path(file_path)), os.path.abspath(rootdir_dep_tree_ext()))
+        sentence_lengths = np.array([len(row_data[0].split()) for row_data in rows], dtype=np.int64)
+        target_indices = np.array([int(row_data[2]) for row_data in rows], dtype=np.int64)
+        distances = np.array([int(row_data[4]) for row_data in rows], dtype=np.int64)
+        random_indices = sample_random_indices(sentence_lengths, target_indices, distances, self.random_mode, 1,
+                                               task_rng(self.seed, morph_path))
+        return [row_data[:4]+[random_idx,'_','_','_'] for row_data, random_idx in zip(rows, random_indices[:, 0].tolist())]
+
+    def masked_rows(self, file_path, rows):
+        # The rows without masked tokens are left out, like by 'masked_variant'.
+        language = tags_from_path(file_path).split("/")[1]
+        ud_treebank = view_ud_treebank(language) if self.uses_ud_data() else None
+        missing_count = 0
+        for row_data in rows:
+            target = int(row_data[2])
+            if self.target:
+                yield row_data[:4]+[target,'_','_','_']
+                continue
+            sentence_id = ud_treebank.token_sentence_id(row_data[0])
+            if sentence_id is None:
+                missing_count += 1
+                continue
+            indices = self.mask_indices(ud_treebank, sentence_id, target)
+            if indices:
+                yield row_data[:4]+[" ".join(map(str, indices)),'_','_','_']
+        if missing_count:
+            print(f"WARNING! {missing_count} sentences of {file_path} were not found in the UD data of {language}.")
+
+    def mask_indices(self, ud_treebank, sentence_id, target):
+        adjacency = ud_treebank.adjacency(sentence_id)
+        if self.relations is not None:
+            labels = ud_treebank.relations.items
+            adjacency = {node: [(neighbour, rela) for neighbour, rela in edges if labels[rela] in self.relations]
+                         for node, edges in adjacency.items()}
+        return sorted(node for node, distance in neighbourhood(adjacency, target, self.hops).items() if distance > 0)
+
+
+def perturbation_view(data_type):
+    # The perturbation view of a data type ('view:<spec>'), None for the other data types.
+    if data_type.startswith(VIEW_DATA_TYPE_PREFIX):
+        return PerturbationView(data_type[len(VIEW_DATA_TYPE_PREFIX):])
+    return None
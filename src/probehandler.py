@@ -2,10 +2,18 @@ import os
 import subprocess
 import shlex
 import yaml
+import json
+import time
+import heapq
+import collections
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser
 
 from utils import *
+from dataset_io import DatasetStream, open_dataset
+from perturbation_views import perturbation_view
 
 
 
@@ -16,7 +24,7 @@ def get_paths(orig = False):
         rootdir = 'output/morphology_probes/data/'
     print(f"Geting data paths from: {rootdir}")
     path_pairs = []
-    for subroot, dirs, files in [x for x in os.walk(rootdir)]:
+    for subroot, dirs, files in catalog_walk(rootdir):
         if not dirs:
             train_name = "train.tsv"
             dev_name = "dev.tsv"
@@ -28,13 +36,14 @@ def get_paths(orig = False):
     return path_pairs
 
 
-def compare_results(result_path, test_path):
+def compare_results(result_path, test_path, view=None):
     #TODO open the files and compute the accuracy of the inference
     result_file = open(result_path, "r")
-    test_file = open(test_path, "r")
+    # The test file may be compressed (see 'open_dataset'), or perturbed at read time (see 'PerturbationView').
+    test_file = view.lines(test_path) if view is not None else open_dataset(test_path)
 
     resultdata = result_file.readlines()
-    testdata = test_file.readlines()
+    testdata = list(test_file)
     correct_counter = 0
     for i, line in enumerate(resultdata):
         res_line = resultdata[i]
@@ -55,6 +64,7 @@ def inference(tags: str, data_type: str, config = "default", posthoc: bool = Fal
     #model_accuracies = {}
     #print(tags, data_type, config)
     rootdir = data_rootdir(data_type)
+    view = perturbation_view(data_type)
     config_path = model_config_path(config)
     experiment_dir = extract_experiment_dir(config_path)
 
@@ -72,10 +82,11 @@ def inference(tags: str, data_type: str, config = "default", posthoc: bool = Fal
         if train_path_tags in train_exp_path_pairs:
             try:
                 exp_dir_path = train_exp_path_pairs[train_path_tags]
-                inference_command = f"python probing/src/probing/inference.py --experiment-dir {exp_dir_path} --test-file {test_path} > {tmp_result_filename}"
-                print(f"{idx+1}/{len(path_triplets)} Inference. Running command:\n    {inference_command}")
-                
-                subprocess.run(inference_command, shell=True)
+                with DatasetStream(test_path, dataset_stream_dir(), view) as test_file:
+                    inference_command = f"python probing/src/probing/inference.py --experiment-dir {exp_dir_path} --test-file {test_file} > {tmp_result_filename}"
+                    print(f"{idx+1}/{len(path_triplets)} Inference. Running command:\n    {inference_command}")
+
+                    subprocess.run(inference_command, shell=True)
 
             except Exception as err:
                 print(f"Unexpected {err=}, {type(err)=}")
@@ -90,7 +101,7 @@ def inference(tags: str, data_type: str, config = "default", posthoc: bool = Fal
 
             # extended/random | TEST_DATA/POSTHOC | English | number_noun | bert-base-multilingual-cased | 98.7485779294653
             test_type = "posthoc" if posthoc else "test_data"
-            acc = compare_results(tmp_result_filename, test_path)
+            acc = compare_results(tmp_result_filename, test_path, view)
             #print(f"{data_type} {test_type} {language} {morph} {pos} {model_name} {acc}")
             
             #This block is for saving the data into a text file after every inference
@@ -111,7 +122,9 @@ def inference(tags: str, data_type: str, config = "default", posthoc: bool = Fal
             elif data_type == "random":
                 acc_pair[2] = acc
             else:
-                raise Exception(f"Unknown input data type provided: {data_type}")
+                # The statistics file has columns for the three main data types only (masked sets, views).
+                print(f"    Accuracy on {data_type}: {acc}")
+                continue
 
             saved_data[meta_data_key] = acc_pair
 
@@ -119,27 +132,194 @@ def inference(tags: str, data_type: str, config = "default", posthoc: bool = Fal
         
 
 
-def training(tags: str, data_type: str, config = "default"):
-    
+def run_training_job(job_number, job_count, train_path, dev_path, config_path, view, log_path):
+    """
+    Run the training script of a task, its output is written to the log file,
+    the errors of running it (e.g. of reading the streamed datasets, see 'DatasetStream') are appended to the log.
+
+    Returns:
+        pair: the exit code of the script (None if it could not be started) and the error message (or None)
+    """
+    train_command = f"python probing/src/probing/train.py --config {config_path}"
+    try:
+        create_dir_if_needed(os.path.dirname(log_path))
+        # The compressed datasets and the perturbation views are streamed to the training script (see 'DatasetStream').
+        with DatasetStream(train_path, dataset_stream_dir(), view) as train_file, DatasetStream(dev_path, dataset_stream_dir(), view) as dev_file, \
+             open(log_path, "w", encoding="utf-8") as log_file:
+            train_command += f"  --train-file {train_file}  --dev-file {dev_file}"
+            print(f"{job_number}/{job_count} Training. Running command:\n    {train_command}\n    Log: {log_path}")
+            completed = subprocess.run(train_command, shell=True, stdout=log_file, stderr=subprocess.STDOUT)
+        return completed.returncode, None
+    except Exception as err:
+        error = f"Unexpected {err=}, {type(err)=}\nFailed to run command: {train_command}"
+        if os.path.isdir(os.path.dirname(log_path)):
+            with open(log_path, "a", encoding="utf-8") as log_file:
+                log_file.write(f"\n{error}\n")
+        return None, error
+
+
+"""
+Scheduling of the training jobs: the cost of a job is estimated from the size of its training data
+(rows x average sentence length, in tokens) and from the runtimes of the earlier runs (see 'training_history_path'),
+the longest jobs are started first (LPT), so that no long job is left to run alone at the end of the campaign.
+"""
+_training_history_lock = threading.Lock()
+
+
+def load_training_history():
+    # The runtimes of the successful training jobs: {job key: {"seconds": float, "tokens": int}}
+    history_path = training_history_path()
+    if not os.path.isfile(history_path):
+        return {}
+    with open(history_path, "r", encoding="utf-8") as history_file:
+        return json.load(history_file)
+
+
+def record_training_runtime(job_key, seconds, tokens):
+    # Called from the job threads, the history file is rewritten atomically.
+    with _training_history_lock:
+        history = load_training_history()
+        history[job_key] = {"seconds": seconds, "tokens": tokens}
+        create_dir_if_needed(os.path.dirname(training_history_path()))
+        with atomic_write(training_history_path()) as tmp_path:
+            with open(tmp_path, "w", encoding="utf-8") as history_file:
+                json.dump(history, history_file, indent=1)
+
+
+def training_job_key(config_path, data_type, train_path):
+    # The runtime of a job depends on the configuration (model, epochs), the data type and the task.
+    return "|".join([config_path, data_type, os.path.dirname(tags_from_path(train_path))])
+
+
+def training_data_size(train_path):
+    # The number of rows and tokens (space separated) of a training file of any format.
+    rows = 0
+    tokens = 0
+    for line in open_dataset(train_path):
+        rows += 1
+        tokens += len(line.split("\t", 1)[0].split())
+    return rows, tokens
+
+
+def estimate_training_costs(job_keys, job_tokens, history):
+    """
+    Estimate the runtime of the jobs in seconds: a job that ran before takes the same time per token as then,
+    the others the average time per token of the earlier runs of the same configuration.
+    Without any earlier runs the costs are the number of tokens.
+
+    Returns:
+        pair: the estimated costs and their unit ('s' or 'tokens')
+    """
+    config_runs = {}
+    for key, run in history.items():
+        config_seconds, config_tokens = config_runs.get(key.split("|")[0], (0.0, 0))
+        config_runs[key.split("|")[0]] = (config_seconds + run["seconds"], config_tokens + run["tokens"])
+    all_seconds = sum(run["seconds"] for run in history.values())
+    all_tokens = sum(run["tokens"] for run in history.values())
+    if not all_tokens:
+        return list(map(float, job_tokens)), "tokens"
+
+    costs = []
+    for key, tokens in zip(job_keys, job_tokens):
+        run = history.get(key)
+        if run and run["tokens"]:
+            costs.append(run["seconds"] * tokens / run["tokens"])
+            continue
+        config_seconds, config_tokens = config_runs.get(key.split("|")[0], (0.0, 0))
+        seconds_per_token = config_seconds / config_tokens if config_tokens else all_seconds / all_tokens
+        costs.append(seconds_per_token * tokens)
+    return costs, "s"
+
+
+def lpt_schedule(costs, workers, groups=None):
+    """
+    Longest processing time first: the job order and the predicted makespan of running the jobs
+    on 'workers' parallel workers, each worker taking the next job when it is free.
+    With 'groups' (the group of every job, e.g. its language) the jobs of a group are started one after
+    the other, the groups with the largest total cost first, the longest jobs of a group first.
+
+    Returns:
+        triplet: the job indices in the order they are started, the predicted makespan and the load of each worker
+    """
+    order = sorted(range(len(costs)), key=lambda job_id: -costs[job_id])
+    if groups is not None:
+        group_costs = collections.Counter()
+        for job_id, group in enumerate(groups):
+            group_costs[group] += costs[job_id]
+        # The sort is stable, the jobs of a group stay in LPT order.
+        order.sort(key=lambda job_id: (-group_costs[groups[job_id]], groups[job_id]))
+    loads = [0.0] * max(1, workers)
+    worker_heap = [(0.0, worker_id) for worker_id in range(len(loads))]
+    for job_id in order:
+        load, worker_id = heapq.heappop(worker_heap)
+        loads[worker_id] = load + costs[job_id]
+        heapq.heappush(worker_heap, (loads[worker_id], worker_id))
+    return order, max(loads), loads
+
+
+def format_cost(cost, unit):
+    if unit == "s":
+        return f"{int(cost)//3600}h {int(cost)%3600//60:02d}m {int(cost)%60:02d}s"
+    return f"{cost:.0f} tokens"
+
+
+def training(tags: str, data_type: str, config = "default", workers = 1, plan = False):
+    """
+    Train the probes of the selected datasets, one training job per (train, dev) pair,
+    running at most 'workers' jobs at a time, the longest jobs first (see 'lpt_schedule').
+    The output of every job is written to its own log file (see 'training_log_path'),
+    a summary of the failed jobs is printed at the end.
+
+    Args:
+        plan: only print the job order and the predicted makespan, without training.
+    Returns:
+        list of (train path, exit code) pairs, the exit code is None if the job could not be run
+        (e.g. its datasets could not be streamed, see 'run_training_job').
+    """
     rootdir = data_rootdir(data_type)
+    view = perturbation_view(data_type)
     config_path = model_config_path(config)
         
-    path_triplets = dataset_paths(rootdir, tags)
-    folder_num = len(path_triplets)
-    folder_counter = 1
+    path_triplets = [tuple(map(os.path.abspath, triplet)) for triplet in dataset_paths(rootdir, tags)]
+    job_count = len(path_triplets)
+    job_keys = [training_job_key(config_path, data_type, train_path) for train_path, _, _ in path_triplets]
+    job_sizes = [training_data_size(train_path) for train_path, _, _ in path_triplets]
+    costs, unit = estimate_training_costs(job_keys, [tokens for _, tokens in job_sizes], load_training_history())
+    # The jobs of the views reading the UD data are grouped by language, so that the jobs running at
+    # the same time share the UD data of their language (see 'view_ud_treebank').
+    languages = [tags_from_path(train_path).split("/")[1] for train_path, _, _ in path_triplets]
+    order, makespan, loads = lpt_schedule(costs, workers, languages if view is not None and view.uses_ud_data() else None)
 
-    for triplet in path_triplets:
+    print(f"Training {job_count} probe(s) with {workers} parallel job(s), the longest first. Predicted makespan: {format_cost(makespan, unit)}")
+    if plan:
+        for job_number, job_id in enumerate(order, 1):
+            rows, tokens = job_sizes[job_id]
+            print(f"    {job_number}/{job_count} {os.path.dirname(tags_from_path(path_triplets[job_id][0]))}: "
+                  f"{rows} rows, {tokens/rows if rows else 0:.1f} tokens/sentence, estimated {format_cost(costs[job_id], unit)}")
+        print(f"    Total: {format_cost(sum(costs), unit)}, per worker: {', '.join(format_cost(load, unit) for load in loads)}")
+        if unit != "s":
+            print("    No runtimes recorded yet, the costs are the number of training tokens.")
+        return []
 
-        train_path, dev_path, test_path = tuple(map(os.path.abspath, triplet))
-        
-        try:
-            train_command = f"python probing/src/probing/train.py --config {config_path}"
-            train_command += f"  --train-file {train_path}  --dev-file {dev_path}"
-            print(f"{folder_counter}/{folder_num} Training. Running command:")
-            print(f"    {train_command}")
-            subprocess.run(train_command, shell=True)
-            print("Train scripts executed.")
-            folder_counter+=1
-
-        except Exception as err:
-            print(f"Unexpected {err=}, {type(err)=}\nFailed to run command: {train_command}")
+    def run_job(job_number, job_id):
+        train_path, dev_path, test_path = path_triplets[job_id]
+        log_path = training_log_path(data_type, train_path)
+        start_time = time.monotonic()
+        returncode, error = run_training_job(job_number, job_count, train_path, dev_path, config_path, view, log_path)
+        if returncode == 0:
+            record_training_runtime(job_keys[job_id], time.monotonic()-start_time, job_sizes[job_id][1])
+            print(f"{job_number}/{job_count} Train script executed.")
+        else:
+            print(error if error else f"{job_number}/{job_count} Train script failed (exit code: {returncode}), see the log: {log_path}")
+        return train_path, returncode, error, log_path
+
+    # The pool starts the jobs in the order they are submitted.
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(run_job, range(1, job_count+1), order))
+
+    failures = [result for result in results if result[1] != 0]
+    print(f"\nTraining finished: {job_count-len(failures)}/{job_count} succeeded, {len(failures)} failed.")
+    for train_path, returncode, error, log_path in failures:
+        reason = f"exit code: {returncode}" if returncode is not None else "failed to run"
+        print(f"    FAILED ({reason}): {os.path.dirname(tags_from_path(train_path))}, log: {log_path}")
+    return [(train_path, returncode) for train_path, returncode, _, _ in results]
@@ -0,0 +1,182 @@
+import json
+import os
+import numpy as np
+
+from treebank import Vocabulary
+from utils import relation_counts_dir, create_dir_if_needed, atomic_write, output_signature
+from dataset_io import open_dataset
+
+
+# The node distance histograms cover [-MAX_HISTOGRAM_DISTANCE, MAX_HISTOGRAM_DISTANCE],
+# the longer distances are counted in the first and the last bin.
+MAX_HISTOGRAM_DISTANCE = 20
+# Pseudo count of the relations of the reference distribution (KL divergence), so that the
+# relations missing from the reference do not give an infinite divergence.
+REFERENCE_SMOOTHING = 0.5
+
+
+class RelationCounts:
+    """
+    Deptree relation label counts and node distance histogram of a dataset (or of the UD treebank of a language).
+    The labels are interned in a vocabulary that can be shared by several counts, so that the count vectors
+    of the same vocabulary are aligned (see 'vector').
+
+    Args:
+        relations (Vocabulary): the shared relation vocabulary (a new one if not given)
+    """
+    def __init__(self, relations=None):
+        self.relations = relations if relations is not None else Vocabulary()
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.distances = np.zeros(2*MAX_HISTOGRAM_DISTANCE+1, dtype=np.int64)
+
+    def add(self, relation_ids, distances):
+        """
+        Count a batch of rows.
+
+        Args:
+            relation_ids (array of ints): the relation of every row, as ids of the vocabulary.
+            distances (array of ints): the node distance of every row.
+        """
+        relation_counts = np.bincount(np.asarray(relation_ids, dtype=np.int64), minlength=len(self.relations))
+        self.counts = self.vector() + relation_counts
+        distance_bins = np.clip(np.asarray(distances, dtype=np.int64), -MAX_HISTOGRAM_DISTANCE, MAX_HISTOGRAM_DISTANCE)
+        self.distances += np.bincount(distance_bins+MAX_HISTOGRAM_DISTANCE, minlength=len(self.distances))
+
+    def add_labels(self, labels, distances):
+        self.add([self.relations.add(label) for label in labels], distances)
+
+    def merge(self, other):
+        # Add the counts of another RelationCounts (with any vocabulary).
+        if other.relations is self.relations:
+            relation_ids = np.arange(len(other.counts))
+        else:
+            relation_ids = np.array([self.relations.add(label) for label in other.relations.items[:len(other.counts)]], dtype=np.int64)
+        counts = self.vector()
+        np.add.at(counts, relation_ids, other.counts)
+        self.counts = counts
+        self.distances += other.distances
+
+    def vector(self):
+        # The relation counts aligned to the current size of the vocabulary.
+        return np.pad(self.counts, (0, len(self.relations)-len(self.counts)))
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def to_json(self):
+        return {"relations": {self.relations[idx]: int(count) for idx, count in enumerate(self.counts.tolist()) if count},
+                "distances": self.distances.tolist()}
+
+    @classmethod
+    def from_json(cls, data, relations=None):
+        relation_counts = cls(relations)
+        relation_ids = [relation_counts.relations.add(label) for label in data["relations"]]
+        counts = relation_counts.vector()
+        counts[relation_ids] = list(data["relations"].values())
+        relation_counts.counts = counts
+        relation_counts.distances = np.array(data["distances"], dtype=np.int64)
+        return relation_counts
+
+    @classmethod
+    def from_treebank(cls, ud_treebank, row_ids=None, relations=None):
+        """
+        The counts of the token rows of a UDTreebank (all of them, or the given rows).
+        """
+        relation_counts = cls(relations)
+        row_ids = row_ids if row_ids is not None else slice(None)
+        relation_ids = np.array([relation_counts.relations.add(label) for label in ud_treebank.relations.items], dtype=np.int64)
+        distances = ud_treebank.head_idx[row_ids] - ud_treebank.token_idx[row_ids]
+        relation_counts.add(relation_ids[ud_treebank.rela[row_ids]], distances)
+        return relation_counts
+
+    @classmethod
+    def from_dataset(cls, file_path, relations=None):
+        """
+        The counts of an extended dataset file of any format (see 'open_dataset'), streaming its rows.
+        """
+        relation_counts = cls(relations)
+        relation_ids = []
+        distances = []
+        for line in open_dataset(file_path):
+            row_data = line.rstrip("\n").split("\t")
+            relation_ids.append(relation_counts.relations.add(row_data[7]))
+            distances.append(int(row_data[4]))
+        relation_counts.add(relation_ids, distances)
+        return relation_counts
+
+
+def probability_vector(counts, smoothing=0.0):
+    counts = counts.astype(np.float64) + smoothing
+    total = counts.sum()
+    return counts / total if total > 0 else counts
+
+
+def kl_divergence(counts, reference_counts):
+    # KL(P || Q) in bits, the reference distribution Q is smoothed (see 'REFERENCE_SMOOTHING') over all entries
+    # of the count vectors, so the vectors should cover the relations of a single language only.
+    p = probability_vector(counts)
+    q = probability_vector(reference_counts, REFERENCE_SMOOTHING)
+    support = p > 0
+    return float(np.sum(p[support] * np.log2(p[support] / q[support])))
+
+
+def js_divergence(counts, reference_counts):
+    # Jensen-Shannon divergence in bits (symmetric, at most 1).
+    p = probability_vector(counts)
+    q = probability_vector(reference_counts)
+    m = (p + q) / 2
+    def kl_to_m(x):
+        support = x > 0
+        return float(np.sum(x[support] * np.log2(x[support] / m[support])))
+    return (kl_to_m(p) + kl_to_m(q)) / 2
+
+
+"""
+The counts of the generated datasets are saved when the datasets are written (see 'save_dataset_relation_counts'),
+the datasets without saved counts (or modified since) are streamed.
+"""
+def dataset_counts_path(file_path):
+    return os.path.join(relation_counts_dir(), os.path.relpath(file_path)+".json")
+
+
+def save_dataset_relation_counts(file_path, relation_counts):
+    counts_path = dataset_counts_path(file_path)
+    create_dir_if_needed(os.path.dirname(counts_path))
+    with atomic_write(counts_path) as tmp_path:
+        with open(tmp_path, "w", encoding="utf-8") as counts_file:
+            json.dump(dict(relation_counts.to_json(), signature=output_signature(file_path)), counts_file)
+
+
+def dataset_relation_counts(file_path, relations=None):
+    # The saved counts of a dataset if it was not modified since, otherwise the counts of its rows.
+    counts_path = dataset_counts_path(file_path)
+    if os.path.isfile(counts_path):
+        with open(counts_path, "r", encoding="utf-8") as counts_file:
+            data = json.load(counts_file)
+        if data["signature"] == output_signature(file_path):
+            return RelationCounts.from_json(data, relations)
+    relation_counts = RelationCounts.from_dataset(file_path, relations)
+    save_dataset_relation_counts(file_path, relation_counts)
+    return relation_counts
+
+
+def ud_relation_counts(language, cache_key, load_treebank, relations=None):
+    """
+    The counts of all tokens of the UD treebank of a language (the reference distribution),
+    saved with the fingerprint of the UD files (see 'ud_cache_key').
+
+    Args:
+        load_treebank (function): returns the UDTreebank of the language, called only if the counts are not saved.
+    """
+    counts_path = os.path.join(relation_counts_dir(), "ud", language.lower()+".json")
+    if os.path.isfile(counts_path):
+        with open(counts_path, "r", encoding="utf-8") as counts_file:
+            data = json.load(counts_file)
+        if data["cache_key"] == cache_key:
+            return RelationCounts.from_json(data, relations)
+    relation_counts = RelationCounts.from_treebank(load_treebank(), relations=relations)
+    create_dir_if_needed(os.path.dirname(counts_path))
+    with atomic_write(counts_path) as tmp_path:
+        with open(tmp_path, "w", encoding="utf-8") as counts_file:
+            json.dump(dict(relation_counts.to_json(), cache_key=cache_key), counts_file)
+    return relation_counts
@@ -5,6 +5,8 @@ import yaml
 
 from utils import *
 from datagen import *
+from treebank import Vocabulary
+from relation_stats import MAX_HISTOGRAM_DISTANCE, RelationCounts, dataset_relation_counts, ud_relation_counts, kl_divergence, js_divergence
 
 
 def get_inference_stats():
@@ -91,6 +93,53 @@ def get_dev_stats():
     output_file.close()
 
 
+def get_relation_statistics(tags="All,All"):
+    """
+    Compare the deptree relation label distribution of the extended datasets with the one of the UD treebank of their language.
+    The KL and JS divergences (in bits) are computed per task and per language (all tasks of the language),
+    the node distance histograms are written as well. The counts of the datasets are saved when they are generated,
+    the other datasets are streamed once (see 'dataset_relation_counts').
+    Each language has its own relation vocabulary: the reference distribution is smoothed over the relations
+    of the datasets and the UD treebank of the language, independently of the other languages.
+    """
+    divergence_rows = []
+    histogram_rows = []
+    path_triplets = dataset_paths(rootdir_dep_tree_ext(), tags)
+    for lang, datalist in group_paths_on_language(path_triplets).items():
+        relations = Vocabulary()
+        ud_data_paths = list(conllu_file_path_loader(lang))
+        ud_counts = ud_relation_counts(lang, ud_cache_key(ud_data_paths), lambda: load_ud_data(lang), relations)
+        language_counts = RelationCounts(relations)
+        task_rows = []
+        for morph_pos, path_triplet in datalist:
+            task_counts = RelationCounts(relations)
+            for path in path_triplet:
+                if path:
+                    task_counts.merge(dataset_relation_counts(path, relations))
+            language_counts.merge(task_counts)
+            task_rows.append((morph_pos, task_counts))
+
+        for morph_pos, counts in [("All", language_counts)] + task_rows:
+            kl = kl_divergence(counts.vector(), ud_counts.vector())
+            js = js_divergence(counts.vector(), ud_counts.vector())
+            print(f"{lang}\t{morph_pos}\trows: {counts.total()}\tKL: {kl:.4f}\tJS: {js:.4f}")
+            divergence_rows.append([lang, morph_pos, counts.total(), ud_counts.total(), f"{kl:.6f}", f"{js:.6f}"])
+            histogram_rows.append([lang, morph_pos] + counts.distances.tolist())
+        histogram_rows.append([lang, "UD"] + ud_counts.distances.tolist())
+
+    with open(relation_divergence_file_name(), "w", encoding="utf-8") as divergence_file:
+        divergence_file.write("language\tmorph_pos\trows\tud_rows\tkl\tjs\n")
+        for row in divergence_rows:
+            divergence_file.write("\t".join(map(str, row))+"\n")
+    with open(distance_histogram_file_name(), "w", encoding="utf-8") as histogram_file:
+        # The first and last bins contain the longer distances too.
+        distance_bins = range(-MAX_HISTOGRAM_DISTANCE, MAX_HISTOGRAM_DISTANCE+1)
+        histogram_file.write("language\tmorph_pos\t" + "\t".join(map(str, distance_bins)) + "\n")
+        for row in histogram_rows:
+            histogram_file.write("\t".join(map(str, row))+"\n")
+    print(f"Relation statistics written to: {relation_divergence_file_name()}, {distance_histogram_file_name()}")
+
+
 def get_statistics():
     #get_inference_stats()
     get_dev_stats()
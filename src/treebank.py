@@ -0,0 +1,305 @@
+import array
+import numpy as np
+
+from utils import clean_string, sentence_key_hash
+
+
+class Vocabulary:
+    """
+    Interned strings: every distinct string is stored once and referred to by an integer id.
+    """
+    def __init__(self, items=()):
+        self.items = []
+        self.ids = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        idx = self.ids.get(item)
+        if idx is None:
+            idx = len(self.items)
+            self.ids[item] = idx
+            self.items.append(item)
+        return idx
+
+    def __getitem__(self, idx):
+        return self.items[idx]
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getstate__(self):
+        # The id lookup is rebuilt on load, it is not worth pickling.
+        return self.items
+
+    def __setstate__(self, items):
+        self.items = []
+        self.ids = {}
+        for item in items:
+            self.add(item)
+
+
+class SentenceKeyIndex:
+    """
+    Lookup of the UD sentences by their character-simplified form (see the 'clean_string' function).
+    If the same key occurs more than once, the last sentence wins.
+
+    With 'hash_keys' the index is keyed by the 64-bit hash of the keys (see 'sentence_key_hash'), the keys
+    themselves are not kept in memory. Every hit is verified with a full-string check, the sentences whose hash
+    collides with a different sentence are stored separately under their full key.
+    The subclasses implement 'raw_sentence_of(value)', which returns the character-simplified sentence of an
+    indexed value (e.g. 'UDTreebank.raw_sentence_of', 'ConlluIndex.raw_sentence_of').
+    """
+    def init_index(self, hash_keys):
+        self.hash_keys = hash_keys
+        self.index = {}
+        # {hash: {key: value}} for the keys whose hash collides with the key in the index
+        self.collisions = {}
+
+    def set_key(self, raw_sentence, value):
+        if not self.hash_keys:
+            self.index[raw_sentence] = value
+            return
+        key = sentence_key_hash(raw_sentence)
+        if key in self.index and not self.raw_sentence_of(self.index[key]) == raw_sentence:
+            self.collisions.setdefault(key, {})[raw_sentence] = value
+        else:
+            self.index[key] = value
+
+    def index_key(self, key):
+        # Hashed keys: the full keys are hashed, the hashes are kept.
+        if self.hash_keys and isinstance(key, str):
+            return sentence_key_hash(key)
+        return key
+
+    def lookup(self, key, get_raw_sentence=None):
+        """
+        Return the indexed value of the key, None if it is not found.
+
+        Args:
+            key: the character-simplified sentence, or its hash (see 'sentence_key_hash') if the keys are hashed.
+            get_raw_sentence (function): returns the character-simplified sentence of a hashed key,
+                                         it is called only for the full-string check of a hit.
+        """
+        if not self.hash_keys:
+            return self.index.get(key)
+        raw_sentence = key if isinstance(key, str) else None
+        key = self.index_key(key)
+        value = self.index.get(key)
+        if value is None:
+            return None
+        if raw_sentence is None:
+            raw_sentence = get_raw_sentence()
+        if self.raw_sentence_of(value) == raw_sentence:
+            return value
+        return self.collisions.get(key, {}).get(raw_sentence)
+
+    def raw_sentences(self):
+        # All the indexed character-simplified sentences (e.g. for the fuzzy matching, see 'MinHashIndex').
+        if not self.hash_keys:
+            return list(self.index)
+        return [self.raw_sentence_of(value) for value in self.index.values()] + \
+               [raw_sentence for collisions in self.collisions.values() for raw_sentence in collisions]
+
+    def __contains__(self, raw_sentence):
+        return self.lookup(raw_sentence) is not None
+
+    def __len__(self):
+        return len(self.index) + sum(map(len, self.collisions.values()))
+
+
+class UDTreebank(SentenceKeyIndex):
+    """
+    Columnar storage of the parsed UD sentences of a language.
+
+    The token data (see 'process_ud_sentence') of all sentences is stored in NumPy int arrays,
+    one entry per token, the strings are interned in vocabularies:
+        form        id of the word form (forms)
+        token_idx   index of the token in the sentence
+        pos         id of the PoS tag (pos_tags)
+        feats       id of the FEATS string (feats)
+        head_form   id of the word form of the parent node (forms)
+        head_idx    index of the parent node in the sentence
+        rela        id of the deptree relation (relations)
+    The tokens of the i-th sentence are the rows offsets[i]:offsets[i+1].
+
+    The sentences are looked up by their character-simplified form (see 'SentenceKeyIndex').
+    """
+    COLUMNS = ("form", "token_idx", "pos", "feats", "head_form", "head_idx", "rela")
+
+    def __init__(self, hash_keys=False):
+        self.init_index(hash_keys)
+        self.token_sentences = []
+        self.orig_sentences = []
+        self.forms = Vocabulary()
+        self.pos_tags = Vocabulary()
+        self.feats_strings = Vocabulary()
+        self.relations = Vocabulary()
+        self._offsets = array.array("q", [0])
+        self._columns = {name: array.array("i") for name in self.COLUMNS}
+
+    def add_sentence(self, key, token_sentence, orig_sentence, data_lists):
+        """
+        Add a sentence in the format returned by 'process_ud_sentence'. Without a key the sentence is not indexed.
+        """
+        columns = self._columns
+        for w2, w2_idx, pos_tag, morph_tags, w1, w1_idx, rela in data_lists:
+            columns["form"].append(self.forms.add(w2))
+            columns["token_idx"].append(w2_idx)
+            columns["pos"].append(self.pos_tags.add(pos_tag))
+            columns["feats"].append(self.feats_strings.add(morph_tags))
+            columns["head_form"].append(self.forms.add(w1))
+            columns["head_idx"].append(w1_idx)
+            columns["rela"].append(self.relations.add(rela))
+        self._offsets.append(len(columns["form"]))
+
+        self.token_sentences.append(token_sentence)
+        self.orig_sentences.append(orig_sentence)
+        if key is not None:
+            self.set_key(key, len(self.token_sentences)-1)
+
+    def merge(self, other, keys):
+        """
+        Append all sentences of a frozen treebank (e.g. parsed from a chunk of a file, see 'parse_conllu_chunk'),
+        as if they were added one by one: the vocabulary ids are remapped, and the later sentences win
+        for duplicate keys.
+
+        Args:
+            other (UDTreebank): the frozen treebank to append.
+            keys (list of strings): the keys of the sentences of 'other', in order.
+        """
+        def id_map(vocabulary, other_vocabulary):
+            return np.array([vocabulary.add(item) for item in other_vocabulary.items], dtype=np.int32)
+        forms = id_map(self.forms, other.forms)
+        mapped_columns = {
+            "form": forms[other.form],
+            "token_idx": other.token_idx,
+            "pos": id_map(self.pos_tags, other.pos_tags)[other.pos],
+            "feats": id_map(self.feats_strings, other.feats_strings)[other.feats],
+            "head_form": forms[other.head_form],
+            "head_idx": other.head_idx,
+            "rela": id_map(self.relations, other.relations)[other.rela],
+        }
+        row_count = self._offsets[-1]
+        for name in self.COLUMNS:
+            self._columns[name].frombytes(mapped_columns[name].astype(np.int32).tobytes())
+        self._offsets.frombytes((other.offsets[1:] + row_count).astype(np.int64).tobytes())
+
+        for sentence_id, key in enumerate(keys):
+            self.token_sentences.append(other.token_sentences[sentence_id])
+            self.orig_sentences.append(other.orig_sentences[sentence_id])
+            if key is not None:
+                self.set_key(key, len(self.token_sentences)-1)
+
+    def raw_sentence_of(self, sentence_id):
+        return clean_string(self.orig_sentences[sentence_id])
+
+    def freeze(self):
+        """
+        Convert the collected token data into NumPy arrays. No sentences can be added afterwards.
+        """
+        self.offsets = np.array(self._offsets, dtype=np.int64)
+        for name in self.COLUMNS:
+            setattr(self, name, np.array(self._columns[name], dtype=np.int32))
+        del self._offsets
+        del self._columns
+        return self
+
+    def select(self, keys):
+        # All the sentences are in memory already (see 'ConlluIndex.select' for the lazy version).
+        return self
+
+    def token_rows(self, sentence_id):
+        return int(self.offsets[sentence_id]), int(self.offsets[sentence_id+1])
+
+    def feature_maps(self):
+        """
+        The FEATS strings parsed into {lowercase feature: value} maps, once per distinct FEATS string.
+        Like in 'get_morph_tag', the first value of a feature counts.
+        """
+        if getattr(self, "_feature_maps", None) is None:
+            self._feature_maps = []
+            for morph_tags in self.feats_strings.items:
+                feature_map = {}
+                for tag_pair in morph_tags.split("|"):
+                    if "=" in tag_pair:
+                        tag_type, tag_value = tag_pair.split("=", 1)
+                        feature_map.setdefault(tag_type.lower(), tag_value)
+                self._feature_maps.append(feature_map)
+        return self._feature_maps
+
+    def adjacency(self, sentence_id):
+        """
+        The dependency graph of a sentence as adjacency lists, built once per sentence from its token rows
+        (every row is an edge between the token and its parent node, the root has no row):
+            {token index: [(neighbour token index, relation id)]}, the edges are undirected.
+        """
+        if getattr(self, "_adjacency", None) is None:
+            self._adjacency = {}
+        adjacency = self._adjacency.get(sentence_id)
+        if adjacency is None:
+            adjacency = {}
+            start, end = self.token_rows(sentence_id)
+            edges = zip(self.token_idx[start:end].tolist(), self.head_idx[start:end].tolist(), self.rela[start:end].tolist())
+            for token_idx, head_idx, rela in edges:
+                adjacency.setdefault(token_idx, []).append((head_idx, rela))
+                adjacency.setdefault(head_idx, []).append((token_idx, rela))
+            self._adjacency[sentence_id] = adjacency
+        return adjacency
+
+    def token_sentence_id(self, token_sentence):
+        # The id of a sentence by its tokens joined with spaces (the sentence column of the datasets), None if not found.
+        if getattr(self, "_token_sentence_ids", None) is None:
+            self._token_sentence_ids = {sentence: idx for idx, sentence in enumerate(self.token_sentences)}
+        return self._token_sentence_ids.get(token_sentence)
+
+
+class MatchedRows:
+    """
+    The output rows selected from a UDTreebank, referring to its token rows.
+    Iterating yields the rows of the extended datasets:
+        [sentence, word, word_idx, morph_tag, node distance, parent_word, parent_idx, relation]
+
+    Args:
+        treebank (UDTreebank): the treebank the rows are selected from.
+        row_ids (array of ints): the selected token rows of the treebank.
+        feats_tags (list of strings): the morph. tag value of each FEATS string of the treebank.
+    """
+    def __init__(self, treebank, row_ids, feats_tags):
+        self.treebank = treebank
+        self.row_ids = np.asarray(row_ids, dtype=np.int64)
+        self.feats_tags = feats_tags
+        self.sentence_ids = np.searchsorted(treebank.offsets, self.row_ids, side="right") - 1
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    def __bool__(self):
+        return len(self.row_ids) > 0
+
+    def tags(self):
+        return [self.feats_tags[f] for f in self.treebank.feats[self.row_ids].tolist()]
+
+    def distances(self):
+        return self.treebank.head_idx[self.row_ids] - self.treebank.token_idx[self.row_ids]
+
+    def target_indices(self):
+        return self.treebank.token_idx[self.row_ids]
+
+    def sentence_lengths(self):
+        # The number of space separated tokens of the sentence of each row, every sentence is split only once.
+        unique_ids, inverse = np.unique(self.sentence_ids, return_inverse=True)
+        lengths = np.array([len(self.treebank.token_sentences[i].split()) for i in unique_ids.tolist()], dtype=np.int64)
+        return lengths[inverse]
+
+    def __iter__(self):
+        treebank = self.treebank
+        rows = self.row_ids
+        forms = treebank.forms.items
+        relations = treebank.relations.items
+        columns = zip(self.sentence_ids.tolist(), treebank.form[rows].tolist(), treebank.token_idx[rows].tolist(),
+                      self.tags(), self.distances().tolist(), treebank.head_form[rows].tolist(),
+                      treebank.head_idx[rows].tolist(), treebank.rela[rows].tolist())
+        for sentence_id, form, token_idx, tag, distance, head_form, head_idx, rela in columns:
+            yield [treebank.token_sentences[sentence_id], forms[form], token_idx, tag, distance,
+                   forms[head_form], head_idx, relations[rela]]
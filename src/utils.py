@@ -6,17 +6,31 @@ import tarfile
 import re
 import collections
 import yaml
+import io
+import time
+import hashlib
+import json
+import contextlib
 from unidecode import unidecode
 
-from git import Repo
+from git import Repo, GitCommandError
 from pathlib import Path
 
 
 
 
+NON_ALPHANUMERIC_PATTERN = re.compile('[^a-zA-Z0-9]')
+# The byte tables of 'clean_string': the uppercase letters are lowercased and the non-alphanumeric
+# characters are deleted in a single pass over the (transliterated) ASCII string.
+CLEAN_STRING_LOWERCASE_TABLE = bytes.maketrans(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ", b"abcdefghijklmnopqrstuvwxyz")
+CLEAN_STRING_DELETED_BYTES = bytes(byte for byte in range(256) if NON_ALPHANUMERIC_PATTERN.fullmatch(chr(byte)))
+
+
 def clean_string(str):
     """
     Remove non-alphabetic and non-numeric characters from the string, transformed into lowercase.
+    'unidecode' is skipped for pure ASCII input. The results are not memoized, a cache of the sentences
+    would keep them in memory for the whole run.
 
     Args:
         str (string): The input strign to simplify.
@@ -24,17 +38,47 @@ def clean_string(str):
     Returns:
         The simplified version of the input string.
     """
-    cleaned_string = re.sub('[^a-zA-Z0-9]', '', unidecode(str)) # Keep only alphabetic and numeric chars
-    cleaned_string = cleaned_string.lower() # Convert to lowercase
+    if not str.isascii():
+        str = unidecode(str)
+    # Keep only alphabetic and numeric chars, converted to lowercase
+    cleaned_string = str.encode("ascii", "ignore").translate(CLEAN_STRING_LOWERCASE_TABLE, CLEAN_STRING_DELETED_BYTES)
 
-    return cleaned_string
+    return cleaned_string.decode("ascii")
+
+
+def sentence_key_hash(raw_sentence):
+    """
+    Stable (not process dependent) 64-bit hash of a character-simplified sentence (see 'clean_string'),
+    used as a compact join key of the UD and morphology probe sentences.
+    """
+    return int.from_bytes(hashlib.blake2b(raw_sentence.encode("utf-8"), digest_size=8).digest(), "little")
 
 
 """ Functions for downloading data. """
 
+DOWNLOAD_CHUNK_SIZE = 1024*1024
+DOWNLOAD_PROGRESS_INTERVAL = 5 # seconds
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def output_signature(path):
+    # A cheap check of whether a written file was modified since (see 'file_sha256' for its contents).
+    file_stat = os.stat(path)
+    return {"size": file_stat.st_size, "mtime_ns": file_stat.st_mtime_ns}
+
+
 def download_ud_treebank(base_url: str, ud_treebank_name: str):
     """
     Download the UD treebank to the current directory.
+    The file is streamed to disk in chunks, into a '.part' file first. If a previous download was
+    interrupted, it is resumed from the end of the '.part' file with an HTTP Range request.
 
     Args:
         base_url (str): The url to download the file from.
@@ -42,14 +86,72 @@ def download_ud_treebank(base_url: str, ud_treebank_name: str):
         ud_treebank_name (str) The name of the UD treebank file.
 
     """
-    filename = ud_treebank_name+".tgz"
+    file_name = ud_treebank_name+".tgz"
+    partial_file_name = file_name+".part"
     url = base_url + "/" + file_name
+
+    downloaded = os.path.getsize(partial_file_name) if os.path.isfile(partial_file_name) else 0
+    headers = {"Range": f"bytes={downloaded}-"} if downloaded else {}
     print(f"Downloadng UD treebank from: {url}")
-    response = requests.get(url)
-    with open(file_name, "wb") as file:
-        file.write(response.content)
 
-    print("Download complete.")
+    with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+        if downloaded and response.status_code == 416:
+            # Range not satisfiable: the previous download has already received the whole file.
+            response_size = 0
+        else:
+            response.raise_for_status()
+            if downloaded and response.status_code == 206:
+                print(f"Resuming the download from {downloaded/2**20:.1f} MB.")
+            elif downloaded:
+                print("The server does not support resuming, restarting the download.")
+                downloaded = 0
+            response_size = int(response.headers.get("Content-Length", 0))
+        total_size = downloaded + response_size
+
+        start_time = time.time()
+        last_report = start_time
+        received = 0
+        with open(partial_file_name, "ab" if downloaded else "wb") as file:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+                received += len(chunk)
+                if time.time() - last_report >= DOWNLOAD_PROGRESS_INTERVAL:
+                    last_report = time.time()
+                    speed = received / (last_report-start_time) / 2**20
+                    progress = f" ({(downloaded+received)/total_size*100:.1f}%)" if response_size else ""
+                    print(f"    {(downloaded+received)/2**20:.1f} MB{progress}, {speed:.2f} MB/s")
+
+    os.replace(partial_file_name, file_name)
+    elapsed = max(time.time()-start_time, 1e-6)
+    print(f"Download complete: {(downloaded+received)/2**20:.1f} MB ({received/elapsed/2**20:.2f} MB/s).")
+
+
+def verify_ud_treebank(ud_treebank_name: str, expected_sha256=None, raise_error=True):
+    """
+    Compute the SHA-256 checksum of the downloaded UD treebank archive and compare it to the expected one.
+    The checksum is saved next to the archive ('.sha256' file).
+
+    Args:
+        ud_treebank_name (str) The name of the UD treebank file.
+        expected_sha256 (str): The expected hex digest, the check is skipped if it is not given.
+        raise_error (bool): Raise an exception on a mismatch, instead of returning False.
+    Returns:
+        bool: False if the checksum does not match the expected one.
+    """
+    file_name = ud_treebank_name+".tgz"
+    if not os.path.isfile(file_name):
+        return True
+    sha256 = file_sha256(file_name)
+    with open(file_name+".sha256", "w") as checksum_file:
+        checksum_file.write(f"{sha256}  {file_name}\n")
+    if expected_sha256 and sha256 != expected_sha256.lower():
+        message = f"SHA-256 checksum mismatch for '{file_name}': {sha256} (expected: {expected_sha256})."
+        if raise_error:
+            raise Exception(message)
+        print(message)
+        return False
+    print(f"SHA-256 of '{file_name}': {sha256}" + (" (verified)" if expected_sha256 else ""))
+    return True
 
 
 def extract_ud_treebank(ud_treebank_name: str):
@@ -62,34 +164,104 @@ def extract_ud_treebank(ud_treebank_name: str):
     """
     print(f"Extracting UD treebank: {ud_treebank_name}")
     try:
+        extracted_count = 0
         with tarfile.open(ud_treebank_name+".tgz", "r:gz") as file:
-            for member in file.getmembers():
-                print(member.name)
+            for member in file:
                 if member.name.startswith("ud-treebanks") and member.name.endswith(".conllu"):
                     file.extract(member)
-        print("Extraction complete.")
+                    extracted_count += 1
+        print(f"Extraction complete ({extracted_count} files).")
     except tarfile.ReadError:
         print("Error: Invalid compressed file. Please ensure the downloaded file is a valid TAR archive.")
     except FileNotFoundError:
         print("Error: The downloaded file '" + ud_treebank_name + ".tgz' is missing.")
 
 
-def download_github_repo(git_url, repo_dir):
+def download_github_repo(git_url, repo_name, repo_dir=None, sparse_patterns=None):
     """
-    Download a repository from github.
-    The target directory has the same name as the repo on Github.
+    Download a repository from github, as a shallow clone (only the latest commit).
+    The target directory has the same name as the repo on Github, unless 'repo_dir' is given.
 
     Args:
         git_url (str): The url on Github without the repository name
-        repo_dir (str): The name of the repository
+        repo_name (str): The name of the repository
+        repo_dir (str): The target directory
+        sparse_patterns (list of str): Check out only the matching paths (see 'morphology_probes_sparse_patterns').
+                                       Everything is checked out if not given.
+    """
+    repo_dir = repo_dir if repo_dir else repo_name
+    if sparse_patterns:
+        # The file contents outside the sparse paths are not downloaded either.
+        repo = Repo.clone_from(git_url+repo_name, repo_dir, depth=1, no_checkout=True, multi_options=["--filter=blob:none"])
+        repo.git.sparse_checkout("set", "--no-cone", *sparse_patterns)
+        repo.git.checkout(repo.active_branch.name)
+    else:
+        Repo.clone_from(git_url+repo_name, repo_dir, depth=1)
+    print(f"Downloaded data for probing from: {git_url+repo_name}.")
+
+
+def update_github_repo(repo_dir, sparse_patterns=None):
+    """
+    Fetch the latest commit of an already downloaded repository (see 'download_github_repo').
+    For sparse checkouts the new patterns are added to the checked out paths, without patterns (everything is needed)
+    the sparse checkout is disabled.
+    The branch is only fast-forwarded: a repository with local changes, a detached HEAD
+    or diverged commits is left as it is, with an exception.
+    """
+    repo = Repo(repo_dir)
+    if repo.is_dirty():
+        raise Exception(f"The git repo '{repo_dir}' has local changes, commit or discard them before updating.")
+    if repo.head.is_detached:
+        raise Exception(f"The git repo '{repo_dir}' is not on a branch (detached HEAD at {repo.head.commit.hexsha[:10]}), "
+                        "check out a branch before updating.")
+    if is_sparse_checkout(repo):
+        if sparse_patterns:
+            repo.git.sparse_checkout("add", *sparse_patterns)
+        else:
+            # The missing file contents are fetched on checkout (see the '--filter' of 'download_github_repo').
+            repo.git.sparse_checkout("disable")
+    branch = repo.active_branch.name
+    # No '--depth': the new commits are fetched down to the (shallow) history of the clone, so that they can be fast-forwarded.
+    repo.git.fetch("origin", branch)
+    try:
+        repo.git.merge("--ff-only", "FETCH_HEAD")
+    except GitCommandError as err:
+        raise Exception(f"The git repo '{repo_dir}' can not be fast-forwarded to 'origin/{branch}': {err.stderr.strip()}")
+    print(f"Updated git repo '{repo_dir}' to: {repo.head.commit.hexsha[:10]}")
 
+
+def is_sparse_checkout(repo):
+    # The setting is in the worktree specific config, read it with git itself.
+    try:
+        return repo.git.config("--get", "core.sparseCheckout") == "true"
+    except GitCommandError:
+        return False
+
+
+def case_insensitive_pattern(name):
+    # Glob pattern matching the name in any letter case, e.g. 'En' -> '[Ee][Nn]'
+    return "".join(f"[{c.upper()}{c.lower()}]" if c.isalpha() else c for c in name)
+
+
+def morphology_probes_sparse_patterns(tags):
+    """
+    Sparse checkout patterns of the 'data/<morph_pos>/<Language>' directories selected by the tags
+    (see 'filtered_path' for the format of the tags). Returns None if everything is needed.
     """
-    Repo.clone_from(git_url+repo_dir, repo_dir)
-    print(f"Downloaded data for probing from: {git_url}.")
+    patterns = []
+    for lang, morph_pos in [filter_elem.split(",") for filter_elem in list(tags.split("|"))]:
+        lang, morph_pos = lang.strip(), morph_pos.strip().lower()
+        if lang.lower() == "all" and morph_pos == "all":
+            return None
+        morph_pos_pattern = "*" if morph_pos == "all" else morph_pos
+        lang_pattern = "*" if lang.lower() == "all" else case_insensitive_pattern(lang)
+        patterns.append(f"/data/{morph_pos_pattern}/{lang_pattern}/")
+    return patterns
 
 
 def is_ud_treebank_downloaded(ud_treebank_name):
-    return os.path.exists(ud_treebank_name)
+    # The treebank files can be read from the archive too, it does not have to be extracted.
+    return os.path.exists(ud_treebank_name) or os.path.exists(ud_treebank_name+".tgz")
 
 
 def is_git_repo_downloaded(repo_name):
@@ -97,19 +269,161 @@ def is_git_repo_downloaded(repo_name):
 
 
 # Download the latest UD treebank if it's not already downloaded for the requested language codes.
-def download_ud_treebank_if_needed(base_url, ud_treebank_name):
-    if not is_ud_treebank_downloaded(ud_treebank_name):
+def download_ud_treebank_if_needed(base_url, ud_treebank_name, extract=False, expected_sha256=None):
+    downloaded = is_ud_treebank_downloaded(ud_treebank_name)
+    if not downloaded:
         download_ud_treebank(base_url, ud_treebank_name)
-        extract_ud_treebank(ud_treebank_name)
     else:
         print(f"Treebank '{ud_treebank_name}' already downlaoded.")
+    if (not downloaded or expected_sha256) and not verify_ud_treebank(ud_treebank_name, expected_sha256, raise_error=False):
+        # A corrupted archive (e.g. resumed from the '.part' file of another version) is downloaded again from the start.
+        print(f"Deleting '{ud_treebank_name}.tgz', downloading it again.")
+        os.remove(ud_treebank_name+".tgz")
+        download_ud_treebank(base_url, ud_treebank_name)
+        verify_ud_treebank(ud_treebank_name, expected_sha256)
+    if extract and not os.path.isdir(ud_treebank_name):
+        extract_ud_treebank(ud_treebank_name)
+        invalidate_catalog_tree(ud_treebank_name)
 
 # Download git repository if it's not already downloaded.
-def download_git_repo_if_needed(git_url, repo_dir):
+def download_git_repo_if_needed(git_url, repo_name, repo_dir=None, sparse_patterns=None):
+    repo_dir = repo_dir if repo_dir else repo_name
     if not is_git_repo_downloaded(repo_dir):
-        download_github_repo(git_url, repo_dir)
+        download_github_repo(git_url, repo_name, repo_dir, sparse_patterns)
     else:
-        print(f"Git repo '{repo_dir}' already downlaoded.")
+        print(f"Git repo '{repo_dir}' already downlaoded, fetching updates.")
+        update_github_repo(repo_dir, sparse_patterns)
+    invalidate_catalog_tree(repo_dir)
+
+
+"""
+Directory catalog: the listings of the walked directory trees (morphology probes, datasets, UD treebank)
+are saved in a JSON file, so that the trees are not listed again on every call (slow on network file systems).
+A directory is listed again only if its modification time changed (entries were added, removed or renamed),
+so the catalog is refreshed incrementally. The results derived from a tree (e.g. the UD files of a language)
+are saved as well, and recomputed when the tree changes.
+A tree is validated once per process: it is validated again only if the modification time of its root changed,
+or if the process wrote to it (see 'invalidate_catalog_tree').
+"""
+CATALOG_VERSION = 1
+
+# The loaded catalog: {"version": int, "trees": {rootdir: {"dirs": {path: listing}, "derived": {name: value}}}}
+_catalog = {}
+# The trees validated by this process: {rootdir: modification time of the root when it was validated}
+_validated_trees = {}
+
+
+def load_catalog():
+    if not _catalog:
+        catalog = None
+        if os.path.isfile(catalog_path()):
+            try:
+                with open(catalog_path(), "r", encoding="utf-8") as catalog_file:
+                    catalog = json.load(catalog_file)
+            except ValueError as err:
+                print(f"Invalid catalog file ({err}), rebuilding: {catalog_path()}")
+        if catalog is None or catalog.get("version") != CATALOG_VERSION:
+            catalog = {"version": CATALOG_VERSION, "trees": {}}
+        _catalog.update(catalog)
+    return _catalog
+
+
+def save_catalog():
+    os.makedirs(os.path.dirname(catalog_path()), exist_ok=True)
+    with atomic_write(catalog_path()) as tmp_path:
+        with open(tmp_path, "w", encoding="utf-8") as catalog_file:
+            json.dump(_catalog, catalog_file)
+
+
+def list_directory(path):
+    # Listing of a directory in the format of the catalog: the subdirectories, the files and the subdirectories to walk.
+    listing = {"mtime": os.stat(path).st_mtime_ns, "dirs": [], "files": [], "walk": []}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                listing["dirs"].append(entry.name)
+                # Like 'os.walk', the symbolic links to directories are not followed.
+                if not entry.is_symlink():
+                    listing["walk"].append(entry.name)
+            else:
+                listing["files"].append(entry.name)
+    return listing
+
+
+def catalog_tree(rootdir):
+    """
+    The catalog entry of a directory tree, refreshed by the modification times of its directories.
+
+    Returns:
+        dict: {"dirs": {directory path: listing (see 'list_directory')}, "derived": {name: value}}
+    """
+    catalog = load_catalog()
+    root_mtime = os.stat(rootdir).st_mtime_ns if os.path.isdir(rootdir) else None
+    if rootdir in catalog["trees"] and rootdir in _validated_trees and _validated_trees[rootdir] == root_mtime:
+        return catalog["trees"][rootdir]
+    tree = catalog["trees"].get(rootdir, {"dirs": {}, "derived": {}})
+    dirs = {}
+    changed = rootdir not in catalog["trees"]
+    pending = [rootdir] if os.path.isdir(rootdir) else []
+    while pending:
+        cur_dir = pending.pop()
+        listing = tree["dirs"].get(cur_dir)
+        try:
+            if listing is None or listing["mtime"] != os.stat(cur_dir).st_mtime_ns:
+                listing = list_directory(cur_dir)
+                changed = True
+        except OSError:
+            continue
+        dirs[cur_dir] = listing
+        pending.extend(os.path.join(cur_dir, name) for name in listing["walk"])
+
+    if changed or len(dirs) != len(tree["dirs"]):
+        tree = {"dirs": dirs, "derived": {}}
+        catalog["trees"][rootdir] = tree
+        save_catalog()
+    _validated_trees[rootdir] = root_mtime
+    return tree
+
+
+def invalidate_catalog_tree(path):
+    # The trees containing a written (or removed) path, or contained by it, are validated again on their next use.
+    path = os.path.abspath(path)
+    for rootdir in list(_validated_trees):
+        abs_rootdir = os.path.abspath(rootdir)
+        if os.path.commonpath([path, abs_rootdir]) in (path, abs_rootdir):
+            del _validated_trees[rootdir]
+
+
+def catalog_walk(rootdir, start=None):
+    """
+    Walk a directory tree from the catalog, yielding the same (top-down) triplets as 'os.walk':
+    (directory path, subdirectory names, file names)
+    With 'start' only the subtree of a directory (walked from 'rootdir') is yielded.
+    """
+    dirs = catalog_tree(rootdir)["dirs"]
+    start = start if start is not None else rootdir
+    pending = [start] if start in dirs else []
+    while pending:
+        cur_dir = pending.pop()
+        listing = dirs[cur_dir]
+        yield cur_dir, listing["dirs"], listing["files"]
+        pending.extend(reversed([os.path.join(cur_dir, name) for name in listing["walk"]]))
+
+
+def catalog_derived(rootdir, name, compute):
+    """
+    A value derived from a directory tree (e.g. the UD files of a language), computed only once
+    for every state of the tree. The value has to be JSON serializable.
+    """
+    tree = catalog_tree(rootdir)
+    if name not in tree["derived"]:
+        tree["derived"][name] = compute()
+        save_catalog()
+    return tree["derived"][name]
 
 
 # For the AcsJudit data
@@ -121,7 +435,7 @@ def leaf_dirs(rootdir):
         rootdir (str): directory path where the search starts.
     """
     dir_paths = []
-    for subroot, dirs, files in os.walk(rootdir):
+    for subroot, dirs, files in catalog_walk(rootdir):
         if not dirs:
             dir_paths.append(subroot)
     return dir_paths
@@ -194,24 +508,72 @@ def git_repo_url():
 def git_repo_name_probe():
     return "probing"
 
+def git_repo_name_morphology_probes():
+    return "morphology-probes"
+
+def git_repo_dir_morphology_probes():
+    return "morphology_probes"
+
 def git_repo_name_probing_dataset():
     return "morphology_probes/data"
 
-def rootdir_rnd_ext():
-    return "datasets/random"
+def rootdir_rnd_ext(sample=0):
+    # Additional random samples (see 'generate_dataset') are written next to the first one.
+    return "datasets/random" if sample == 0 else f"datasets/random_{sample}"
     #return "output_rnd"
 
 def rootdir_dep_tree_ext():
     return "datasets/dep_tree"
     #return "output_ext"
 
+def rootdir_masked_ext(mask_set):
+    # The deptree masking datasets, one directory per mask set (see 'masked_variant').
+    return f"datasets/masked/{mask_set}"
+
 def rootdir_orig():
     return "morphology_probes/data"
 
+def ud_treebank_archive_path():
+    return ud_treebank_name()+".tgz"
+
+def ud_cache_dir():
+    return os.path.join(".cache", "ud")
+
+def catalog_path():
+    return os.path.join(".cache", "catalog.json")
+
+def manifest_dir():
+    return os.path.join(".cache", "manifest")
+
+def relation_counts_dir():
+    return os.path.join(".cache", "relation_counts")
+
+def dataset_stream_dir():
+    # The named pipes of the compressed datasets read by the probing scripts (see 'DatasetStream').
+    return os.path.join(".cache", "streams")
+
+
+def training_log_dir():
+    return os.path.join("logs", "training")
+
+def training_history_path():
+    # The runtimes of the earlier training jobs, used to order the jobs (see 'estimate_training_costs').
+    return os.path.join(".cache", "training_history.json")
+
+def training_log_path(data_type, train_path):
+    # The log of a training job: logs/training/<data type>/<morph_pos>/<language>.log
+    return os.path.join(training_log_dir(), data_type, os.path.dirname(tags_from_path(train_path))+".log")
+
 
 def inferece_accuracy_file_name():
     return "inference_accuracy.txt"
 
+def relation_divergence_file_name():
+    return "relation_divergence.tsv"
+
+def distance_histogram_file_name():
+    return "distance_histograms.tsv"
+
 def home_workdir():
     home = str(Path.home())
     workdir = os.path.join(home, "workdir")
@@ -222,8 +584,15 @@ def data_rootdir(data_type: str):
         rootdir = rootdir_orig()
     elif data_type == "random":
         rootdir = rootdir_rnd_ext()
+    elif data_type.startswith("random_") and data_type[len("random_"):].isdigit():
+        rootdir = rootdir_rnd_ext(int(data_type[len("random_"):]))
     elif data_type == "extended":
         rootdir = rootdir_dep_tree_ext()
+    elif data_type.startswith("masked/"):
+        rootdir = rootdir_masked_ext(data_type[len("masked/"):])
+    elif data_type.startswith("view:"):
+        # The perturbation views are computed from the extended datasets (see 'PerturbationView').
+        rootdir = rootdir_dep_tree_ext()
     else:
         raise Exception(f"Unknown input data type provided: {data_type}")
     return rootdir
@@ -249,27 +618,66 @@ def model_config_path(config):
 def tags_from_path(path):
     # path '/media/mzpx/HDD/Work/language_data_processing/output_ext/morphology_probes/data/number_noun/English/train.tsv'
     # return 'number_noun/English/train.tsv'
+    # The datasets in the other formats and layouts have the tags of their TSV version (e.g. 'train.tsv.gz' -> 'train.tsv')
+    path = dataset_tsv_path(path)
     tag_postfix = '/'.join(path.split('/')[-3:])
     return tag_postfix
 
 
+# The file extensions of the dataset formats (see 'write_dataset'), in the order they are looked up.
+DATASET_FORMATS = {
+    "tsv": ".tsv",
+    "gzip": ".tsv.gz",
+    "zstd": ".tsv.zst",
+    "parquet": ".parquet",
+}
+
+
+# The suffixes of the dataset layouts (see 'write_dataset'): one row per line, or the rows referring to the
+# sentences by id, with the sentences in a separate table (e.g. 'train.rows.tsv' and 'train.sentences.tsv').
+DATASET_LAYOUTS = {
+    "rows": "",
+    "normalized": ".rows",
+}
+SENTENCE_TABLE_SUFFIX = ".sentences"
+
+
+def dataset_format_path(tsv_path, output_format, layout="rows"):
+    # The path of a dataset in the given format and layout, e.g. 'train.tsv' -> 'train.tsv.gz' or 'train.rows.tsv.gz'
+    return tsv_path[:-len(".tsv")] + DATASET_LAYOUTS[layout] + DATASET_FORMATS[output_format]
+
+
+def dataset_tsv_path(path):
+    # The path of the TSV version of a dataset (in the 'rows' layout), e.g. 'train.rows.tsv.gz' -> 'train.tsv'
+    for layout, suffix in DATASET_LAYOUTS.items():
+        for output_format, extension in DATASET_FORMATS.items():
+            if path.endswith(suffix+extension) and (suffix or not path[:-len(extension)].endswith(DATASET_LAYOUTS["normalized"])):
+                return path[:-len(suffix+extension)] + ".tsv"
+    return path
+
+
+def dataset_file_path(_dir, file_names, tsv_name):
+    # The path of a dataset file in any of the layouts and formats, None if it does not exist.
+    for layout in DATASET_LAYOUTS:
+        for output_format in DATASET_FORMATS:
+            file_name = dataset_format_path(tsv_name, output_format, layout)
+            if file_name in file_names:
+                return os.path.join(_dir, file_name)
+    return None
+
+
 def dataset_paths(rootdir, tags, absolute=False, posthoc=False):
     # Return triplets of dataset file paths matching tags.
-    directories = leaf_dirs(rootdir)
+    dir_files = {subroot: set(files) for subroot, dirs, files in catalog_walk(rootdir) if not dirs}
+    directories = list(dir_files)
     if tags:
         dir_paths = filter_dirs(directories, tags)
     datasets = []
     for _dir in dir_paths:
-        train_path = os.path.join(_dir, "train.tsv")
-        if not os.path.isfile(train_path):
-            train_path = None
-        dev_path = os.path.join(_dir, "dev.tsv")
-        if not os.path.isfile(dev_path):
-            dev_path = None
+        train_path = dataset_file_path(_dir, dir_files[_dir], "train.tsv")
+        dev_path = dataset_file_path(_dir, dir_files[_dir], "dev.tsv")
         test_file_name = "test.tsv" if not posthoc else "posthoc.tsv"
-        test_path = os.path.join(_dir, test_file_name)
-        if not os.path.isfile(test_path):
-            test_path = None
+        test_path = dataset_file_path(_dir, dir_files[_dir], test_file_name)
         triplet = (train_path, dev_path, test_path)
         if absolute:
             triplet = tuple(map(os.path.abspath, triplet))
@@ -351,23 +759,151 @@ def group_paths_on_language(dataset_triplets):
 
 
 def conllu_file_path_loader(language):
+    """
+    Yield the paths of the UD treebank files of a language.
+    If the UD treebank is not extracted, the .conllu members of the downloaded archive are yielded
+    (as '<archive path>::<member name>', see 'iter_conllu_files').
+    """
     treebank_name = ud_treebank_name()
-    if not os.path.isdir(treebank_name):
+    archive_path = ud_treebank_archive_path()
+    if os.path.isdir(treebank_name):
+        treebank_source = treebank_name
+    elif os.path.isfile(archive_path):
+        treebank_source = archive_path
+    else:
         raise Exception(f"UD treebank directory not found at: {treebank_name}")
-    print(f"Start reading the UD treebank from: {treebank_name}")
+    print(f"Start reading the UD treebank from: {treebank_source}")
 
     langname = language.lower()
     # Fix the syntax difference of the names of swedish datasets.
     langname = langname.replace("bokmal", "bokmaal")
-    for root, dirs, files in os.walk(treebank_name):
-        for dirname in dirs:
+    if treebank_source == archive_path:
+        for member_name in archive_member_index(archive_path):
+            member_dirs = member_name.split("/")[:-1]
+            if any(clean_string(langname) in clean_string(dirname) for dirname in member_dirs):
+                yield archive_member_path(archive_path, member_name)
+        return
+
+    def language_file_paths():
+        file_paths = []
+        for root, dirs, files in catalog_walk(treebank_name):
+            for dirname in dirs:
+
+                if clean_string(langname) in clean_string(dirname):
+                    cur_dir  = os.path.join(root, dirname)
+                    for lang_root, lang_dirs, lang_files in catalog_walk(treebank_name, cur_dir):
+                        for cur_lang_file in lang_files:
+                            file_path = os.path.join(lang_root, cur_lang_file)
+                            file_paths.append(file_path)
+        return file_paths
+
+    # The files of the languages are saved in the catalog, the directory names are not compared again.
+    yield from catalog_derived(treebank_name, f"ud_files:{langname}", language_file_paths)
+
+
+"""
+Reading the .conllu files from the UD treebank archive.
+"""
+ARCHIVE_MEMBER_SEPARATOR = "::"
+
+# {archive path: ((size, mtime), member index)}
+_archive_member_indexes = {}
+
+
+def archive_member_path(archive_path, member_name):
+    return f"{archive_path}{ARCHIVE_MEMBER_SEPARATOR}{member_name}"
+
+
+def split_archive_member_path(path):
+    # Returns the archive path and the member name, or (None, path) for regular files.
+    if ARCHIVE_MEMBER_SEPARATOR in path:
+        archive_path, member_name = path.split(ARCHIVE_MEMBER_SEPARATOR, 1)
+        return archive_path, member_name
+    return None, path
 
-            if clean_string(langname) in clean_string(dirname):
-                cur_dir  = os.path.join(root, dirname)
-                for lang_root, lang_dirs, lang_files in os.walk(cur_dir):
-                    for cur_lang_file in lang_files:
-                        file_path = os.path.join(lang_root, cur_lang_file)
-                        yield file_path
+
+def archive_member_index(archive_path):
+    """
+    Index of the .conllu members of a .tgz archive: {member name: (data offset, size)}.
+    Building the index needs one pass over the archive, then it is saved next to the UD cache,
+    and rebuilt only if the archive changes.
+    """
+    archive_stat = os.stat(archive_path)
+    archive_signature = [archive_stat.st_size, archive_stat.st_mtime_ns]
+    if archive_path in _archive_member_indexes and _archive_member_indexes[archive_path][0] == archive_signature:
+        return _archive_member_indexes[archive_path][1]
+
+    index_path = os.path.join(ud_cache_dir(), os.path.basename(archive_path)+".members.json")
+    members = None
+    if os.path.isfile(index_path):
+        with open(index_path, "r", encoding="utf-8") as index_file:
+            saved_index = json.load(index_file)
+        if saved_index["archive"] == archive_signature:
+            members = saved_index["members"]
+
+    if members is None:
+        print(f"Indexing the members of the archive: {archive_path}")
+        members = {}
+        with tarfile.open(archive_path, "r:gz") as archive:
+            for member in archive:
+                if member.isreg() and member.name.endswith(".conllu"):
+                    members[member.name] = [member.offset_data, member.size]
+        create_dir_if_needed(ud_cache_dir())
+        with atomic_write(index_path) as tmp_path:
+            with open(tmp_path, "w", encoding="utf-8") as index_file:
+                json.dump({"archive": archive_signature, "members": members}, index_file)
+
+    _archive_member_indexes[archive_path] = (archive_signature, members)
+    return members
+
+
+def file_signature(path):
+    # Size and modification time of a file (or an archive member), used to detect changes.
+    archive_path, member_name = split_archive_member_path(path)
+    if archive_path is None:
+        file_stat = os.stat(path)
+        return f"{file_stat.st_size}\t{file_stat.st_mtime_ns}"
+    archive_stat = os.stat(archive_path)
+    member_size = archive_member_index(archive_path)[member_name][1]
+    return f"{member_size}\t{archive_stat.st_size}\t{archive_stat.st_mtime_ns}"
+
+
+def conllu_file_size(path):
+    # Size of a file (or the uncompressed size of an archive member) in bytes.
+    archive_path, member_name = split_archive_member_path(path)
+    if archive_path is None:
+        return os.path.getsize(path)
+    return archive_member_index(archive_path)[member_name][1]
+
+
+def iter_conllu_files(file_paths):
+    """
+    Open the .conllu files one after the other, either regular files or archive members
+    (see 'conllu_file_path_loader'). The archive members are decompressed in streaming mode,
+    the archives are opened only once.
+
+    Yields:
+        pair: the path and the opened text file
+    """
+    archives = {}
+    try:
+        for cur_path in file_paths:
+            archive_path, member_name = split_archive_member_path(cur_path)
+            if archive_path is None:
+                with open(cur_path, "r", encoding="utf-8") as conllu_file:
+                    yield cur_path, conllu_file
+                continue
+
+            if archive_path not in archives:
+                archives[archive_path] = tarfile.open(archive_path, "r:gz")
+            # The member is read from its saved offset, without walking the headers of the archive.
+            member = tarfile.TarInfo(member_name)
+            member.offset_data, member.size = archive_member_index(archive_path)[member_name]
+            member_file = archives[archive_path].extractfile(member)
+            yield cur_path, io.TextIOWrapper(member_file, encoding="utf-8")
+    finally:
+        for archive in archives.values():
+            archive.close()
 
 
 """
@@ -375,27 +911,45 @@ File manipualtion functions.
 """
 def create_dir_if_needed(output_dir):
     if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+        # exist_ok: parallel workers may create the same directory at the same time
+        os.makedirs(output_dir, exist_ok=True)
         print(f"Directory created: '{output_dir}'")
 
 
+@contextlib.contextmanager
+def atomic_write(file_path):
+    """
+    Write a file atomically: the block writes the temporary file whose path is given, which replaces the file
+    at the end of the block, so that (parallel) writers never leave half-written files.
+    The temporary file is removed if the block fails.
+
+        with atomic_write(path) as tmp_path:
+            with open(tmp_path, "w") as f:
+                ...
+    """
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def find_all_languages():
     # Should work only for morphology_probing atm
     # TODO finsih
     found_languages = set()
 
-    for root, dirs, files in os.walk("morphology_probes/data"):
-        for dirname in dirs:
-            cur_dir  = os.path.join(root, dirname)
-            for lang_root, lang_dirs, lang_files in os.walk(cur_dir):
-                for lang_dir_name in lang_dirs:
-                    found_languages.add(lang_dir_name)
+    for root, dirs, files in catalog_walk("morphology_probes/data"):
+        if root != "morphology_probes/data":
+            found_languages.update(dirs)
 
     return list(found_languages)
 
 def find_all_tag_pairs():
     base_path = f"morphology_probes/data"
-    tag_pairs = [ tuple(os.path.basename(f.path).split("_")) for f in os.scandir(base_path) if f.is_dir() ]
+    tag_pairs = [tuple(dirname.split("_")) for dirname in catalog_tree(base_path)["dirs"][base_path]["dirs"]]
 
     return tag_pairs
 
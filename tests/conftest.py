@@ -0,0 +1,74 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_PATH = os.path.join(REPO_DIR, "main.py")
+
+# The number of sentences of the fixture treebank.
+SENTENCE_COUNT = 12
+
+
+# The sentences of the morphology probe splits.
+SPLITS = {"train": range(0, 8), "dev": range(8, 10), "test": range(10, 12)}
+
+
+def conllu_sentence(sentence_id, object_relation="obj"):
+    # (word form, PoS tag, FEATS, head, relation), the heads are 1-based.
+    tokens = [
+        ("The", "DET", "Definite=Def|PronType=Art", 2, "det"),
+        (f"cat{sentence_id}", "NOUN", "Number=Sing", 3, "nsubj"),
+        ("sees", "VERB", "Mood=Ind|Tense=Pres|VerbForm=Fin", 0, "root"),
+        (f"dogs{sentence_id}", "NOUN", "Number=Plur", 3, object_relation),
+        (".", "PUNCT", "_", 3, "punct"),
+    ]
+    lines = [f"# sent_id = s{sentence_id}", f"# text = {sentence_text(sentence_id)}"]
+    for idx, (form, pos_tag, feats, head, relation) in enumerate(tokens, 1):
+        lines.append("\t".join([str(idx), form, form.lower(), pos_tag, "_", feats, str(head), relation, "_", "_"]))
+    return "\n".join(lines) + "\n\n"
+
+
+def sentence_text(sentence_id):
+    return f"The cat{sentence_id} sees dogs{sentence_id} ."
+
+
+def write_treebank(root, language, code, object_relation="obj"):
+    # The UD treebank of a language, the sentences of all languages are the same, only the relation of the object differs.
+    ud_dir = root / "ud-treebanks-v2.12" / f"UD_{language}-Test"
+    ud_dir.mkdir(parents=True)
+    sentences = [conllu_sentence(sentence_id, object_relation) for sentence_id in range(SENTENCE_COUNT)]
+    (ud_dir / f"{code}_test-ud-train.conllu").write_text("".join(sentences), encoding="utf-8")
+
+
+def write_probe_task(root, morph_pos, language, probe_row):
+    # The morphology probes of a task, 'probe_row' gives the row of a sentence id.
+    probe_dir = root / "morphology_probes" / "data" / morph_pos / language
+    probe_dir.mkdir(parents=True)
+    for split, sentence_ids in SPLITS.items():
+        (probe_dir / f"{split}.tsv").write_text("".join(map(probe_row, sentence_ids)), encoding="utf-8")
+
+
+def number_noun_row(sentence_id):
+    return f"{sentence_text(sentence_id)}\tcat{sentence_id}\t1\tSing\n"
+
+
+def definite_det_row(sentence_id):
+    return f"{sentence_text(sentence_id)}\tThe\t0\tDef\n"
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    """
+    A working directory with a small English UD treebank and the number_noun morphology probes of its sentences.
+    """
+    write_treebank(tmp_path, "English", "en")
+    write_probe_task(tmp_path, "number_noun", "English", number_noun_row)
+    return tmp_path
+
+
+def run_main(cwd, *args):
+    # Run the command line interface like a user does (not importing 'src' directly).
+    return subprocess.run([sys.executable, MAIN_PATH, *args], cwd=cwd, capture_output=True, text=True)
@@ -0,0 +1,324 @@
+import hashlib
+import http.server
+import os
+import subprocess
+import threading
+
+import pytest
+
+from conftest import run_main, write_treebank, write_probe_task, number_noun_row, definite_det_row
+
+
+EXTENDED_TRAIN = os.path.join("datasets", "dep_tree", "morphology_probes", "data", "number_noun", "English", "train.tsv")
+
+
+def test_generate_writes_the_extended_datasets(workspace):
+    result = run_main(workspace, "generate", "--tags", "English,number_noun")
+    assert result.returncode == 0, result.stdout + result.stderr
+    with open(workspace / EXTENDED_TRAIN, encoding="utf-8") as train_file:
+        rows = [line.rstrip("\n").split("\t") for line in train_file]
+    # Both nouns of every training sentence, with their parent in the deptree.
+    assert len(rows) == 16
+    assert rows[0] == ["The cat0 sees dogs0 .", "cat0", "1", "Sing", "1", "sees", "2", "nsubj"]
+    assert rows[1] == ["The cat0 sees dogs0 .", "dogs0", "3", "Plur", "-1", "sees", "2", "obj"]
+
+
+def test_generate_options_reach_the_generator(workspace):
+    reference = run_main(workspace, "generate", "--tags", "English,number_noun")
+    assert reference.returncode == 0, reference.stdout + reference.stderr
+    with open(workspace / EXTENDED_TRAIN, encoding="utf-8") as train_file:
+        expected = train_file.read()
+
+    result = run_main(workspace, "generate", "--tags", "English,number_noun", "--force", "--workers", "2", "--lazy",
+                      "--hash_keys", "--variants", "extended,random", "--seed", "1")
+    assert result.returncode == 0, result.stdout + result.stderr
+    with open(workspace / EXTENDED_TRAIN, encoding="utf-8") as train_file:
+        assert train_file.read() == expected
+    assert os.path.isfile(workspace / EXTENDED_TRAIN.replace("dep_tree", "random"))
+
+
+def test_generate_skips_up_to_date_tasks(workspace):
+    assert run_main(workspace, "generate", "--tags", "English,number_noun").returncode == 0
+    result = run_main(workspace, "generate", "--tags", "English,number_noun")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "Up to date, skipped." in result.stdout
+
+
+def test_all_commands_import(workspace):
+    # Every command imports the modules of 'src' (e.g. 'DATASET_FORMATS', 'get_relation_statistics').
+    for command in ["download", "generate", "probe", "stats"]:
+        result = run_main(workspace, command, "--help")
+        assert result.returncode == 0, result.stdout + result.stderr
+
+
+def test_generate_compressed_format(workspace):
+    result = run_main(workspace, "generate", "--tags", "English,number_noun", "--format", "gzip", "--layout", "normalized")
+    assert result.returncode == 0, result.stdout + result.stderr
+    rows_path = workspace / EXTENDED_TRAIN.replace("train.tsv", "train.rows.tsv.gz")
+    assert os.path.isfile(rows_path)
+    assert os.path.isfile(workspace / EXTENDED_TRAIN.replace("train.tsv", "train.sentences.tsv.gz"))
+    assert not os.path.isfile(workspace / EXTENDED_TRAIN)
+
+
+def test_stats_relations(workspace):
+    assert run_main(workspace, "generate", "--tags", "English,number_noun").returncode == 0
+    result = run_main(workspace, "stats", "relations", "--tags", "English,number_noun")
+    assert result.returncode == 0, result.stdout + result.stderr
+    with open(workspace / "relation_divergence.tsv", encoding="utf-8") as divergence_file:
+        rows = [line.rstrip("\n").split("\t") for line in divergence_file]
+    assert rows[0] == ["language", "morph_pos", "rows", "ud_rows", "kl", "js"]
+    assert [row[:3] for row in rows[1:]] == [["English", "All", "24"], ["English", "number_noun", "24"]]
+
+
+def test_generate_masked_parquet(workspace):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    result = run_main(workspace, "generate", "--tags", "English,number_noun", "--variants", "masked",
+                      "--mask_sets", "hop1", "--format", "parquet")
+    assert result.returncode == 0, result.stdout + result.stderr
+    masked_train = EXTENDED_TRAIN.replace("dep_tree", os.path.join("masked", "hop1")).replace(".tsv", ".parquet")
+    rows = parquet.read_table(workspace / masked_train).to_pylist()
+    # The masked indices are written to the 'distance' column as a space separated string.
+    assert len(rows) == 16
+    assert list(rows[0].values()) == ["The cat0 sees dogs0 .", "cat0", 1, "Sing", "0 2", "_", "_", "_"]
+    assert list(rows[1].values()) == ["The cat0 sees dogs0 .", "dogs0", 3, "Plur", "2", "_", "_", "_"]
+
+
+def test_parallel_generate_reports_failed_jobs(workspace):
+    # A file in place of the output directory fails the job of the task in the worker.
+    output_dir = workspace / os.path.dirname(EXTENDED_TRAIN)
+    output_dir.parent.mkdir(parents=True)
+    output_dir.write_text("")
+    result = run_main(workspace, "generate", "--tags", "English,number_noun", "--workers", "2")
+    assert result.returncode != 0
+    assert "FAILED: English: number_noun" in result.stdout
+
+
+def test_stats_relations_per_language(workspace):
+    # A second language with a relation label that English does not have.
+    write_treebank(workspace, "Afrikaans", "af", "iobj")
+    write_probe_task(workspace, "number_noun", "Afrikaans", number_noun_row)
+    assert run_main(workspace, "generate", "--tags", "Afrikaans,number_noun|English,number_noun").returncode == 0
+
+    # The divergences of a language do not depend on the other languages of the report.
+    def divergences(tags):
+        result = run_main(workspace, "stats", "relations", "--tags", tags)
+        assert result.returncode == 0, result.stdout + result.stderr
+        with open(workspace / "relation_divergence.tsv", encoding="utf-8") as divergence_file:
+            return sorted(line.split("\t") for line in list(divergence_file)[1:])
+    both_languages = divergences("Afrikaans,number_noun|English,number_noun")
+    assert both_languages == sorted(divergences("Afrikaans,number_noun") + divergences("English,number_noun"))
+
+
+def test_fuzzy_matches_do_not_cross_splits(workspace):
+    # A training sentence similar to a test sentence, which is the exact match of a UD sentence.
+    probe_file = workspace / "morphology_probes" / "data" / "number_noun" / "English" / "train.tsv"
+    with open(probe_file, "a", encoding="utf-8") as train_file:
+        train_file.write("The cat11 sees dogs11s .\tcat11\t1\tSing\n")
+    result = run_main(workspace, "generate", "--tags", "English,number_noun", "--fuzzy")
+    assert result.returncode == 0, result.stdout + result.stderr
+    with open(workspace / EXTENDED_TRAIN, encoding="utf-8") as train_file:
+        assert "cat11" not in train_file.read()
+    with open(workspace / EXTENDED_TRAIN.replace("train.tsv", "test.tsv"), encoding="utf-8") as test_file:
+        assert "cat11" in test_file.read()
+
+
+def test_fuzzy_matches_do_not_depend_on_other_tasks(workspace):
+    # A definite_det test sentence similar to a UD sentence, which is an exact match of a number_noun sentence only.
+    write_probe_task(workspace, "definite_det", "English", definite_det_row)
+    probe_file = workspace / "morphology_probes" / "data" / "definite_det" / "English" / "test.tsv"
+    probe_file.write_text(definite_det_row(10) + "The cat11 sees dogs11x .\tThe\t0\tDef\n", encoding="utf-8")
+    output_dir = workspace / os.path.dirname(EXTENDED_TRAIN).replace("number_noun", "definite_det")
+    outputs = {}
+    for tags in ["English,definite_det", "English,number_noun|English,definite_det"]:
+        result = run_main(workspace, "generate", "--tags", tags, "--fuzzy", "--force")
+        assert result.returncode == 0, result.stdout + result.stderr
+        outputs[tags] = {path.name: path.read_bytes() for path in sorted(output_dir.iterdir())}
+    assert b"cat11" in outputs["English,definite_det"]["test.tsv"]
+    assert outputs["English,number_noun|English,definite_det"] == outputs["English,definite_det"]
+
+
+def test_generate_rejects_negative_seeds(workspace):
+    result = run_main(workspace, "generate", "--tags", "English,number_noun", "--variants", "random", "--seed", "-1")
+    assert result.returncode == 2
+    assert "invalid non-negative integer: '-1'" in result.stderr
+
+
+def test_generate_rejects_invalid_random_samples(workspace):
+    for random_samples in ["0", "-1"]:
+        result = run_main(workspace, "generate", "--tags", "English,number_noun", "--variants", "random", "--random_samples", random_samples)
+        assert result.returncode == 2
+        assert f"invalid positive integer: '{random_samples}'" in result.stderr
+
+
+def fake_training_script(workspace, exit_code):
+    # Reads the training and the dev files like the probing scripts do, then exits with the given code.
+    script_dir = workspace / "probing" / "src" / "probing"
+    script_dir.mkdir(parents=True)
+    (script_dir / "train.py").write_text(
+        "import sys\n"
+        "for option in ['--train-file', '--dev-file']:\n"
+        "    with open(sys.argv[sys.argv.index(option)+1], encoding='utf-8') as data_file:\n"
+        "        data_file.read()\n"
+        f"sys.exit({exit_code})\n", encoding="utf-8")
+
+
+def test_probe_train_fails_with_the_jobs(workspace):
+    fake_training_script(workspace, 3)
+    result = run_main(workspace, "probe", "--train", "--tags", "English,number_noun", "--config_path", "default")
+    assert result.returncode == 1, result.stdout + result.stderr
+    assert "FAILED (exit code: 3): number_noun/English" in result.stdout
+
+
+def test_probe_train_reports_stream_errors(workspace):
+    fake_training_script(workspace, 0)
+    assert run_main(workspace, "generate", "--tags", "English,number_noun").returncode == 0
+    # A row the random view can not read: the training script sees the rows before it only.
+    with open(workspace / EXTENDED_TRAIN, "a", encoding="utf-8") as train_file:
+        train_file.write("The cat0 sees dogs0 .\tcat0\tx\tSing\t1\tsees\t2\tnsubj\n")
+    result = run_main(workspace, "probe", "--train", "--tags", "English,number_noun", "--config_path", "default",
+                      "--data_type", "view:random=uniform,seed=1")
+    assert result.returncode == 1, result.stdout + result.stderr
+    assert "FAILED (failed to run): number_noun/English" in result.stdout
+    with open(workspace / "logs" / "training" / "view:random=uniform,seed=1" / "number_noun" / "English.log", encoding="utf-8") as log_file:
+        assert "Streaming the rows of" in log_file.read()
+
+
+def test_view_training_jobs_grouped_by_language(workspace):
+    # By the data size alone (longest first) the jobs of the two languages would alternate.
+    write_treebank(workspace, "Afrikaans", "af")
+    write_probe_task(workspace, "number_noun", "Afrikaans", number_noun_row)
+    for language in ["English", "Afrikaans"]:
+        write_probe_task(workspace, "definite_det", language, definite_det_row)
+    assert run_main(workspace, "generate", "--tags", "All,All").returncode == 0
+    result = run_main(workspace, "probe", "--train", "--plan", "--workers", "2", "--config_path", "default",
+                      "--data_type", "view:hops=1")
+    assert result.returncode == 0, result.stdout + result.stderr
+    jobs = [line.split()[1].rstrip(":") for line in result.stdout.splitlines() if line.startswith("    ") and "/4 " in line]
+    assert jobs == ["number_noun/Afrikaans", "definite_det/Afrikaans", "number_noun/English", "definite_det/English"]
+
+
+def bare_git_repo(root, repo_name, file_paths):
+    # A bare repository with a single commit of the given files, served like a remote ('--git_url file://<root>/').
+    work_dir = root / "work" / repo_name
+    for file_path in file_paths:
+        (work_dir / file_path).parent.mkdir(parents=True, exist_ok=True)
+        (work_dir / file_path).write_text(f"{file_path}\n", encoding="utf-8")
+    git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.com"]
+    subprocess.run(git + ["init", "-q", "-b", "main", str(work_dir)], check=True)
+    subprocess.run(git + ["-C", str(work_dir), "add", "-A"], check=True)
+    subprocess.run(git + ["-C", str(work_dir), "commit", "-q", "-m", "data"], check=True)
+    subprocess.run(git + ["clone", "-q", "--bare", str(work_dir), str(root / repo_name)], check=True)
+    # Serve the partial clones of the sparse checkouts too.
+    subprocess.run(git + ["-C", str(root / repo_name), "config", "uploadpack.allowFilter", "true"], check=True)
+
+
+def test_download_sparse_checkout(tmp_path):
+    remote = tmp_path / "remote"
+    bare_git_repo(remote, "probing", ["README.md"])
+    probe_files = ["data/number_noun/English/train.tsv", "data/number_noun/Hungarian/train.tsv", "data/definite_det/English/train.tsv"]
+    bare_git_repo(remote, "morphology-probes", probe_files)
+    workspace = tmp_path / "workspace"
+    # The UD treebank is already downloaded.
+    write_treebank(workspace, "English", "en")
+    checked_out = {
+        "English,number_noun": {"data/number_noun/English/train.tsv"},
+        "Hungarian,number_noun": {"data/number_noun/English/train.tsv", "data/number_noun/Hungarian/train.tsv"},
+        "All,All": set(probe_files),
+    }
+    # Clone sparse, add a language, then check out everything.
+    for tags, expected_files in checked_out.items():
+        result = run_main(workspace, "download", "--git_url", f"file://{remote}/", "--tags", tags)
+        assert result.returncode == 0, result.stdout + result.stderr
+        found_files = {file_path for file_path in probe_files if os.path.isfile(workspace / "morphology_probes" / file_path)}
+        assert found_files == expected_files, tags
+    sparse_checkout = subprocess.run(["git", "-C", str(workspace / "morphology_probes"), "config", "--get", "core.sparseCheckout"],
+                                     capture_output=True, text=True)
+    assert sparse_checkout.stdout.strip() != "true"
+
+
+# The UD treebank archive served by 'ud_server', its contents are not read by the download.
+UD_ARCHIVE = bytes(range(256)) * 64
+
+
+class UDArchiveHandler(http.server.BaseHTTPRequestHandler):
+    # Serves 'UD_ARCHIVE' with HTTP Range support, the Range header of every request is recorded in 'ranges'.
+    ranges = []
+
+    def do_GET(self):
+        if self.path != "/ud-treebanks-v2.12.tgz":
+            self.send_error(404)
+            return
+        byte_range = self.headers.get("Range")
+        self.ranges.append(byte_range)
+        start = int(byte_range[len("bytes="):].rstrip("-")) if byte_range else 0
+        if start >= len(UD_ARCHIVE):
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{len(UD_ARCHIVE)}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(206 if byte_range else 200)
+        if byte_range:
+            self.send_header("Content-Range", f"bytes {start}-{len(UD_ARCHIVE)-1}/{len(UD_ARCHIVE)}")
+        self.send_header("Content-Length", str(len(UD_ARCHIVE)-start))
+        self.end_headers()
+        self.wfile.write(UD_ARCHIVE[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def ud_server():
+    """
+    A local stand-in of the UD treebank repository, yields its url and the recorded Range headers.
+    """
+    UDArchiveHandler.ranges = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), UDArchiveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", UDArchiveHandler.ranges
+    server.shutdown()
+    server.server_close()
+
+
+def download_treebank(tmp_path, ud_url, file_name, file_data):
+    # Run the download with the given file of a previous download in the workspace.
+    remote = tmp_path / "remote"
+    bare_git_repo(remote, "probing", ["README.md"])
+    bare_git_repo(remote, "morphology-probes", ["data/number_noun/English/train.tsv"])
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+    (workspace / file_name).write_bytes(file_data)
+    result = run_main(workspace, "download", "--ud_url", ud_url, "--git_url", f"file://{remote}/",
+                      "--sha256", hashlib.sha256(UD_ARCHIVE).hexdigest())
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert (workspace / "ud-treebanks-v2.12.tgz").read_bytes() == UD_ARCHIVE
+    assert not (workspace / "ud-treebanks-v2.12.tgz.part").exists()
+    return result
+
+
+def test_download_resumes_partial_file(tmp_path, ud_server):
+    ud_url, ranges = ud_server
+    result = download_treebank(tmp_path, ud_url, "ud-treebanks-v2.12.tgz.part", UD_ARCHIVE[:1000])
+    assert ranges == ["bytes=1000-"]
+    assert "Resuming the download" in result.stdout
+
+
+def test_download_completed_partial_file(tmp_path, ud_server):
+    # The whole file was received before the interruption: the server answers 416.
+    ud_url, ranges = ud_server
+    download_treebank(tmp_path, ud_url, "ud-treebanks-v2.12.tgz.part", UD_ARCHIVE)
+    assert ranges == [f"bytes={len(UD_ARCHIVE)}-"]
+
+
+@pytest.mark.parametrize("file_name, ranges_expected", [
+    # A download resumed from the partial file of another archive.
+    ("ud-treebanks-v2.12.tgz.part", ["bytes=1000-", None]),
+    ("ud-treebanks-v2.12.tgz", [None]),
+])
+def test_download_replaces_corrupted_file(tmp_path, ud_server, file_name, ranges_expected):
+    ud_url, ranges = ud_server
+    result = download_treebank(tmp_path, ud_url, file_name, bytes(1000))
+    assert ranges == ranges_expected
+    assert "SHA-256 checksum mismatch" in result.stdout